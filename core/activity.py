@@ -0,0 +1,142 @@
+import logging
+import threading
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Coalesce
+from koru.utils import PeriodicFlusher
+from . import permissions
+from .models import Channel, Message
+
+logger = logging.getLogger(__name__)
+
+# channel id -> newest message id sent there that hasn't been written to Channel.last_message yet
+_pending = {}
+_lock = threading.Lock()
+
+FLUSH_BATCH_SIZE = 500
+
+
+def _flush_interval():
+    return getattr(settings, "LAST_MESSAGE_FLUSH_INTERVAL", 1)
+
+
+def record_last_message(channel_id, message_id):
+    """
+    Note a new message in a channel. Channel.last_message isn't written on every send; the newest id per
+    channel is kept in memory and written by flush_last_messages(), so busy channels don't serialize every
+    insert on their channel row.
+    """
+    with _lock:
+        if channel_id not in _pending or _pending[channel_id] < message_id:
+            _pending[channel_id] = message_id
+    _flusher.start()
+
+
+def on_message_created(message):
+    channel_id, message_id = message.channel_id, message.pk
+    transaction.on_commit(lambda: record_last_message(channel_id, message_id))
+
+
+def forget_messages(message_ids):
+    """Drop pending pointers to messages that are being purged, so they never get written."""
+    message_ids = set(message_ids)
+    with _lock:
+        for channel_id in [c for c, m in _pending.items() if m in message_ids]:
+            del _pending[channel_id]
+
+
+def _valid_pointers(batch):
+    # Pointers to messages that are gone (or somehow in another channel) would fail the foreign key forever
+    found = dict(Message.objects.filter(pk__in={message_id for _, message_id in batch}).values_list("pk", "channel_id"))
+    return [(channel_id, message_id) for channel_id, message_id in batch if found.get(message_id) == channel_id]
+
+
+def _write_pointers(batch):
+    if not batch:
+        return
+    pointer = Channel._meta.get_field("last_message").target_field
+    newer = Q()
+    whens = []
+    for channel_id, message_id in batch:
+        condition = Q(pk=channel_id) & (Q(last_message__isnull=True) | Q(last_message_id__lt=message_id))
+        newer |= condition
+        whens.append(When(condition, then=Value(message_id)))
+    with transaction.atomic():
+        Channel.objects.filter(newer).update(
+            last_message_id=Case(*whens, default=F("last_message_id"), output_field=pointer)
+        )
+
+
+def flush_last_messages() -> int:
+    """
+    Write pending last_message pointers, one UPDATE per batch of channels. The pointer only ever moves
+    forward, so a stale flush can't undo a newer one. Pointers to messages that have since been deleted are
+    dropped rather than retried. Returns how many channels were written.
+    """
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    items = list(pending.items())
+    written = 0
+    for start in range(0, len(items), FLUSH_BATCH_SIZE):
+        try:
+            batch = _valid_pointers(items[start:start + FLUSH_BATCH_SIZE])
+            if not batch:
+                continue
+            try:
+                _write_pointers(batch)
+                written += len(batch)
+            except IntegrityError:
+                # A message went away since the check above; find it one pointer at a time
+                for item in batch:
+                    try:
+                        _write_pointers([item])
+                        written += 1
+                    except IntegrityError:
+                        logger.warning("Dropping last message pointer %r that can't be written", item)
+        except Exception:
+            # Anything else (the database going away) is worth another go, for what hasn't been written yet
+            with _lock:
+                for channel_id, message_id in items[start:]:
+                    if channel_id not in _pending or _pending[channel_id] < message_id:
+                        _pending[channel_id] = message_id
+            raise
+    return written
+
+
+_flusher = PeriodicFlusher("last-message-flusher", flush_last_messages, _flush_interval)
+
+
+def last_message_id(channel):
+    """The newest message in a channel, counting sends that haven't been flushed yet."""
+    channel_id = getattr(channel, "pk", channel)
+    with _lock:
+        pending = _pending.get(channel_id)
+    if isinstance(channel, Channel):
+        stored = channel.last_message_id
+    else:
+        stored = Channel.objects.filter(pk=channel_id).values_list("last_message_id", flat=True).first()
+    return max(filter(None, (stored, pending)), default=None)
+
+
+def inbox(user, limit: int = 50) -> list[Channel]:
+    """
+    The user's DMs and group DMs, most recently active first, in one query. Each channel gets
+    `last_activity`: the id of its newest message, or its own id if nothing has been sent yet.
+    Sends that haven't been flushed yet are folded in for the channels on the page.
+    """
+    channels = list(
+        permissions.private_channels(user)
+        .select_related("dm", "group_dm")
+        .annotate(last_activity=Coalesce("last_message_id", "id"))
+        .order_by("-last_activity")[:limit]
+    )
+    with _lock:
+        pending = {c.pk: _pending[c.pk] for c in channels if c.pk in _pending}
+    if pending:
+        for channel in channels:
+            if channel.pk in pending and pending[channel.pk] > channel.last_activity:
+                channel.last_activity = pending[channel.pk]
+        channels.sort(key=lambda c: c.last_activity, reverse=True)
+    return channels
@@ -0,0 +1,337 @@
+import json
+import logging
+import mmap
+import tempfile
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import InvalidStorageError, storages
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from koru.utils import snowflake_from_timestamp, timestamp_from_snowflake
+from users.models import User
+from . import search, uploads
+from .models import ArchiveSegment, Attachment, Channel, Message
+from .deletion import delete_message_rows
+
+logger = logging.getLogger(__name__)
+
+# Messages per compressed block. A block is the smallest unit read back, and gets one entry in the sparse index.
+BLOCK_SIZE = 256
+DELETE_BATCH_SIZE = 1000
+
+MESSAGE_FIELDS = (
+    "id", "author_id", "content", "attachments", "reply_to_id", "forwarded_from_id", "pinned_to_channel",
+    "mention_roles", "mention_everyone", "created_at", "updated_at",
+)
+
+
+def archive_after() -> timedelta:
+    return timedelta(days=getattr(settings, "ARCHIVE_AFTER_DAYS", 180))
+
+
+def get_archive_storage():
+    """The "archive" entry in STORAGES if there is one, otherwise wherever attachments go."""
+    try:
+        return storages["archive"]
+    except InvalidStorageError:
+        return uploads.get_storage()
+
+
+def _month_start(when: datetime) -> datetime:
+    return when.astimezone(dt_timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(start: datetime) -> datetime:
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+# Writing
+
+def _records(messages: list[dict]) -> list[dict]:
+    """Archive records for a block of messages, with their mentions and uploads folded in. Two queries."""
+    ids = [m["id"] for m in messages]
+    mentions = {}
+    for message_id, user_id in Message.mentions.through.objects.filter(message_id__in=ids).values_list("message_id", "user_id"):
+        mentions.setdefault(message_id, []).append(user_id)
+    uploads = {}
+    for upload in Attachment.objects.filter(message_id__in=ids).order_by("id").values(
+        "id", "message_id", "url", "path", "filename", "content_type", "size", "sha256"
+    ):
+        uploads.setdefault(upload.pop("message_id"), []).append(upload)
+    return [
+        {
+            **m,
+            "created_at": m["created_at"].isoformat(),
+            "updated_at": m["updated_at"].isoformat(),
+            "mentions": sorted(mentions.get(m["id"], ())),
+            "uploads": uploads.get(m["id"], []),
+        }
+        for m in messages
+    ]
+
+
+def _encode_block(records: list[dict]) -> bytes:
+    return zlib.compress("\n".join(json.dumps(r, separators=(",", ":")) for r in records).encode())
+
+
+def _archivable(channel: Channel, start_id: str, end_id: str):
+    # The channel's last message stays hot so Channel.last_message (and the inbox order) survives archiving
+    qs = Message.objects.filter(channel_id=channel.pk, deleted=False, id__gte=start_id, id__lt=end_id)
+    if channel.last_message_id:
+        qs = qs.exclude(pk=channel.last_message_id)
+    return qs
+
+
+def archive_channel_month(channel: Channel, month: datetime) -> ArchiveSegment | None:
+    """
+    Move a channel's messages from one calendar month (UTC) into a new segment file, then delete them from
+    the hot table. Segments are never rewritten: running this again for a month that already has one just
+    adds another segment holding whatever was left behind. Returns the segment, or None if there was nothing.
+
+    A segment is a run of zlib-compressed blocks of up to BLOCK_SIZE messages, as JSON lines in id order.
+    Its sparse index, one (first id, last id, offset, length) entry per block, is kept on the ArchiveSegment
+    row so a read can go straight to the blocks it needs.
+    """
+    start = _month_start(month)
+    start_id, end_id = snowflake_from_timestamp(start), snowflake_from_timestamp(_next_month(start))
+    messages = _archivable(channel, start_id, end_id).order_by("id").values(*MESSAGE_FIELDS)
+
+    index = []
+    ids = []
+    authors, upload_paths = set(), []
+    with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as segment:
+        last_id = ""
+        while True:
+            block = list(messages.filter(id__gt=last_id)[:BLOCK_SIZE])
+            if not block:
+                break
+            last_id = block[-1]["id"]
+            records = _records(block)
+            payload = _encode_block(records)
+            index.append([block[0]["id"], last_id, segment.tell(), len(payload)])
+            segment.write(payload)
+            ids.extend(m["id"] for m in block)
+            authors.update(r["author_id"] for r in records)
+            upload_paths.extend(u["path"] for r in records for u in r["uploads"] if u["path"])
+        if not ids:
+            return None
+        size = segment.tell()
+        segment.seek(0)
+        path = get_archive_storage().save(f"archive/{channel.pk}/{start:%Y-%m}-{ids[0]}.seg", File(segment))
+
+    with transaction.atomic():
+        archived = ArchiveSegment.objects.create(
+            channel_id=channel.pk, month=f"{start:%Y-%m}", path=path, first_id=ids[0], last_id=ids[-1],
+            message_count=len(ids), size=size, index=index, upload_paths=upload_paths,
+        )
+        archived.authors.add(*authors)
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            # The uploads' files stay, the segment still points at them
+            delete_message_rows(ids[i:i + DELETE_BATCH_SIZE], delete_files=False)
+        # Only ever moves forward, in case an older month gets archived after a newer one
+        Channel.objects.filter(pk=channel.pk).filter(
+            Q(archived_through__isnull=True) | Q(archived_through__lt=ids[-1])
+        ).update(archived_through=ids[-1])
+    search.remove_messages(ids)
+    logger.info("Archived %d messages from channel %s for %s into %s", len(ids), channel.pk, archived.month, path)
+    return archived
+
+
+def archive_messages(older_than: timedelta = None, channel=None, now=None) -> int:
+    """
+    Archive every whole month of messages that ended more than older_than (ARCHIVE_AFTER_DAYS by default)
+    ago, for one channel or all of them. Returns how many messages were archived.
+    """
+    now = now or timezone.now()
+    cutoff = _month_start(now - (older_than if older_than is not None else archive_after()))
+    cutoff_id = snowflake_from_timestamp(cutoff)
+    channels = Channel.objects.all() if channel is None else Channel.objects.filter(pk=getattr(channel, "pk", channel))
+
+    archived = 0
+    for c in channels.filter(messages__id__lt=cutoff_id, messages__deleted=False).distinct().order_by("pk"):
+        oldest = Message.objects.filter(channel=c, deleted=False).order_by("id").values_list("id", flat=True).first()
+        month = _month_start(timestamp_from_snowflake(oldest))
+        while month < cutoff:
+            segment = archive_channel_month(c, month)
+            archived += segment.message_count if segment else 0
+            month = _next_month(month)
+    return archived
+
+
+# Reading
+
+def _read_block(storage, path: str, offset: int, length: int) -> bytes:
+    try:
+        local_path = storage.path(path)
+    except NotImplementedError:
+        local_path = None
+    if local_path is not None:
+        with open(local_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return mapped[offset:offset + length]
+    # Remote storages turn a seek + read into a ranged GET
+    with storage.open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _decode_block(storage, path: str, offset: int, length: int) -> list[dict]:
+    return [json.loads(line) for line in zlib.decompress(_read_block(storage, path, offset, length)).decode().split("\n")]
+
+
+def _to_message(channel: Channel, record: dict) -> Message:
+    message = Message(
+        channel=channel,
+        **{field: record[field] for field in MESSAGE_FIELDS if field not in ("created_at", "updated_at")},
+    )
+    message.created_at = parse_datetime(record["created_at"])
+    message.updated_at = parse_datetime(record["updated_at"])
+    message._state.adding = False
+    message.archived = True
+    message.archived_mention_ids = record["mentions"]
+    message.archived_files = [Attachment(message_id=message.pk, **upload) for upload in record["uploads"]]
+    return message
+
+
+def read_archived(channel: Channel, after=None, before=None, limit: int = 50, newest_first: bool = True) -> list[Message]:
+    """
+    Archived messages in a channel with after < id < before, up to limit of them from the newest end
+    (or the oldest with newest_first=False), newest first either way. One query for the segments plus
+    one for the people in them; only the blocks the page actually falls in are read and decompressed.
+    """
+    if not channel.archived_through:
+        return []
+    segments = ArchiveSegment.objects.filter(channel_id=channel.pk)
+    if after is not None:
+        segments = segments.filter(last_id__gt=after)
+    if before is not None:
+        segments = segments.filter(first_id__lt=before)
+    segments = list(segments.order_by("-first_id" if newest_first else "first_id"))
+
+    storage = get_archive_storage()
+    records = []
+    for segment in segments:
+        blocks = [b for b in segment.index if (after is None or b[1] > after) and (before is None or b[0] < before)]
+        for first_id, last_id, offset, length in (reversed(blocks) if newest_first else blocks):
+            block = [
+                r for r in _decode_block(storage, segment.path, offset, length)
+                if (after is None or r["id"] > after) and (before is None or r["id"] < before)
+            ]
+            records.extend(reversed(block) if newest_first else block)
+            if len(records) >= limit:
+                break
+        if len(records) >= limit:
+            break
+    # Segments can overlap when a month got archived twice, so sort rather than trust the read order
+    records.sort(key=lambda r: r["id"], reverse=newest_first)
+    records = records[:limit]
+    if not newest_first:
+        records.reverse()
+
+    messages = [_to_message(channel, r) for r in records]
+    people = User.objects.in_bulk({m.author_id for m in messages} | {u for r in records for u in r["mentions"]})
+    for message in messages:
+        message.author = people.get(message.author_id)
+        message.archived_mentions = [people[u] for u in message.archived_mention_ids if u in people]
+    return messages
+
+
+
+# Removing
+
+def delete_segment_files(path: str, upload_paths=()):
+    """Remove a segment's file, and the uploads only it still pointed at, from storage. Failures are only logged."""
+    try:
+        get_archive_storage().delete(path)
+    except Exception:
+        logger.exception("Couldn't delete archive segment %s", path)
+    uploads.delete_files(upload_paths)
+
+
+def _rewrite_segment(segment_id, drop) -> list[str]:
+    """
+    Rewrite one segment without the records drop(record) is true for, or delete it if that's all of them.
+    The old file and the dropped messages' uploads are deleted once that commits. Returns the dropped ids.
+    """
+    storage = get_archive_storage()
+    with transaction.atomic():
+        # Locked, so two rewrites of the same segment can't each keep the other's messages
+        segment = ArchiveSegment.objects.select_for_update().filter(pk=segment_id).first()
+        if segment is None:
+            return []
+        blocks, dropped, dropped_uploads = [], [], []
+        for _, _, offset, length in segment.index:
+            kept = []
+            for record in _decode_block(storage, segment.path, offset, length):
+                if drop(record):
+                    dropped.append(record["id"])
+                    dropped_uploads.extend(u["path"] for u in record["uploads"] if u["path"])
+                else:
+                    kept.append(record)
+            if kept:
+                blocks.append(kept)
+        if not dropped:
+            return []
+        if not blocks:
+            # post_delete takes care of the files (see core.signals)
+            segment.delete()
+            return dropped
+
+        gone = set(dropped)
+        records = [r for block in blocks for r in block]
+        for record in records:
+            # Same as delete_message_rows() does for the hot table
+            if record["reply_to_id"] in gone:
+                record["reply_to_id"] = None
+            if record["forwarded_from_id"] in gone:
+                record["forwarded_from_id"] = None
+        index = []
+        with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as rewritten:
+            for block in blocks:
+                payload = _encode_block(block)
+                index.append([block[0]["id"], block[-1]["id"], rewritten.tell(), len(payload)])
+                rewritten.write(payload)
+            size = rewritten.tell()
+            rewritten.seek(0)
+            path = storage.save(f"archive/{segment.channel_id}/{segment.month}-{records[0]['id']}.seg", File(rewritten))
+        old_path, dropped_upload_set = segment.path, set(dropped_uploads)
+        try:
+            segment.path, segment.index, segment.size = path, index, size
+            segment.first_id, segment.last_id, segment.message_count = records[0]["id"], records[-1]["id"], len(records)
+            segment.upload_paths = [p for p in segment.upload_paths if p not in dropped_upload_set]
+            segment.save()
+            segment.authors.set({r["author_id"] for r in records})
+        except Exception:
+            storage.delete(path)
+            raise
+        transaction.on_commit(lambda: delete_segment_files(old_path, dropped_uploads))
+    return dropped
+
+
+def remove_archived(segments, drop) -> list[tuple[str, str]]:
+    """
+    Permanently remove archived messages: every record drop(record) is true for, from the given segments.
+    Each segment is rewritten (in its own transaction) without them. Returns (message id, channel id) for
+    each message removed.
+    """
+    removed = []
+    for segment_id, channel_id in segments.order_by("pk").values_list("pk", "channel_id"):
+        removed.extend((message_id, channel_id) for message_id in _rewrite_segment(segment_id, drop))
+    return removed
+
+
+def remove_archived_ids(channel_id, ids) -> list[tuple[str, str]]:
+    """Permanently remove these archived messages from a channel. Returns what remove_archived() does."""
+    ids = set(ids)
+    if not ids:
+        return []
+    segments = ArchiveSegment.objects.filter(channel_id=channel_id, first_id__lte=max(ids), last_id__gte=min(ids))
+    return remove_archived(segments, lambda record: record["id"] in ids)
+
+
+def remove_archived_author(user_id) -> list[tuple[str, str]]:
+    """Permanently remove every archived message a user wrote. Returns what remove_archived() does."""
+    return remove_archived(ArchiveSegment.objects.filter(authors=user_id), lambda record: record["author_id"] == user_id)
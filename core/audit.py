@@ -0,0 +1,147 @@
+import logging
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from koru import metrics
+from koru.utils import PeriodicFlusher, normalize_cursor
+from .models import AuditLogEntry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+# Entries whose transaction has committed but that haven't been written yet
+_buffer = []
+_lock = threading.Lock()
+
+
+def _flush_interval():
+    return getattr(settings, "AUDIT_LOG_FLUSH_INTERVAL", 2)
+
+
+def _batch_size():
+    return getattr(settings, "AUDIT_LOG_BATCH_SIZE", 500)
+
+
+def _max_buffer():
+    return getattr(settings, "AUDIT_LOG_MAX_BUFFER", 50000)
+
+
+def _trim_buffer():
+    # Call with _lock held. If the database has been gone long enough for this to fill up, keep the newest entries.
+    excess = len(_buffer) - _max_buffer()
+    if excess > 0:
+        del _buffer[:excess]
+        metrics.incr("audit_log.dropped", excess)
+        logger.error("Audit log buffer is full, dropped the %d oldest entries", excess)
+
+
+def _write(entries) -> int:
+    try:
+        with transaction.atomic():
+            AuditLogEntry.objects.bulk_create(entries)
+        return len(entries)
+    except IntegrityError:
+        pass
+    # Something in the batch can't be written (say its space was deleted since), so go one at a time and drop it
+    written = 0
+    for entry in entries:
+        try:
+            with transaction.atomic():
+                entry.save(force_insert=True)
+            written += 1
+        except IntegrityError:
+            metrics.incr("audit_log.dropped")
+            logger.warning("Dropping audit log entry %s (%s in space %s) that can't be written", entry.pk, entry.action, entry.space_id)
+    return written
+
+
+def flush_audit_log() -> int:
+    """
+    Write every buffered entry, a batch at a time. Entries the database rejects are dropped so they can't
+    hold up the rest. Returns how many were written.
+    """
+    global _buffer
+    with _lock:
+        entries, _buffer = _buffer, []
+    written = 0
+    batch_size = _batch_size()
+    for start in range(0, len(entries), batch_size):
+        try:
+            written += _write(entries[start:start + batch_size])
+        except Exception:
+            # The database is probably unreachable, so keep what's left for the next flush
+            with _lock:
+                _buffer = entries[start:] + _buffer
+                _trim_buffer()
+            raise
+    return written
+
+
+_flusher = PeriodicFlusher("audit-log-flusher", flush_audit_log, _flush_interval)
+
+
+def _enqueue(entries):
+    with _lock:
+        _buffer.extend(entries)
+        _trim_buffer()
+        full = len(_buffer) >= _batch_size()
+    if full:
+        flush_audit_log()
+    else:
+        _flusher.start()
+
+
+def log_action(space, action: str, performed_by=None, details: dict = None) -> AuditLogEntry:
+    """
+    Record an action in a space's audit log without writing it inside the request.
+
+    The entry is buffered until the surrounding transaction commits (and dropped if it rolls back), then
+    written in a batch with everything else buffered, either when the batch fills up or on the next timer tick.
+    The entry's snowflake is assigned now, so it still sorts by when the action happened.
+    """
+    entry = AuditLogEntry(
+        space_id=getattr(space, "pk", space),
+        action=action,
+        performed_by_id=getattr(performed_by, "pk", performed_by),
+        details=details or {},
+        timestamp=timezone.now(),
+    )
+    transaction.on_commit(lambda: _enqueue([entry]))
+    return entry
+
+
+def get_audit_log(space, before=None, action: str = None, actor=None, limit: int = DEFAULT_PAGE_SIZE) -> list[AuditLogEntry]:
+    """
+    A page of a space's audit log, newest first. Pass the last entry's id as before to get the next page.
+
+    Only written entries are read, so an action shows up here once its process has flushed it, within
+    AUDIT_LOG_FLUSH_INTERVAL seconds (sooner if the batch filled up).
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    qs = AuditLogEntry.objects.filter(space_id=getattr(space, "pk", space)).select_related("performed_by")
+    if before is not None:
+        qs = qs.filter(id__lt=normalize_cursor(before))
+    if action is not None:
+        qs = qs.filter(action=action)
+    if actor is not None:
+        qs = qs.filter(performed_by_id=getattr(actor, "pk", actor))
+    return list(qs.order_by("-id")[:limit])
+
+
+def prune_audit_log(batch_size: int = 1000, now=None) -> int:
+    """Delete entries older than AUDIT_LOG_RETENTION_DAYS, batch_size at a time. Returns how many were deleted."""
+    cutoff = (now or timezone.now()) - timedelta(days=getattr(settings, "AUDIT_LOG_RETENTION_DAYS", 90))
+    deleted = 0
+    while True:
+        ids = list(AuditLogEntry.objects.created_before(cutoff).order_by("id").values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            break
+        # Nothing references audit log entries, so this is a single DELETE with no collector work
+        deleted += AuditLogEntry.objects.filter(pk__in=ids).delete()[0]
+        if len(ids) < batch_size:
+            break
+    return deleted
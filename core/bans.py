@@ -0,0 +1,131 @@
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from . import counters, permissions
+from .audit import log_action
+from .models import Message, Space, SpaceBan, SpaceMember, UserRoleAssignment
+from .deletion import raw_delete
+from .purge import purge_message_ids
+
+# Ban checks are cached briefly. Bans made or lifted here clear the cache straight away; the TTL only
+# bounds what we can't see, like the sweeper expiring a ban.
+BAN_CHECK_TTL = 30
+CHUNK_SIZE = 1000
+
+
+def _ban_key(space_id, user_id):
+    return f"koru:ban:{space_id}:{user_id}"
+
+
+def is_banned(user, space) -> bool:
+    """Whether the user has an active ban in the space, from cache when possible."""
+    space_id, user_id = getattr(space, "pk", space), getattr(user, "pk", user)
+    key = _ban_key(space_id, user_id)
+    banned = cache.get(key)
+    if banned is None:
+        banned = int(SpaceBan.objects.filter(space_id=space_id, user_id=user_id, active=True).exists())
+        cache.set(key, banned, BAN_CHECK_TTL)
+    return bool(banned)
+
+
+def check_not_banned(user, space):
+    """For join and send paths: raises ValidationError if the user is banned from the space."""
+    if is_banned(user, space):
+        raise ValidationError("You are banned from this space")
+
+
+def forget_bans(pairs):
+    """Drop cached ban checks for (space id, user id) pairs."""
+    cache.delete_many([_ban_key(space_id, user_id) for space_id, user_id in pairs])
+
+
+def _targets(space: Space, user_ids, joined_after, joined_before) -> list:
+    members = SpaceMember.objects.filter(space_id=space.pk)
+    if joined_after is not None:
+        members = members.filter(joined_at__gte=joined_after)
+    if joined_before is not None:
+        members = members.filter(joined_at__lt=joined_before)
+    if user_ids is None:
+        targets = set(members.values_list("user_id", flat=True))
+    elif joined_after is None and joined_before is None:
+        # Plain user lists can include people who've already left
+        targets = {getattr(user, "pk", user) for user in user_ids}
+    else:
+        targets = set(members.filter(user_id__in=[getattr(user, "pk", user) for user in user_ids]).values_list("user_id", flat=True))
+    targets.discard(space.owner_id)
+    return sorted(targets)
+
+
+def bulk_ban(
+    space: Space,
+    user_ids=None,
+    joined_after=None,
+    joined_before=None,
+    banned_by=None,
+    reason: str = "",
+    expires_at=None,
+    purge_since=None,
+) -> dict:
+    """
+    Ban a set of users from a space in one go, for raids. Pick them with user_ids, a join window
+    (joined_after/joined_before), or both. The owner and whoever is banning are never included.
+
+    Per CHUNK_SIZE users that's one INSERT of bans, one DELETE each for memberships and role assignments,
+    and, with purge_since, their messages in the space sent since then are purged in batches.
+    One audit entry covers the lot. Returns counts of what was done.
+    """
+    if user_ids is None and joined_after is None and joined_before is None:
+        raise ValidationError("Pick who to ban with a list of users or a join window")
+    banned_by_id = getattr(banned_by, "pk", banned_by)
+    targets = [user_id for user_id in _targets(space, user_ids, joined_after, joined_before) if user_id != banned_by_id]
+    result = {"banned": 0, "removed": 0, "messages_purged": 0}
+    if not targets:
+        return result
+
+    with transaction.atomic():
+        for start in range(0, len(targets), CHUNK_SIZE):
+            chunk = targets[start:start + CHUNK_SIZE]
+            already = set(
+                SpaceBan.objects.filter(space_id=space.pk, user_id__in=chunk, active=True).values_list("user_id", flat=True)
+            )
+            bans = SpaceBan.objects.bulk_create([
+                SpaceBan(space_id=space.pk, user_id=user_id, banned_by_id=banned_by_id, reason=reason, expires_at=expires_at)
+                for user_id in chunk if user_id not in already
+            ])
+            result["banned"] += len(bans)
+
+            # Both are bulk deletes with no signals: SpaceMember has none to send, so QuerySet.delete() is a single
+            # DELETE, and role assignments go through raw_delete to skip theirs. Counters and caches are told below.
+            removed, _ = SpaceMember.objects.filter(space_id=space.pk, user_id__in=chunk).delete()
+            result["removed"] += removed
+            assignments = list(UserRoleAssignment.objects.filter(space_id=space.pk, user_id__in=chunk).values_list("pk", flat=True))
+            if assignments:
+                raw_delete(UserRoleAssignment, assignments)
+
+            if purge_since is not None:
+                messages = Message.objects.filter(channel__space_id=space.pk, author_id__in=chunk).created_after(purge_since)
+                while batch := list(messages.values_list("pk", flat=True)[:CHUNK_SIZE]):
+                    result["messages_purged"] += purge_message_ids(batch)
+
+        if result["removed"]:
+            counters.on_members_changed(space.pk, -result["removed"])
+        log_action(space, "bulk_ban", performed_by=banned_by_id, details={
+            "user_ids": targets,
+            "reason": reason,
+            "expires_at": expires_at.isoformat() if expires_at else None,
+            "joined_after": joined_after.isoformat() if joined_after else None,
+            "joined_before": joined_before.isoformat() if joined_before else None,
+            **result,
+        })
+        space_id = space.pk
+        transaction.on_commit(lambda: permissions.invalidate_space(space_id))
+        transaction.on_commit(lambda: forget_bans((space_id, user_id) for user_id in targets))
+    return result
+
+
+def unban(space, user):
+    """Lift a user's active bans in a space."""
+    space_id, user_id = getattr(space, "pk", space), getattr(user, "pk", user)
+    SpaceBan.objects.filter(space_id=space_id, user_id=user_id, active=True).update(active=False, updated_at=timezone.now())
+    transaction.on_commit(lambda: forget_bans([(space_id, user_id)]))
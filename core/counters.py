@@ -0,0 +1,94 @@
+import threading
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Value, When
+from django.dispatch import Signal
+from koru.utils import PeriodicFlusher
+from .models import Space
+
+# Sent with space_ids=... after member_count has been written for those spaces
+member_counts_changed = Signal()
+
+# space id -> pending member_count delta that hasn't been written yet
+_pending = {}
+_lock = threading.Lock()
+
+
+def _flush_interval():
+    return getattr(settings, "MEMBER_COUNT_FLUSH_INTERVAL", 5)
+
+
+def record_member_delta(space_id, delta: int):
+    """
+    Queue a member_count change. Joins and leaves are folded together in memory and written by
+    flush_member_counts(), so a raid turns into one UPDATE per flush instead of one per join.
+    """
+    if not delta:
+        return
+    with _lock:
+        _pending[space_id] = _pending.get(space_id, 0) + delta
+    _flusher.start()
+
+
+def flush_member_counts() -> int:
+    """Write out pending member_count deltas. Returns how many spaces were touched."""
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+
+    # Spaces that moved by the same amount share one UPDATE
+    by_delta = {}
+    for space_id, delta in pending.items():
+        if delta:
+            by_delta.setdefault(delta, []).append(space_id)
+    try:
+        for delta, space_ids in by_delta.items():
+            Space.objects.filter(pk__in=space_ids).update(member_count=F("member_count") + delta)
+    except Exception:
+        # Put the deltas back so they get another go on the next flush
+        with _lock:
+            for space_id, delta in pending.items():
+                _pending[space_id] = _pending.get(space_id, 0) + delta
+        raise
+    changed = [space_id for space_ids in by_delta.values() for space_id in space_ids]
+    if changed:
+        member_counts_changed.send(sender=Space, space_ids=changed)
+    return len(changed)
+
+
+_flusher = PeriodicFlusher("member-count-flusher", flush_member_counts, _flush_interval)
+
+
+def on_members_changed(space_id, delta: int):
+    # Only count the change once the transaction that made it actually commits
+    transaction.on_commit(lambda: record_member_delta(space_id, delta))
+
+
+def reconcile_member_counts(batch_size: int = 1000) -> int:
+    """
+    Fix member_count drift for every space. Costs one aggregate query per batch of spaces, plus one UPDATE
+    for the batch if anything drifted. Returns the number of spaces that were corrected.
+    """
+    flush_member_counts()
+    fixed = 0
+    last_pk = ""
+    while True:
+        batch = list(
+            Space.objects.filter(pk__gt=last_pk)
+            .order_by("pk")
+            .annotate(actual=Count("members"))
+            .values_list("pk", "member_count", "actual")[:batch_size]
+        )
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+
+        drifted = {pk: actual for pk, stored, actual in batch if stored != actual}
+        if drifted:
+            Space.objects.filter(pk__in=drifted.keys()).update(member_count=Case(
+                *[When(pk=pk, then=Value(actual)) for pk, actual in drifted.items()],
+                output_field=IntegerField(),
+            ))
+            fixed += len(drifted)
+            member_counts_changed.send(sender=Space, space_ids=list(drifted))
+    return fixed
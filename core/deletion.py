@@ -0,0 +1,38 @@
+from django.db import connections, router, transaction
+from . import activity, uploads
+from .models import Attachment, Channel, Message, MessageReadState
+
+
+def raw_delete(model, ids) -> int:
+    """DELETE rows by primary key without Django's collector loading them (and everything they cascade to) first."""
+    connection = connections[router.db_for_write(model)]
+    table = connection.ops.quote_name(model._meta.db_table)
+    pk = connection.ops.quote_name(model._meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table} WHERE {pk} IN ({', '.join(['%s'] * len(ids))})", list(ids))
+        return cursor.rowcount
+
+
+def delete_attachments(queryset, delete_files: bool = True):
+    """Delete attachment rows, and their files once the deletion commits (unless something else still uses them)."""
+    paths = [path for path in queryset.values_list("path", flat=True) if path] if delete_files else []
+    queryset.delete()
+    if paths:
+        transaction.on_commit(lambda: uploads.delete_files(paths), using=router.db_for_write(Attachment))
+
+
+def delete_message_rows(ids, delete_files: bool = True) -> int:
+    """
+    Delete messages from the database along with everything that points at them, one statement per relation
+    instead of letting the collector walk them row by row. Doesn't touch the search index or tell anyone;
+    see core.purge.purge_message_ids() for that. Call it inside a transaction. Returns how many messages were
+    deleted. delete_files=False keeps the attachments' files in storage, for when the messages live on elsewhere.
+    """
+    Message.mentions.through.objects.filter(message_id__in=ids).delete()
+    delete_attachments(Attachment.objects.filter(message_id__in=ids), delete_files)
+    Message.objects.filter(reply_to_id__in=ids).update(reply_to=None)
+    Message.objects.filter(forwarded_from_id__in=ids).update(forwarded_from=None)
+    MessageReadState.objects.filter(last_read_message_id__in=ids).update(last_read_message=None)
+    Channel.objects.filter(last_message_id__in=ids).update(last_message=None)
+    activity.forget_messages(ids)
+    return raw_delete(Message, ids)
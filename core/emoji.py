@@ -0,0 +1,123 @@
+import re
+import threading
+from typing import NamedTuple
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from koru.utils import bump_stamp, get_stamps
+from .models import CustomEmoji, EmojiVersion
+
+# :name: as typed in message content
+EMOJI_TOKEN = re.compile(r":([A-Za-z0-9_]{2,64}):")
+
+
+class EmojiEntry(NamedTuple):
+    id: str
+    url: str
+    available: bool
+
+
+# space id -> (stamp, version, {name: EmojiEntry}). A map is only served while its stamp is still the space's
+# stamp in the shared cache, which every process's forget_space() replaces.
+_maps = {}
+_lock = threading.Lock()
+
+
+def _stamp_key(space_id) -> str:
+    return f"koru:emoji:{space_id}"
+
+
+def _pk(obj):
+    return getattr(obj, "pk", obj)
+
+
+def next_version(space_id) -> int:
+    """
+    Claim the next emoji version for a space. Call it inside the transaction that makes the change: the
+    counter row stays locked until that commits, so versions become visible in order.
+    """
+    with transaction.atomic():
+        if not EmojiVersion.objects.filter(space_id=space_id).update(version=F("version") + 1):
+            try:
+                with transaction.atomic():
+                    EmojiVersion.objects.create(space_id=space_id, version=1)
+                return 1
+            except IntegrityError:
+                # Someone else created it first
+                EmojiVersion.objects.filter(space_id=space_id).update(version=F("version") + 1)
+        return EmojiVersion.objects.filter(space_id=space_id).values_list("version", flat=True).get()
+
+
+def emoji_hard_deleted(space_id):
+    # A hard delete leaves nothing behind to report as a change, so everyone older than this has to start over
+    EmojiVersion.objects.filter(space_id=space_id).update(version=F("version") + 1, resync_version=F("version") + 1)
+
+
+def delete_emoji(emoji: CustomEmoji):
+    """Soft-delete an emoji. It stays behind as a tombstone so changes_since() can tell clients it's gone."""
+    emoji.deleted = True
+    emoji.save(update_fields=["deleted"])
+
+
+def _current_version(space_id) -> tuple[int, int]:
+    return EmojiVersion.objects.filter(space_id=space_id).values_list("version", "resync_version").first() or (0, 0)
+
+
+def get_emoji_map(space) -> tuple[int, dict]:
+    """The space's emoji as (version, {name: EmojiEntry}). Cached until an emoji in the space changes."""
+    space_id = _pk(space)
+    # Stamp before anything is loaded: a change landing mid-load replaces it, so the next read loads again
+    stamp, = get_stamps(_stamp_key(space_id))
+    with _lock:
+        cached = _maps.get(space_id)
+    if cached is not None and cached[0] == stamp:
+        return cached[1], cached[2]
+    # Version first: if an emoji changes in between, the map is newer than its version, never older
+    version, _ = _current_version(space_id)
+    emoji = {
+        name: EmojiEntry(pk, url, available)
+        for pk, name, url, available in CustomEmoji.objects.filter(space_id=space_id, deleted=False)
+        .values_list("pk", "name", "url", "available")
+    }
+    with _lock:
+        _maps[space_id] = (stamp, version, emoji)
+    return version, emoji
+
+
+def forget_space(space_id):
+    """Drop the space's cached map here, and (once the change commits) in every other process too."""
+    with _lock:
+        _maps.pop(space_id, None)
+    bump_stamp(_stamp_key(space_id))
+
+
+def resolve_emoji(space, content: str) -> dict[str, EmojiEntry]:
+    """Every custom emoji used in content that the space has, looked up in a single pass over the text."""
+    _, emoji = get_emoji_map(space)
+    if not emoji:
+        return {}
+    found = {}
+    for match in EMOJI_TOKEN.finditer(content):
+        name = match.group(1)
+        if name not in found and name in emoji:
+            found[name] = emoji[name]
+    return found
+
+
+def changes_since(space, version: int) -> dict:
+    """
+    What changed in a space's emoji after `version`, for clients keeping their own copy. Deleted emoji come
+    back with deleted=True. If the client is too far behind to patch up (or claims a version from the
+    future), `full` is set and `emoji` is everything the space has.
+    """
+    space_id = _pk(space)
+    current, resync = _current_version(space_id)
+    if version == current:
+        return {"version": current, "full": False, "emoji": []}
+    full = version < resync or version > current
+    queryset = CustomEmoji.objects.filter(space_id=space_id)
+    queryset = queryset.filter(deleted=False) if full else queryset.filter(version__gt=version)
+    return {
+        "version": current,
+        "full": full,
+        "emoji": list(queryset.order_by("version").values("id", "name", "url", "available", "deleted")),
+    }
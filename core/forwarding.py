@@ -0,0 +1,139 @@
+import threading
+import time
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from koru import metrics
+from koru.utils import BatchWorker, bump_stamp, get_stamps
+from koru.gateway import events as gateway
+from . import activity, search
+from .models import ChannelForwarder, Message
+
+BATCH_SIZE = 200
+
+# source channel id -> every channel a message sent there ends up in, following chains of forwarders.
+# Built lazily from the whole forwarder table, and rebuilt whenever the stamp in the shared cache says a forwarder
+# changed anywhere.
+_targets = None
+_targets_stamp = None
+_lock = threading.Lock()
+
+_STAMP_KEY = "koru:forwarders"
+
+
+def _load_graph() -> dict:
+    graph = {}
+    for source_id, destination_id in ChannelForwarder.objects.values_list("source_channel_id", "destination_channel_id"):
+        graph.setdefault(source_id, set()).add(destination_id)
+    return graph
+
+
+def _reachable(graph, source_id) -> set:
+    # Walks the graph once per source; the seen set is what keeps a cycle from looping forever
+    seen = {source_id}
+    stack = [source_id]
+    while stack:
+        for destination_id in graph.get(stack.pop(), ()):
+            if destination_id not in seen:
+                seen.add(destination_id)
+                stack.append(destination_id)
+    seen.discard(source_id)
+    return seen
+
+
+def forward_targets(channel_id) -> set:
+    """Every channel a message sent in channel_id gets copied to."""
+    global _targets, _targets_stamp
+    stamp, = get_stamps(_STAMP_KEY)
+    with _lock:
+        targets = _targets if _targets_stamp == stamp else None
+    if targets is None:
+        graph = _load_graph()
+        targets = {source_id: _reachable(graph, source_id) for source_id in graph}
+        with _lock:
+            _targets, _targets_stamp = targets, stamp
+    return targets.get(getattr(channel_id, "pk", channel_id), set())
+
+
+def invalidate():
+    """Forget the forwarding graph here straight away, and in every other process once the change commits."""
+    global _targets
+    with _lock:
+        _targets = None
+    bump_stamp(_STAMP_KEY)
+
+
+def add_forwarder(source, destination) -> ChannelForwarder:
+    """Link two channels, refusing links that would forward a channel's messages back into itself."""
+    source_id, destination_id = getattr(source, "pk", source), getattr(destination, "pk", destination)
+    if source_id == destination_id or source_id in _reachable(_load_graph(), destination_id):
+        raise ValidationError("That forwarder would create a loop.")
+    forwarder, _ = ChannelForwarder.objects.get_or_create(source_channel_id=source_id, destination_channel_id=destination_id)
+    return forwarder
+
+
+def deliver_forwards(message_ids) -> int:
+    """
+    Copy messages into every channel they forward to, with one bulk_create for the whole batch.
+    Copies point back at the original through forwarded_from, and a channel never gets the same original
+    twice, so redelivering a message is harmless. Returns how many copies were written; only those are announced.
+    """
+    originals = list(Message.objects.filter(pk__in=message_ids, deleted=False, forwarded_from__isnull=True))
+    wanted = {(o.pk, channel_id) for o in originals for channel_id in forward_targets(o.channel_id)}
+    if not wanted:
+        return 0
+    existing = set(
+        Message.objects.filter(forwarded_from__in=[o.pk for o in originals])
+        .values_list("forwarded_from_id", "channel_id")
+    )
+    copies = [
+        Message(channel_id=channel_id, author_id=o.author_id, content=o.content, forwarded_from=o)
+        for o in originals
+        for channel_id in sorted(forward_targets(o.channel_id))
+        if (o.pk, channel_id) not in existing
+    ]
+    if not copies:
+        return 0
+    with transaction.atomic():
+        # ignore_conflicts covers a copy another worker wrote since the check above. Those are skipped without
+        # a trace, so look up which of our ids actually went in; only those get announced.
+        Message.objects.bulk_create(copies, batch_size=BATCH_SIZE, ignore_conflicts=True)
+        inserted = set()
+        for i in range(0, len(copies), BATCH_SIZE):
+            inserted.update(Message.objects.filter(pk__in=[copy.pk for copy in copies[i:i + BATCH_SIZE]]).values_list("pk", flat=True))
+    copies = [copy for copy in copies if copy.pk in inserted]
+
+    # bulk_create doesn't send post_save, so do what the signal handlers would have
+    search.index_messages([copy.pk for copy in copies])
+    for copy in copies:
+        activity.record_last_message(copy.channel_id, copy.pk)
+        gateway.message_created(copy)
+    return len(copies)
+
+
+def _deliver_batch(batch) -> int:
+    start = time.monotonic()
+    copies = deliver_forwards([message_id for message_id, _ in batch])
+    done = time.monotonic()
+    for _, enqueued_at in batch:
+        metrics.observe("forwarding.lag", done - enqueued_at)
+    metrics.observe("forwarding.batch_duration", done - start)
+    metrics.incr("forwarding.messages", len(batch))
+    metrics.incr("forwarding.copies", copies)
+    metrics.gauge("forwarding.backlog", _worker.queue.qsize())
+    return copies
+
+
+# Senders never wait on forwards, they're delivered in the background
+_worker = BatchWorker("forwarding-worker", _deliver_batch, BATCH_SIZE)
+
+
+def _enqueue_if_forwarded(message_id, channel_id):
+    if forward_targets(channel_id):
+        _worker.enqueue(message_id)
+
+
+def on_message_created(message):
+    # Copies are never forwarded again, the original's targets already cover the whole chain
+    if message.forwarded_from_id is None:
+        message_id, channel_id = message.pk, message.channel_id
+        transaction.on_commit(lambda: _enqueue_if_forwarded(message_id, channel_id))
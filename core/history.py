@@ -0,0 +1,82 @@
+from django.core.exceptions import ValidationError
+from django.db.models import Prefetch, prefetch_related_objects
+from koru.db import replica_reads
+from koru.utils import format_snowflake, normalize_cursor
+from . import archive
+from .models import Attachment, Channel, Message
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+def _base_queryset(channel: Channel):
+    return (
+        Message.objects.filter(channel=channel, deleted=False)
+        .select_related("author", "reply_to", "reply_to__author")
+        .prefetch_related("mentions")
+    )
+
+
+def _attach_files(messages):
+    # One query for the whole page, however it was put together. Archived messages come with theirs
+    # already (on archived_files), so only hot ones are looked up.
+    prefetch_related_objects(
+        [m for m in messages if not getattr(m, "archived", False)],
+        Prefetch("files", queryset=Attachment.objects.order_by("id")),
+    )
+    return messages
+
+
+@replica_reads()
+def get_history(channel: Channel, before=None, after=None, around=None, limit: int = DEFAULT_PAGE_SIZE) -> list[Message]:
+    """
+    Return one page of a channel's history, newest first, using the snowflake as a keyset cursor.
+
+    Only one of before/after/around may be given. With none of them you get the latest page.
+    A page costs a fixed number of queries no matter how deep it is: messages and their mentions
+    (twice over for around), plus one for attachments.
+
+    Pages that reach below channel.archived_through are filled in from the archive (see core.archive).
+    Those messages come back with archived=True, their mentions on archived_mentions and their uploads on
+    archived_files.
+    """
+    if sum(c is not None for c in (before, after, around)) > 1:
+        raise ValidationError("Only one of before, after or around can be used at a time")
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    before, after, around = normalize_cursor(before), normalize_cursor(after), normalize_cursor(around)
+    qs = _base_queryset(channel)
+
+    if around is not None:
+        # Half the page at or before the cursor, the other half after it
+        older = _older(qs, channel, format_snowflake(int(around) + 1), limit - limit // 2)
+        newer = _newer(qs, channel, around, limit // 2)
+        messages = newer + older
+    elif after is not None:
+        messages = _newer(qs, channel, after, limit)
+    else:
+        messages = _older(qs, channel, before, limit)
+
+    return _attach_files(messages)
+
+
+def _older(qs, channel: Channel, before, limit: int) -> list[Message]:
+    """Up to limit messages before the cursor (or the latest ones), newest first."""
+    if before is not None:
+        qs = qs.filter(id__lt=before)
+    messages = list(qs.order_by("-id")[:limit])
+    # A short page means the hot table has run out, so carry on into the archive
+    if len(messages) < limit and channel.archived_through:
+        older = archive.read_archived(channel, before=before, limit=limit)
+        messages = sorted(messages + older, key=lambda m: m.pk, reverse=True)[:limit]
+    return messages
+
+
+def _newer(qs, channel: Channel, after, limit: int) -> list[Message]:
+    """Up to limit messages right after the cursor, newest first."""
+    # Fetch oldest-first from the cursor so we get the messages right after it, then flip
+    messages = list(qs.filter(id__gt=after).order_by("id")[:limit])
+    if channel.archived_through and after < channel.archived_through:
+        newer = archive.read_archived(channel, after=after, limit=limit, newest_first=False)
+        messages = sorted(messages + newer, key=lambda m: m.pk)[:limit]
+    return messages[::-1]
@@ -0,0 +1,129 @@
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from . import counters, permissions
+from .bans import check_not_banned
+from .models import Invite, Space, UserRoleAssignment
+
+# Resolved codes are cached briefly. Edits clear them straight away, the TTL only bounds what we can't see
+# (like a vanity URL that was just renamed away).
+RESOLVE_TTL = 60
+
+
+def _invite_key(code):
+    return f"koru:invite:{code}"
+
+
+def _vanity_key(slug):
+    return f"koru:vanity:{slug.lower()}"
+
+
+def resolve_invite(code: str) -> dict | None:
+    """Everything needed to redeem an invite code, from cache when possible. None if the code doesn't exist."""
+    key = _invite_key(code)
+    info = cache.get(key)
+    if info is None:
+        invite = Invite.objects.filter(code=code, deleted=False).values(
+            "pk", "space_id", "channel_id", "expires_at", "permanent", "max_uses"
+        ).first()
+        if invite is None:
+            # Cache misses too, so hammering a dead link doesn't hammer the database
+            info = {}
+        else:
+            info = {**invite, "role_ids": list(Invite.roles_granted.through.objects.filter(invite_id=invite["pk"]).values_list("spacerole_id", flat=True))}
+        cache.set(key, info, RESOLVE_TTL)
+    return info or None
+
+
+def resolve_vanity(slug: str) -> str | None:
+    """Space id for a vanity URL, from cache when possible."""
+    key = _vanity_key(slug)
+    space_id = cache.get(key)
+    if space_id is None:
+        space_id = Space.objects.filter(vanity_url__iexact=slug, deleted=False).values_list("pk", flat=True).first() or ""
+        cache.set(key, space_id, RESOLVE_TTL)
+    return space_id or None
+
+
+def forget_invite(code):
+    cache.delete(_invite_key(code))
+
+
+def forget_vanity(slug):
+    if slug:
+        cache.delete(_vanity_key(slug))
+
+
+def _is_member(user_id, space_id) -> bool:
+    return Space.members.through.objects.filter(space_id=space_id, user_id=user_id).exists()
+
+
+def _join(user_id, space_id, role_ids=()) -> bool:
+    """
+    Adds the membership and its roles. Returns False, changing nothing, if the user turned out to be a member
+    already (say, a second redemption racing this one). Must run inside a transaction.
+    """
+    # get_or_create settles the race on the unique (space, user) constraint. Neither INSERT sends the usual
+    # signals, so the counter and permission cache are told directly.
+    _, created = Space.members.through.objects.get_or_create(space_id=space_id, user_id=user_id)
+    if not created:
+        return False
+    if role_ids:
+        UserRoleAssignment.objects.bulk_create(
+            [UserRoleAssignment(user_id=user_id, space_id=space_id, role_id=role_id) for role_id in role_ids],
+            ignore_conflicts=True,
+        )
+    permissions.invalidate_member(user_id, space_id)
+    counters.on_members_changed(space_id, 1)
+    return True
+
+
+def redeem_invite(user, code: str) -> str:
+    """
+    Join the invite's space, granting its roles. Returns the space id.
+
+    The use is counted with a conditional UPDATE, so max_uses holds no matter how many people redeem the
+    same code at once: whoever's UPDATE matches no row didn't get in. It's only counted once the membership
+    row actually went in, so the same user redeeming twice at once only uses it up once.
+    """
+    user_id = getattr(user, "pk", user)
+    info = resolve_invite(code)
+    now = timezone.now()
+    if info is None or (not info["permanent"] and info["expires_at"] is not None and info["expires_at"] <= now):
+        raise ValidationError("This invite is invalid or has expired")
+
+    space_id = info["space_id"]
+    check_not_banned(user_id, space_id)
+    if _is_member(user_id, space_id):
+        # Already in, don't burn a use
+        return space_id
+
+    with transaction.atomic():
+        if not _join(user_id, space_id, info["role_ids"]):
+            return space_id
+        claimed = (
+            Invite.objects.filter(pk=info["pk"], deleted=False)
+            .filter(Q(max_uses__isnull=True) | Q(uses__lt=F("max_uses")))
+            .filter(Q(permanent=True) | Q(expires_at__isnull=True) | Q(expires_at__gt=now))
+            .update(uses=F("uses") + 1)
+        )
+        if not claimed:
+            forget_invite(code)
+            # Rolls the membership back out, along with its on-commit side effects
+            raise ValidationError("This invite is invalid or has expired")
+    return space_id
+
+
+def join_by_vanity(user, slug: str) -> str:
+    """Join a space through its vanity URL. Returns the space id."""
+    user_id = getattr(user, "pk", user)
+    space_id = resolve_vanity(slug)
+    if space_id is None:
+        raise ValidationError("This invite is invalid or has expired")
+    check_not_banned(user_id, space_id)
+    if not _is_member(user_id, space_id):
+        with transaction.atomic():
+            _join(user_id, space_id)
+    return space_id
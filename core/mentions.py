@@ -0,0 +1,96 @@
+import time
+from django.db import transaction
+from koru import metrics
+from koru.utils import BatchWorker
+from . import permissions, readstate
+from .models import Message, Space, SpaceRole, UserRoleAssignment
+
+CHUNK_SIZE = 1000
+
+
+def allowed_mentions(author, channel, role_ids=(), everyone=False) -> tuple[list, bool]:
+    """
+    Which of the requested role and @everyone mentions the author may make in a channel, as
+    (role ids, everyone). Without mention_everyone only roles marked mentionable_by_everyone get through.
+    """
+    if permissions.is_private_channel(channel) or not (role_ids or everyone):
+        return [], False
+    can_mention_all = permissions.has_channel_permission(author, channel, "mention_everyone")
+    allowed_roles = []
+    if role_ids:
+        roles = SpaceRole.objects.filter(space_id=channel.space_id, pk__in=role_ids)
+        if not can_mention_all:
+            roles = roles.filter(mentionable_by_everyone=True)
+        allowed_roles = sorted(roles.values_list("pk", flat=True))
+    return allowed_roles, bool(everyone and can_mention_all)
+
+
+def set_group_mentions(message: Message, role_ids=(), everyone=False):
+    """
+    Put the role and @everyone mentions the author is allowed onto an unsaved message. They're stored as
+    references on the message; who they reach is worked out in the background once it's sent, so a mention
+    costs the sender the same in a space of ten as in a space of a hundred thousand.
+    """
+    message.mention_roles, message.mention_everyone = allowed_mentions(
+        message.author_id, message.channel, role_ids, everyone
+    )
+
+
+def _recipient_ids(message: Message, space_id):
+    members = Space.members.through.objects.filter(space_id=space_id)
+    if message.mention_everyone:
+        recipients = members.values_list("user_id", flat=True)
+    else:
+        recipients = UserRoleAssignment.objects.filter(
+            role_id__in=message.mention_roles, user_id__in=members.values("user_id")
+        ).values_list("user_id", flat=True).distinct()
+    return recipients.exclude(user_id=message.author_id).order_by("user_id")
+
+
+def expand_mentions(message_id) -> int:
+    """
+    Turn a message's role and @everyone references into mention rows plus read-state bumps, CHUNK_SIZE
+    recipients at a time. Users already mentioned are skipped, so running it twice is harmless.
+    Returns how many users were newly mentioned.
+    """
+    message = Message.objects.filter(pk=message_id, deleted=False).select_related("channel").first()
+    if message is None or not (message.mention_roles or message.mention_everyone):
+        return 0
+    recipients = _recipient_ids(message, message.channel.space_id)
+    through = Message.mentions.through
+    expanded = 0
+    last_id = ""
+    while True:
+        chunk = list(recipients.filter(user_id__gt=last_id)[:CHUNK_SIZE])
+        if not chunk:
+            break
+        last_id = chunk[-1]
+        already = set(through.objects.filter(message_id=message.pk, user_id__in=chunk).values_list("user_id", flat=True))
+        new = [user_id for user_id in chunk if user_id not in already]
+        if new:
+            # bulk_create skips m2m_changed, so the read states are bumped here rather than by the signal
+            with transaction.atomic():
+                through.objects.bulk_create([through(message_id=message.pk, user_id=u) for u in new], ignore_conflicts=True)
+                readstate.record_mentions(message.channel_id, new)
+            expanded += len(new)
+    return expanded
+
+
+def _expand_batch(batch) -> int:
+    expanded = 0
+    for message_id, enqueued_at in batch:
+        start = time.monotonic()
+        expanded += expand_mentions(message_id)
+        metrics.observe("mentions.expand_duration", time.monotonic() - start)
+        metrics.observe("mentions.lag", time.monotonic() - enqueued_at)
+    metrics.incr("mentions.expanded", expanded)
+    return expanded
+
+
+_worker = BatchWorker("mention-expander", _expand_batch, batch_size=10)
+
+
+def on_message_created(message):
+    if message.mention_roles or message.mention_everyone:
+        message_id = message.pk
+        transaction.on_commit(lambda: _worker.enqueue(message_id))
@@ -1,10 +1,10 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from koru.utils import ResourceModel, snowflaker
 from users.models import User
 from django.core.exceptions import ValidationError
-from django.db import transaction
-from django.db.models import F, Max
 from django.core.validators import MinValueValidator
+from .ordering import PositionedMixin
 
 FEATURE_OPTS = [
     "staff_only",
@@ -32,7 +32,7 @@ class Space(ResourceModel):
     icon = models.URLField(blank=True, null=True)
     owner = models.ForeignKey("users.User", on_delete=models.CASCADE)
 
-    members = models.ManyToManyField("users.User", related_name="spaces")
+    members = models.ManyToManyField("users.User", related_name="spaces", through="SpaceMember")
     member_count = models.IntegerField(default=0)
     features = models.JSONField(default=dict)
     # Prolific servers and official servers for popular things (except for the Koru instance) can be verified, which grants them:
@@ -46,6 +46,8 @@ class Space(ResourceModel):
     vanity_url = models.CharField(max_length=64, blank=True, null=True, unique=True)
     space_registry_listed = models.BooleanField(default=False)
     space_reg_entry = models.OneToOneField("SpaceRegEntry", on_delete=models.SET_NULL, null=True, blank=True, related_name="space")
+    # Set alongside `deleted`, the space gets purged 30 days after this
+    deleted_at = models.DateTimeField(blank=True, null=True)
 
 class SpaceRegEntry(ResourceModel):
     space = models.OneToOneField(Space, on_delete=models.CASCADE, related_name="registry_entry")
@@ -55,7 +57,23 @@ class SpaceRegEntry(ResourceModel):
 class SpaceSettingsIndex(ResourceModel):
     space = models.OneToOneField(Space, on_delete=models.CASCADE, related_name="settings")
 
-class SpaceRole(ResourceModel):
+class SpaceMember(models.Model):
+    # Through table for Space.members. Same table the plain M2M used, plus when each member joined
+    space = models.ForeignKey(Space, on_delete=models.CASCADE)
+    user = models.ForeignKey("users.User", on_delete=models.CASCADE)
+    joined_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = "core_space_members"
+        constraints = [
+            models.UniqueConstraint(fields=["space", "user"], name="unique_space_member"),
+        ]
+        indexes = [
+            # Raid cleanup picks members by join time, see core.bans
+            models.Index(fields=["space", "joined_at"], name="space_member_joined_idx"),
+        ]
+
+class SpaceRole(PositionedMixin, ResourceModel):
     space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="roles")
     name = models.CharField(max_length=64)
     hex = models.CharField(max_length=6, default="000000")
@@ -65,7 +83,7 @@ class SpaceRole(ResourceModel):
     default_role = models.BooleanField(default=False)
     permissions = models.JSONField(default=dict)
 
-    # 1 == lowest, N == highest; higher number == higher in hierarchy
+    # Higher number == higher in hierarchy. Positions are sparse, see core.ordering
     position = models.IntegerField(validators=[MinValueValidator(1)], db_index=True)
 
     class Meta:
@@ -83,62 +101,7 @@ class SpaceRole(ResourceModel):
         # Normalize space existence
         if self.space_id is None:
             raise ValidationError("Space must be set for a role")
-
-        # Count existing roles in the space (excluding self when updating)
-        existing_qs = SpaceRole.objects.filter(space=self.space)
-        if self.pk:
-            existing_qs = existing_qs.exclude(pk=self.pk)
-        count = existing_qs.count()
-
-        # If creating and no position provided, append to end
-        if not self.pk and (self.position is None):
-            self.position = count + 1
-            super().save(*args, **kwargs)
-            return
-
-        # For creation allowed positions: 1..count+1
-        # For update allowed positions: 1..count+1 (count excludes self, so max is current total)
-        max_allowed = count + 1
-        if self.position is None or not (1 <= self.position <= max_allowed):
-            raise ValidationError(f"Position must be between 1 and {max_allowed}")
-
-        with transaction.atomic():
-            if not self.pk:
-                # Inserting: shift existing roles at or after position up by 1
-                SpaceRole.objects.filter(space=self.space, position__gte=self.position).update(position=F("position") + 1)
-                super().save(*args, **kwargs)
-            else:
-                # Updating: move existing role from old_pos to new_pos and shift others
-                old = SpaceRole.objects.select_for_update().get(pk=self.pk).position
-                new = self.position
-                if new == old:
-                    super().save(*args, **kwargs)
-                    return
-
-                if new < old:
-                    # shift roles in [new, old-1] up by 1
-                    SpaceRole.objects.filter(
-                        space=self.space,
-                        position__gte=new,
-                        position__lt=old
-                    ).exclude(pk=self.pk).update(position=F("position") + 1)
-                else:
-                    # new > old: shift roles in [old+1, new] down by 1
-                    SpaceRole.objects.filter(
-                        space=self.space,
-                        position__gt=old,
-                        position__lte=new
-                    ).exclude(pk=self.pk).update(position=F("position") - 1)
-
-                super().save(*args, **kwargs)
-
-    def delete(self, *args, **kwargs):
-        # On delete, close the gap by decrementing positions greater than this one
-        with transaction.atomic():
-            pos = self.position
-            space = self.space
-            super().delete(*args, **kwargs)
-            SpaceRole.objects.filter(space=space, position__gt=pos).update(position=F("position") - 1)
+        super().save(*args, **kwargs)
 
     def is_higher_than(self, other: "SpaceRole") -> bool:
         if other is None:
@@ -150,24 +113,8 @@ class SpaceRole(ResourceModel):
             return False
         return (self.position or 0) < (other.position or 0)
 
-    def move_up(self):
-        if self.position and self.position > 1:
-            self.position -= 1
-            self.save()
-
-    def move_down(self):
-        # max position is current count of roles in the space
-        max_pos = SpaceRole.objects.filter(space=self.space).aggregate(max_pos=Max("position")).get("max_pos") or 0
-        if self.position and self.position < max_pos:
-            self.position += 1
-            self.save()
-
-    def move_to(self, new_position: int):
-        self.position = new_position
-        self.save()
 
-
-class Channel(ResourceModel):
+class Channel(PositionedMixin, ResourceModel):
     space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="channels")
     name = models.CharField(max_length=64)
     position = models.IntegerField(validators=[MinValueValidator(1)], db_index=True)
@@ -177,6 +124,8 @@ class Channel(ResourceModel):
     rdm = models.BooleanField(default=False)
     sysdm = models.BooleanField(default=False)
     last_message = models.ForeignKey("Message", on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    # Newest message moved out to an archive segment, see core.archive. History only looks there below this.
+    archived_through = models.CharField(max_length=64, blank=True, null=True)
 
     class Meta:
         constraints = [
@@ -184,7 +133,7 @@ class Channel(ResourceModel):
         ]
         ordering = ["position", "name"]
 
-class Category(ResourceModel):
+class Category(PositionedMixin, ResourceModel):
     space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="categories")
     name = models.CharField(max_length=64)
     position = models.IntegerField(validators=[MinValueValidator(1)], db_index=True)
@@ -199,6 +148,12 @@ class ChannelForwarder(ResourceModel):
     source_channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name="forwarders")
     destination_channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name="incoming_forwarders")
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["source_channel", "destination_channel"], name="unique_forwarder"),
+            models.CheckConstraint(condition=~models.Q(source_channel=models.F("destination_channel")), name="prevent_self_forward"),
+        ]
+
 class GroupDM(ResourceModel):
     name = models.CharField(max_length=120)
     icon = models.URLField(blank=True, null=True)
@@ -218,7 +173,30 @@ class Message(ResourceModel):
     attachments = models.JSONField(default=list, blank=True)
     reply_to = models.ForeignKey("self", on_delete=models.SET_NULL, null=True, blank=True, related_name="replies")
     mentions = models.ManyToManyField("users.User", related_name="mentioned_in")
+    # @role and @everyone mentions are kept as references and expanded into `mentions` in the background, see core.mentions
+    mention_roles = models.JSONField(default=list, blank=True)
+    mention_everyone = models.BooleanField(default=False)
     pinned_to_channel = models.BooleanField(default=False)
+    # Set on copies made by a ChannelForwarder, see core.forwarding
+    forwarded_from = models.ForeignKey("self", on_delete=models.SET_NULL, null=True, blank=True, related_name="forwards")
+    # Set alongside `deleted`, the message gets purged 30 days after this (or right away for permadelete users)
+    deleted_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination over a channel's history, see core.history
+            models.Index(fields=["channel", "id"], name="message_channel_id_idx"),
+            # Finding soft-deleted messages to purge, see core.purge
+            models.Index(fields=["deleted", "deleted_at"], name="message_deleted_idx"),
+        ]
+        constraints = [
+            # A channel gets at most one copy of any forwarded message
+            models.UniqueConstraint(
+                fields=["channel", "forwarded_from"],
+                condition=models.Q(forwarded_from__isnull=False),
+                name="unique_forward_per_channel",
+            ),
+        ]
 
 class MessageReadState(ResourceModel):
     channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name="read_states")
@@ -226,6 +204,12 @@ class MessageReadState(ResourceModel):
     last_read_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True)
     mention_count = models.IntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            # One row per user per channel, see core.readstate. Doubles as the (user, channel) lookup index.
+            models.UniqueConstraint(fields=["user", "channel"], name="unique_read_state"),
+        ]
+
 class Friendship(ResourceModel):
     user1 = models.ForeignKey("users.User", on_delete=models.CASCADE, related_name="friendships_as_user1")
     user2 = models.ForeignKey("users.User", on_delete=models.CASCADE, related_name="friendships_as_user2")
@@ -269,6 +253,12 @@ class Invite(ResourceModel):
     uses = models.IntegerField(default=0)
     roles_granted = models.ManyToManyField(SpaceRole, related_name="invites_granting_role")
 
+    class Meta:
+        indexes = [
+            # Used by the expiry sweeper
+            models.Index(fields=["deleted", "expires_at"], name="invite_expiry_idx"),
+        ]
+
 class SpaceBan(ResourceModel):
     space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="bans")
     user = models.ForeignKey("users.User", on_delete=models.CASCADE, related_name="space_bans")
@@ -277,6 +267,14 @@ class SpaceBan(ResourceModel):
     expires_at = models.DateTimeField(blank=True, null=True)
     active = models.BooleanField(default=True)
 
+    class Meta:
+        indexes = [
+            # Used by the expiry sweeper
+            models.Index(fields=["active", "expires_at"], name="ban_active_expiry_idx"),
+            # Ban checks on join and send, see core.bans
+            models.Index(fields=["space", "user", "active"], name="ban_lookup_idx"),
+        ]
+
 class UserNote(ResourceModel):
     user = models.ForeignKey("users.User", on_delete=models.CASCADE, related_name="notes")
     content = models.TextField(blank=True)
@@ -288,17 +286,90 @@ class CustomEmoji(ResourceModel):
     url = models.URLField()
     creator = models.ForeignKey("users.User", on_delete=models.SET_NULL, null=True, related_name="created_emojis")
     available = models.BooleanField(default=True)
+    # Stamped from the space's EmojiVersion on every change, see core.emoji
+    version = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["space", "name"], condition=models.Q(deleted=False), name="unique_emoji_name_per_space"),
+        ]
+        indexes = [
+            models.Index(fields=["space", "version"], name="emoji_space_version_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        from .emoji import next_version
+        with transaction.atomic():
+            self.version = next_version(self.space_id)
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "version"}
+            super().save(*args, **kwargs)
+
+class EmojiVersion(models.Model):
+    # Counter a space's emoji changes are stamped with, so clients can ask for what changed since a version
+    space = models.OneToOneField(Space, on_delete=models.CASCADE, primary_key=True, related_name="emoji_version")
+    version = models.BigIntegerField(default=0)
+    # Bumped by hard deletes, which leave no tombstone behind. Clients older than this need everything again.
+    resync_version = models.BigIntegerField(default=0)
 
 class AuditLogEntry(ResourceModel):
     space = models.ForeignKey(Space, on_delete=models.CASCADE, related_name="audit_logs")
     action = models.CharField(max_length=64)
     performed_by = models.ForeignKey("users.User", on_delete=models.SET_NULL, null=True, related_name="performed_audit_logs")
     details = models.JSONField(default=dict)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Cursor-paged reads, see core.audit
+            models.Index(fields=["space", "id"], name="auditlog_space_id_idx"),
+            models.Index(fields=["space", "action", "id"], name="auditlog_space_action_id_idx"),
+            # No timestamp index: retention pruning and time range queries go by id range (see koru.utils)
+        ]
 
 class Attachment(ResourceModel):
-    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="attachments")
+    # Null until the message it was uploaded for gets sent, see core.uploads
+    # Message.attachments is the legacy JSON list, so uploads are message.files
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="files", null=True, blank=True)
+    uploader = models.ForeignKey("users.User", on_delete=models.SET_NULL, null=True, related_name="uploads")
     url = models.URLField()
+    # Where the file lives in storage
+    path = models.CharField(max_length=512, blank=True)
     filename = models.CharField(max_length=255)
     content_type = models.CharField(max_length=100)
-    size = models.IntegerField()
\ No newline at end of file
+    size = models.IntegerField()
+    sha256 = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        constraints = [
+            # One row per stored file, so confirming the same direct upload twice can't record it twice
+            models.UniqueConstraint(fields=["path"], condition=~models.Q(path=""), name="unique_attachment_path"),
+        ]
+
+class ArchiveSegment(models.Model):
+    # One compressed file of a channel's archived messages from one month, see core.archive
+    channel = models.ForeignKey(Channel, on_delete=models.CASCADE, related_name="archive_segments")
+    month = models.CharField(max_length=7)
+    path = models.CharField(max_length=512)
+    first_id = models.CharField(max_length=64)
+    last_id = models.CharField(max_length=64)
+    message_count = models.IntegerField()
+    size = models.BigIntegerField()
+    # Sparse index: [first id, last id, byte offset, byte length] for each compressed block in the file
+    index = models.JSONField(default=list)
+    # Whose messages are in it, so purging a user only rewrites the segments they actually wrote in
+    authors = models.ManyToManyField("users.User", related_name="+")
+    # Storage paths of the uploads of the messages in it, which go when the segment does
+    upload_paths = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["channel", "first_id"], name="archive_channel_first_idx"),
+        ]
+
+class PurgeCheckpoint(models.Model):
+    # Where an interrupted purge pass picks back up, see core.purge
+    name = models.CharField(max_length=64, primary_key=True)
+    last_id = models.CharField(max_length=64, blank=True, default="")
+    updated_at = models.DateTimeField(auto_now=True)
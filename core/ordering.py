@@ -0,0 +1,119 @@
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, F, Max, Value, When
+from django.dispatch import Signal
+
+# Positions are sparse: new rows go POSITION_STEP after the last one and single moves land halfway between
+# their new neighbours, so moving one row never rewrites the rows around it. When two neighbours end up
+# with no room between them the whole space gets renumbered with reorder().
+POSITION_STEP = 1024
+
+# Sent with sender=<model class> and space_id=... whenever positions change through a bulk UPDATE,
+# since those don't fire post_save.
+positions_changed = Signal()
+
+
+class PositionedMixin:
+    """
+    Sparse ordering for models with a `space` FK and a per-space unique `position` (roles, channels, categories).
+    Lower position comes first when sorted ascending; for roles that means lower in the hierarchy.
+    """
+
+    @classmethod
+    def _siblings_of(cls, space_id):
+        return cls.objects.filter(space_id=space_id)
+
+    @classmethod
+    def _descending(cls):
+        ordering = cls._meta.ordering
+        return bool(ordering) and ordering[0] == "-position"
+
+    def _siblings(self):
+        return self._siblings_of(self.space_id).exclude(pk=self.pk)
+
+    def save(self, *args, **kwargs):
+        if self.position is None:
+            last = self._siblings_of(self.space_id).aggregate(last=Max("position"))["last"] or 0
+            self.position = last + POSITION_STEP
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def reorder(cls, space, ordered_ids):
+        """
+        Apply a complete new ordering for a space in one transaction.
+
+        ordered_ids must contain every row of this model in the space exactly once, in the order the model
+        lists them (Meta.ordering): top of the hierarchy first for roles, top of the list first for channels
+        and categories. Costs the same handful of statements no matter how many rows there are.
+        """
+        space_id = getattr(space, "pk", space)
+        ordered_ids = list(ordered_ids)
+        if cls._descending():
+            ordered_ids.reverse()
+
+        with transaction.atomic():
+            current = set(cls._siblings_of(space_id).select_for_update().values_list("pk", flat=True))
+            if len(ordered_ids) != len(current) or set(ordered_ids) != current:
+                raise ValidationError("ordered_ids must list every item in the space exactly once")
+            if not ordered_ids:
+                return
+
+            # Park everything on negative positions first so the unique constraint can't trip mid-update
+            cls._siblings_of(space_id).update(position=F("position") * -1)
+            cls._siblings_of(space_id).update(position=Case(
+                *[When(pk=pk, then=Value((i + 1) * POSITION_STEP)) for i, pk in enumerate(ordered_ids)]
+            ))
+        positions_changed.send(sender=cls, space_id=space_id)
+
+    @classmethod
+    def renumber(cls, space):
+        """Re-spread a space's positions evenly, keeping the current order."""
+        space_id = getattr(space, "pk", space)
+        ordered = list(cls._siblings_of(space_id).order_by("position").values_list("pk", flat=True))
+        if cls._descending():
+            ordered.reverse()
+        cls.reorder(space_id, ordered)
+
+    def _move_between(self, lower, upper):
+        """Move to a position strictly between lower and upper (either can be None for the ends)."""
+        lower = lower or 0
+        upper = upper if upper is not None else lower + 2 * POSITION_STEP
+        if upper - lower < 2:
+            self.renumber(self.space_id)
+            return False
+        self.position = (lower + upper) // 2
+        self.save(update_fields=["position"])
+        return True
+
+    def move_up(self):
+        # Swap places with the row right below this one
+        below = list(self._siblings().filter(position__lt=self.position).order_by("-position").values_list("position", flat=True)[:2])
+        if not below:
+            return
+        if not self._move_between(below[1] if len(below) > 1 else None, below[0]):
+            self.refresh_from_db(fields=["position"])
+            self.move_up()
+
+    def move_down(self):
+        # Swap places with the row right above this one
+        above = list(self._siblings().filter(position__gt=self.position).order_by("position").values_list("position", flat=True)[:2])
+        if not above:
+            return
+        if not self._move_between(above[0], above[1] if len(above) > 1 else None):
+            self.refresh_from_db(fields=["position"])
+            self.move_down()
+
+    def move_to(self, new_position: int):
+        """Move to the given 1-based rank, counting up from the lowest position."""
+        if new_position < 1:
+            raise ValidationError("Position must be >= 1")
+        neighbours = list(self._siblings().order_by("position").values_list("position", flat=True)[max(0, new_position - 2):new_position])
+        if new_position == 1:
+            lower, upper = None, (neighbours[0] if neighbours else None)
+        elif not neighbours:
+            raise ValidationError("Position is past the end of the list")
+        else:
+            lower, upper = neighbours[0], (neighbours[1] if len(neighbours) > 1 else None)
+        if not self._move_between(lower, upper):
+            self.refresh_from_db(fields=["position"])
+            self.move_to(new_position)
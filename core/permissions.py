@@ -0,0 +1,261 @@
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import Q
+from koru.utils import bump_stamp, get_stamps
+from .models import Space, SpaceRole, Channel
+
+# Order matters! Each permission's bit is its index in this list, so only ever append to it.
+PERMISSIONS = [
+    # Grants everything and skips channel overrides.
+    "administrator",
+    "view_channels",
+    "read_history",
+    "send_messages",
+    "attach_files",
+    "add_reactions",
+    "mention_everyone",
+    "manage_messages",
+    "pin_messages",
+    "create_invites",
+    "manage_channels",
+    "manage_roles",
+    "manage_emoji",
+    "manage_space",
+    "view_audit_log",
+    "kick_members",
+    "ban_members",
+]
+
+FLAGS = {name: 1 << i for i, name in enumerate(PERMISSIONS)}
+ALL_PERMISSIONS = (1 << len(PERMISSIONS)) - 1
+
+
+def compile_permissions(data: dict) -> tuple[int, int]:
+    """
+    Turn a permissions dict like {"send_messages": True, "attach_files": False} into (allow, deny) bitsets.
+    Unknown keys are ignored so old roles don't break when permissions get renamed.
+    """
+    allow = deny = 0
+    for name, value in (data or {}).items():
+        bit = FLAGS.get(name)
+        if bit is None:
+            continue
+        if value:
+            allow |= bit
+        else:
+            deny |= bit
+    return allow, deny
+
+
+class CompiledRole:
+    """
+    A SpaceRole's permissions JSON compiled down to bitsets.
+
+    Channel overrides live under the "channels" key of SpaceRole.permissions:
+    {"send_messages": True, "channels": {"<channel id>": {"send_messages": False}}}
+    """
+    __slots__ = ("id", "position", "default_role", "allow", "deny", "channels")
+
+    def __init__(self, id, position, default_role, permissions):
+        self.id = id
+        self.position = position or 0
+        self.default_role = default_role
+        self.allow, self.deny = compile_permissions({k: v for k, v in (permissions or {}).items() if k != "channels"})
+        self.channels = {
+            channel_id: compile_permissions(overrides)
+            for channel_id, overrides in ((permissions or {}).get("channels") or {}).items()
+        }
+
+
+# Cached permissions are only good while their stamps match the ones in the shared cache. Changing a space's roles
+# gives it a new stamp, changing a member's roles or membership gives that member one, and every process checks
+# the stamps (one cache round trip) before trusting what it has locally.
+
+
+def _space_key(space_id):
+    return f"koru:perms:{space_id}"
+
+
+def _member_key(user_id, space_id):
+    return f"koru:perms:{space_id}:{user_id}"
+
+
+class _SpaceCache:
+    """What one process has cached for one space, valid while the space's stamp is `stamp`."""
+    __slots__ = ("stamp", "roles", "members", "masks")
+
+    def __init__(self, stamp):
+        self.stamp = stamp
+        # {role id: CompiledRole}
+        self.roles = None
+        # user id -> (member stamp, is owner, role ids in ascending position)
+        self.members = {}
+        # (user id, channel id or None) -> (member stamp, effective mask)
+        self.masks = {}
+
+
+# space id -> _SpaceCache, least recently used first
+_spaces = OrderedDict()
+_lock = threading.Lock()
+
+
+def _max_spaces():
+    return getattr(settings, "PERMISSION_CACHE_SPACES", 10000)
+
+
+def _max_entries():
+    return getattr(settings, "PERMISSION_CACHE_ENTRIES_PER_SPACE", 10000)
+
+
+def _pk(obj):
+    return getattr(obj, "pk", obj)
+
+
+def _stamps(user_id, space_id) -> tuple[str, str]:
+    """The current (space stamp, member stamp), in one cache round trip."""
+    space_stamp, member_stamp = get_stamps(_space_key(space_id), _member_key(user_id, space_id))
+    return space_stamp, member_stamp
+
+
+def _space_cache(space_id, stamp) -> _SpaceCache:
+    with _lock:
+        cached = _spaces.get(space_id)
+        if cached is None or cached.stamp != stamp:
+            cached = _spaces[space_id] = _SpaceCache(stamp)
+        _spaces.move_to_end(space_id)
+        while len(_spaces) > _max_spaces():
+            _spaces.popitem(last=False)
+    return cached
+
+
+def _remember(entries: dict, key, value):
+    with _lock:
+        if len(entries) >= _max_entries():
+            entries.clear()
+        entries[key] = value
+
+
+def _get_roles(cached: _SpaceCache, space_id):
+    roles = cached.roles
+    if roles is None:
+        roles = cached.roles = {
+            r["id"]: CompiledRole(r["id"], r["position"], r["default_role"], r["permissions"])
+            for r in SpaceRole.objects.filter(space_id=space_id).values("id", "position", "default_role", "permissions")
+        }
+    return roles
+
+
+def _get_member(cached: _SpaceCache, user_id, space_id, member_stamp):
+    """Returns (is owner, member role ids in ascending position) or None if the user isn't in the space."""
+    member = cached.members.get(user_id)
+    if member is not None and member[0] == member_stamp:
+        return member[1:]
+    space = Space.objects.filter(pk=space_id).values("owner_id").first()
+    if space is None:
+        return None
+    is_owner = space["owner_id"] == user_id
+    if not is_owner and not Space.members.through.objects.filter(space_id=space_id, user_id=user_id).exists():
+        return None
+    roles = _get_roles(cached, space_id)
+    assigned = set(
+        SpaceRole.objects.filter(space_id=space_id, assigned_users__user_id=user_id).values_list("id", flat=True)
+    )
+    role_ids = sorted(
+        (r.id for r in roles.values() if r.default_role or r.id in assigned),
+        key=lambda role_id: roles[role_id].position,
+    )
+    _remember(cached.members, user_id, (member_stamp, is_owner, role_ids))
+    return is_owner, role_ids
+
+
+def _compute(cached: _SpaceCache, user_id, space_id, member_stamp, channel_id=None):
+    member = _get_member(cached, user_id, space_id, member_stamp)
+    if member is None:
+        return 0
+    is_owner, role_ids = member
+    if is_owner:
+        return ALL_PERMISSIONS
+    roles = _get_roles(cached, space_id)
+
+    # Walk up the hierarchy so higher roles win any allow/deny conflict
+    mask = 0
+    for role_id in role_ids:
+        role = roles.get(role_id)
+        if role is not None:
+            mask = (mask | role.allow) & ~role.deny
+    if mask & FLAGS["administrator"]:
+        return ALL_PERMISSIONS
+
+    if channel_id is not None:
+        for role_id in role_ids:
+            role = roles.get(role_id)
+            override = role.channels.get(channel_id) if role is not None else None
+            if override is not None:
+                mask = (mask | override[0]) & ~override[1]
+    return mask
+
+
+def _get_mask(user_id, space_id, channel_id=None, stamps=None) -> int:
+    # The stamps are read before anything is computed, so a change that lands mid-computation leaves
+    # the result under the old stamps, where nobody will trust it
+    space_stamp, member_stamp = stamps or _stamps(user_id, space_id)
+    cached = _space_cache(space_id, space_stamp)
+    key = (user_id, channel_id)
+    hit = cached.masks.get(key)
+    if hit is not None and hit[0] == member_stamp:
+        return hit[1]
+    mask = _compute(cached, user_id, space_id, member_stamp, channel_id)
+    _remember(cached.masks, key, (member_stamp, mask))
+    return mask
+
+
+def get_space_permissions(user, space) -> int:
+    return _get_mask(_pk(user), _pk(space))
+
+
+def get_channel_permissions(user, channel: Channel) -> int:
+    return _get_mask(_pk(user), channel.space_id, channel.pk)
+
+
+def has_permission(user, space, permission: str) -> bool:
+    return bool(get_space_permissions(user, space) & FLAGS[permission])
+
+
+def has_channel_permission(user, channel: Channel, permission: str) -> bool:
+    return bool(get_channel_permissions(user, channel) & FLAGS[permission])
+
+
+def is_private_channel(channel: Channel) -> bool:
+    """DMs, group DMs and system DMs. Visibility for these comes from membership, not roles."""
+    return channel.gdm or channel.rdm or channel.sysdm
+
+
+def private_channels(user):
+    """Every DM and group DM channel the user is in."""
+    user_id = _pk(user)
+    return Channel.objects.filter(
+        Q(dm__user1_id=user_id) | Q(dm__user2_id=user_id) | Q(group_dm__members__id=user_id)
+    ).distinct()
+
+
+def visible_channels(user, space) -> list[Channel]:
+    """Channels in a space the user can see and read history in."""
+    needed = FLAGS["view_channels"] | FLAGS["read_history"]
+    user_id, space_id = _pk(user), _pk(space)
+    channels = Channel.objects.filter(space_id=space_id, gdm=False, rdm=False, sysdm=False)
+    stamps = _stamps(user_id, space_id)
+    return [c for c in channels if (_get_mask(user_id, space_id, c.pk, stamps) & needed) == needed]
+
+
+def invalidate_space(space_id):
+    """
+    Drop everything cached for a space, in every process. Used when its roles, role positions or owner change.
+    Inside a transaction this waits for the commit, so nobody can cache the old state again in between.
+    """
+    bump_stamp(_space_key(space_id))
+
+
+def invalidate_member(user_id, space_id):
+    """Drop what's cached for one member of a space, in every process. Used when their roles or membership change."""
+    bump_stamp(_member_key(user_id, space_id))
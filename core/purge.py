@@ -0,0 +1,152 @@
+import logging
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import router, transaction
+from django.utils import timezone
+from koru.gateway import events as gateway
+from users.models import User
+from . import archive, search
+from .deletion import delete_attachments, delete_message_rows
+from .models import Attachment, Message, PurgeCheckpoint, Space
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def purge_after() -> timedelta:
+    return timedelta(days=getattr(settings, "PURGE_AFTER_DAYS", 30))
+
+
+def _announce_deleted(messages):
+    for message_id, channel_id in messages:
+        transaction.on_commit(lambda m=message_id, c=channel_id: gateway.message_deleted(m, c))
+
+
+def purge_message_ids(ids) -> int:
+    """Permanently delete a batch of messages. Returns how many messages were deleted."""
+    ids = list(ids)
+    if not ids:
+        return 0
+    using = router.db_for_write(Message)
+    with transaction.atomic(using=using):
+        # Soft-deleted messages were already announced as deleted when they were soft-deleted
+        announce = list(Message.objects.filter(pk__in=ids, deleted=False).values_list("pk", "channel_id"))
+        purged = delete_message_rows(ids)
+    # Raw deletes don't send post_delete, so the search index has to be told directly. Callers like bulk_ban
+    # purge inside their own transaction, so wait for that to commit rather than drop hits for rows that may come back.
+    transaction.on_commit(lambda: search.remove_messages(ids), using=using)
+    _announce_deleted(announce)
+    return purged
+
+
+def delete_message(message: Message):
+    """
+    Soft-delete a message, or purge it straight away if its author has the permadelete flag. Archived messages
+    have no row left to flag, so they're always taken out of their segment straight away.
+    """
+    if getattr(message, "archived", False):
+        _announce_deleted(archive.remove_archived_ids(message.channel_id, [message.pk]))
+        return
+    if "permadelete" in (message.author.flags or ()):
+        purge_message_ids([message.pk])
+        return
+    message.deleted = True
+    message.deleted_at = timezone.now()
+    message.save(update_fields=["deleted", "deleted_at"])
+
+
+def _purge_in_batches(queryset, checkpoint_name=None, batch_size=DEFAULT_BATCH_SIZE, pause=0, max_batches=None):
+    """
+    Purge every message in queryset, batch_size at a time in snowflake order. If checkpoint_name is given the pass
+    resumes from where the last interrupted one stopped. Returns (messages purged, whether the pass finished).
+    """
+    checkpoint = None
+    last_id = ""
+    if checkpoint_name:
+        checkpoint, _ = PurgeCheckpoint.objects.get_or_create(name=checkpoint_name)
+        last_id = checkpoint.last_id
+
+    purged = batches = 0
+    while True:
+        ids = list(queryset.filter(pk__gt=last_id).order_by("pk").values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            break
+        purged += purge_message_ids(ids)
+        last_id = ids[-1]
+        if checkpoint:
+            checkpoint.last_id = last_id
+            checkpoint.save(update_fields=["last_id", "updated_at"])
+
+        batches += 1
+        if len(ids) < batch_size:
+            break
+        if max_batches and batches >= max_batches:
+            return purged, False
+        if pause:
+            time.sleep(pause)
+
+    if checkpoint:
+        # Messages deleted later can have older snowflakes, so the next pass starts from the top again
+        checkpoint.last_id = ""
+        checkpoint.save(update_fields=["last_id", "updated_at"])
+    return purged, True
+
+
+def purge_messages(batch_size=DEFAULT_BATCH_SIZE, pause=0, max_batches=None, now=None) -> int:
+    """Purge messages that were soft-deleted more than PURGE_AFTER_DAYS ago."""
+    cutoff = (now or timezone.now()) - purge_after()
+    queryset = Message.objects.filter(deleted=True, deleted_at__lte=cutoff)
+    purged, finished = _purge_in_batches(queryset, "messages", batch_size, pause, max_batches)
+    logger.info("Purged %d deleted messages%s", purged, "" if finished else " (stopped early, will resume)")
+    return purged
+
+
+def _purge_space(space_id, batch_size, pause):
+    _purge_in_batches(Message.objects.filter(channel__space_id=space_id), f"space:{space_id}", batch_size, pause)
+    # With the messages gone there's little left for the collector to cascade through
+    Space.objects.filter(pk=space_id).delete()
+    PurgeCheckpoint.objects.filter(name=f"space:{space_id}").delete()
+
+
+def purge_users(batch_size=DEFAULT_BATCH_SIZE, pause=0, now=None) -> int:
+    """
+    Purge users that were soft-deleted more than PURGE_AFTER_DAYS ago: their messages first, then the spaces they
+    own (which would otherwise go in one unbatched cascade), their archived messages, and their uploads that
+    never got sent.
+    """
+    cutoff = (now or timezone.now()) - purge_after()
+    purged = 0
+    for user in User.objects.filter(deleted=True, deleted_at__lte=cutoff).only("pk"):
+        _purge_in_batches(Message.objects.filter(author_id=user.pk), f"user:{user.pk}", batch_size, pause)
+        for space_id in Space.objects.filter(owner_id=user.pk).values_list("pk", flat=True):
+            _purge_space(space_id, batch_size, pause)
+        _announce_deleted(archive.remove_archived_author(user.pk))
+        with transaction.atomic(using=router.db_for_write(Attachment)):
+            delete_attachments(Attachment.objects.filter(uploader_id=user.pk, message__isnull=True))
+        user.delete()
+        PurgeCheckpoint.objects.filter(name=f"user:{user.pk}").delete()
+        purged += 1
+    logger.info("Purged %d deleted users", purged)
+    return purged
+
+
+def purge_spaces(batch_size=DEFAULT_BATCH_SIZE, pause=0, now=None) -> int:
+    """Purge spaces that were soft-deleted more than PURGE_AFTER_DAYS ago, messages first."""
+    cutoff = (now or timezone.now()) - purge_after()
+    purged = 0
+    for space_id in Space.objects.filter(deleted=True, deleted_at__lte=cutoff).values_list("pk", flat=True):
+        _purge_space(space_id, batch_size, pause)
+        purged += 1
+    logger.info("Purged %d deleted spaces", purged)
+    return purged
+
+
+def purge(batch_size=DEFAULT_BATCH_SIZE, pause=0, max_batches=None) -> dict:
+    now = timezone.now()
+    return {
+        "messages": purge_messages(batch_size, pause, max_batches, now=now),
+        "users": purge_users(batch_size, pause, now=now),
+        "spaces": purge_spaces(batch_size, pause, now=now),
+    }
@@ -0,0 +1,159 @@
+import logging
+import threading
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, CharField, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from koru.utils import PeriodicFlusher, normalize_cursor
+from .models import Message, MessageReadState
+
+logger = logging.getLogger(__name__)
+
+# (user id, channel id) -> newest message acked there that hasn't been written yet
+_pending_acks = {}
+_lock = threading.Lock()
+
+ACK_BATCH_SIZE = 500
+
+
+def _flush_interval():
+    return getattr(settings, "READ_STATE_FLUSH_INTERVAL", 1)
+
+
+def _ensure_rows(pairs):
+    """Make sure a read state exists for each (user id, channel id) pair. One INSERT, existing rows are left alone."""
+    MessageReadState.objects.bulk_create(
+        [MessageReadState(user_id=user_id, channel_id=channel_id) for user_id, channel_id in pairs],
+        ignore_conflicts=True,
+    )
+
+
+def record_mentions(channel_id, user_ids):
+    """Bump mention_count for everyone mentioned by one message. Two queries however many users were mentioned."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    _ensure_rows((user_id, channel_id) for user_id in user_ids)
+    MessageReadState.objects.filter(channel_id=channel_id, user_id__in=user_ids).update(
+        mention_count=F("mention_count") + 1
+    )
+
+
+def on_mentions_added(message, user_ids):
+    # Authors don't get pinged by mentioning themselves
+    user_ids = set(user_ids) - {message.author_id}
+    channel_id = message.channel_id
+    transaction.on_commit(lambda: record_mentions(channel_id, user_ids))
+
+
+def ack(user, channel, message_id):
+    """
+    Mark a channel read up to message_id. Acks are held in memory and written by flush_acks(), so a client
+    scrolling through a channel (or a dozen of them) costs a handful of writes rather than one per ack.
+    """
+    key = (getattr(user, "pk", user), getattr(channel, "pk", channel))
+    # Raises ValidationError for anything that isn't a snowflake, so bad input never reaches the buffer
+    message_id = normalize_cursor(getattr(message_id, "pk", message_id))
+    with _lock:
+        if key not in _pending_acks or _pending_acks[key] < message_id:
+            _pending_acks[key] = message_id
+    _flusher.start()
+
+
+def _unread_mentions():
+    # Mentions of the row's user in the row's channel that are newer than what they've read. With nothing
+    # read yet every mention counts: ids are never empty, so they all sort after "".
+    mentions = Message.mentions.through.objects.filter(
+        user_id=OuterRef("user_id"),
+        message__channel_id=OuterRef("channel_id"),
+        message__deleted=False,
+        message_id__gt=Coalesce(OuterRef("last_read_message_id"), Value(""), output_field=CharField()),
+    ).values("user_id").annotate(n=Count("*")).values("n")
+    return Coalesce(Subquery(mentions), 0)
+
+
+def _valid_acks(batch):
+    # Acks for messages that don't exist (anymore) or live in another channel would fail the foreign key
+    found = dict(Message.objects.filter(pk__in={message_id for _, message_id in batch}).values_list("pk", "channel_id"))
+    return [((user_id, channel_id), message_id) for (user_id, channel_id), message_id in batch if found.get(message_id) == channel_id]
+
+
+def _write_acks(batch):
+    if not batch:
+        # An empty Q() would match (and recount) every read state there is
+        return
+    pointer = MessageReadState._meta.get_field("last_read_message").target_field
+    matches = Q()
+    whens = []
+    for (user_id, channel_id), message_id in batch:
+        pair = Q(user_id=user_id, channel_id=channel_id)
+        matches |= pair
+        whens.append(When(
+            pair & (Q(last_read_message__isnull=True) | Q(last_read_message_id__lt=message_id)),
+            then=Value(message_id),
+        ))
+    rows = MessageReadState.objects.filter(matches)
+    with transaction.atomic():
+        _ensure_rows(key for key, _ in batch)
+        rows.update(last_read_message_id=Case(*whens, default=F("last_read_message_id"), output_field=pointer))
+        # Anything mentioning them after the new pointer is still unread
+        rows.update(mention_count=_unread_mentions())
+
+
+def flush_acks() -> int:
+    """
+    Write pending acks. Read pointers only ever move forward. Acks that can't be written (their message
+    or user is gone) are dropped rather than retried. Returns how many acks were written.
+    """
+    global _pending_acks
+    with _lock:
+        pending, _pending_acks = _pending_acks, {}
+    items = list(pending.items())
+    written = 0
+    for start in range(0, len(items), ACK_BATCH_SIZE):
+        try:
+            batch = _valid_acks(items[start:start + ACK_BATCH_SIZE])
+            if not batch:
+                continue
+            try:
+                _write_acks(batch)
+                written += len(batch)
+            except IntegrityError:
+                # Something in the batch is bad, so find it one ack at a time instead of failing the rest
+                for item in batch:
+                    try:
+                        _write_acks([item])
+                        written += 1
+                    except IntegrityError:
+                        logger.warning("Dropping read ack %r that can't be written", item)
+        except Exception:
+            # Anything else (the database going away) is worth another go, for what hasn't been written yet
+            with _lock:
+                for key, message_id in items[start:]:
+                    if key not in _pending_acks or _pending_acks[key] < message_id:
+                        _pending_acks[key] = message_id
+            raise
+    return written
+
+
+_flusher = PeriodicFlusher("read-state-flusher", flush_acks, _flush_interval)
+
+
+def unread_summary(user) -> list[dict]:
+    """
+    Every channel the user has something unread or a pending mention in, in one query. Each entry has
+    channel_id, space_id, last_read_message_id, last_message_id and mention_count.
+    """
+    return list(
+        MessageReadState.objects.filter(user_id=getattr(user, "pk", user))
+        .filter(
+            Q(mention_count__gt=0)
+            | Q(last_read_message__isnull=True, channel__last_message__isnull=False)
+            | Q(channel__last_message_id__gt=F("last_read_message_id"))
+        )
+        .values(
+            "channel_id", "last_read_message_id", "mention_count",
+            space_id=F("channel__space_id"), last_message_id=F("channel__last_message_id"),
+        )
+        .order_by("channel_id")
+    )
@@ -0,0 +1,149 @@
+import threading
+import time
+from bisect import bisect_left, insort
+from django.conf import settings
+from koru.db import replica_reads
+from .models import Space
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+def _normalize_tags(*tag_lists):
+    return frozenset(str(t).strip().lower() for tags in tag_lists for t in (tags or ()) if str(t).strip())
+
+
+def _rank_key(space_id, official, verified, member_count):
+    # Official spaces first, then verified, then by size. The id keeps the order stable.
+    return (not official, not verified, -(member_count or 0), space_id)
+
+
+class RegistryIndex:
+    """
+    In-process index of Space Registry listings: one ranked list of every listed space plus a
+    tag -> ranked posting list, both kept sorted so single entries can be added or removed without a rebuild.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rebuilding = threading.Lock()
+        self._entries = {}  # space id -> (rank key, tags)
+        self._ranked = []
+        self._postings = {}  # tag -> [rank key, ...]
+        self.built_at = None
+
+    def _queryset(self):
+        return Space.objects.filter(space_registry_listed=True, deleted=False).values_list(
+            "pk", "server_official", "server_verified", "member_count", "server_tags", "registry_entry__tags"
+        )
+
+    def rebuild(self, batch_size: int = 5000):
+        entries = {}
+        last_pk = ""
+        while True:
+            rows = list(self._queryset().filter(pk__gt=last_pk).order_by("pk")[:batch_size])
+            if not rows:
+                break
+            for pk, official, verified, member_count, server_tags, entry_tags in rows:
+                entries[pk] = (_rank_key(pk, official, verified, member_count), _normalize_tags(server_tags, entry_tags))
+            last_pk = rows[-1][0]
+
+        postings = {}
+        for key, tags in entries.values():
+            for tag in tags:
+                postings.setdefault(tag, []).append(key)
+        for keys in postings.values():
+            keys.sort()
+
+        with self._lock:
+            self._entries = entries
+            self._ranked = sorted(key for key, _ in entries.values())
+            self._postings = postings
+            self.built_at = time.monotonic()
+
+    def rebuild_if_stale(self, max_age: float):
+        """
+        Rebuild if the index is more than max_age seconds old. Only one thread rebuilds at a time: the rest keep
+        serving the old index meanwhile, and only wait for the rebuild when there's no index at all yet.
+        """
+        if self.built_at is not None and time.monotonic() - self.built_at <= max_age:
+            return
+        if not self._rebuilding.acquire(blocking=self.built_at is None):
+            return
+        try:
+            # Whoever held the lock before us may have just rebuilt it
+            if self.built_at is None or time.monotonic() - self.built_at > max_age:
+                self.rebuild()
+        finally:
+            self._rebuilding.release()
+
+    def _remove_locked(self, space_id):
+        entry = self._entries.pop(space_id, None)
+        if entry is None:
+            return
+        key, tags = entry
+        for keys in [self._ranked] + [self._postings[t] for t in tags if t in self._postings]:
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+        for tag in tags:
+            if tag in self._postings and not self._postings[tag]:
+                del self._postings[tag]
+
+    def refresh(self, space_ids):
+        """Re-read just these spaces and move them to wherever they now belong (or out of the index)."""
+        space_ids = list(space_ids)
+        if not space_ids or self.built_at is None:
+            return
+        rows = {row[0]: row for row in self._queryset().filter(pk__in=space_ids)}
+        with self._lock:
+            for space_id in space_ids:
+                self._remove_locked(space_id)
+                row = rows.get(space_id)
+                if row is None:
+                    continue
+                pk, official, verified, member_count, server_tags, entry_tags = row
+                key, tags = _rank_key(pk, official, verified, member_count), _normalize_tags(server_tags, entry_tags)
+                self._entries[pk] = (key, tags)
+                insort(self._ranked, key)
+                for tag in tags:
+                    insort(self._postings.setdefault(tag, []), key)
+
+    def page(self, tags=None, offset: int = 0, limit: int = DEFAULT_PAGE_SIZE):
+        """Returns (space ids for this page, total matches)."""
+        tags = _normalize_tags(tags)
+        with self._lock:
+            if not tags:
+                keys = self._ranked
+            else:
+                # Walk the rarest tag's postings and check the rest against each entry's tag set
+                postings = [self._postings.get(t, []) for t in tags]
+                keys = min(postings, key=len)
+                if len(tags) > 1:
+                    keys = [k for k in keys if tags <= self._entries[k[3]][1]]
+            return [k[3] for k in keys[offset:offset + limit]], len(keys)
+
+
+_index = RegistryIndex()
+
+
+def get_index() -> RegistryIndex:
+    _index.rebuild_if_stale(getattr(settings, "REGISTRY_REBUILD_INTERVAL", 300))
+    return _index
+
+
+def refresh_spaces(space_ids):
+    _index.refresh(space_ids)
+
+
+@replica_reads()
+def discover(tags=None, page: int = 1, per_page: int = DEFAULT_PAGE_SIZE):
+    """
+    One page of Space Registry listings, ranked official > verified > member count.
+    Returns (spaces, total matches). Once the index is warm this is a single query for the page's spaces.
+    """
+    per_page = max(1, min(int(per_page), MAX_PAGE_SIZE))
+    page = max(1, int(page))
+    ids, total = get_index().page(tags, offset=(page - 1) * per_page, limit=per_page)
+    spaces = Space.objects.select_related("registry_entry").in_bulk(ids)
+    return [spaces[i] for i in ids if i in spaces], total
@@ -0,0 +1,158 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from koru.utils import bump_stamp, get_stamps, snowflake_from_timestamp, timestamp_from_snowflake
+from .models import Blocks, Friendship
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over string keys. False positives are possible, false negatives aren't."""
+
+    def __init__(self, size_bits: int, hashes: int = 4):
+        self.size = size_bits
+        self.hashes = hashes
+        self.bits = bytearray((size_bits + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.hashes).digest()
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[i * 4:i * 4 + 4], "little") % self.size
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+def _user_key(user_id) -> str:
+    return f"koru:relationships:{user_id}"
+
+
+# Bumped whenever a block is added anywhere, so every process folds the new ones into its Bloom filter
+_BLOCKS_KEY = "koru:relationships:blocks"
+
+# Blocks are folded into the filter in id order, but a block whose id was made just before the last catch-up
+# can commit just after it. Re-reading this far back on every catch-up covers that.
+_CATCH_UP_OVERLAP = timedelta(minutes=1)
+
+
+class RelationshipGraph:
+    """
+    In-process friends and blocks, loaded per user on first use. Each entry is kept under the user's version stamp in
+    the shared cache, which is replaced (on commit) whenever their relationships change, so other processes see it.
+
+    Most users never block anyone, so every user who's on either end of a block goes into a Bloom filter.
+    Anyone who isn't in it can be answered for without even loading their block sets.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._friends = OrderedDict()  # user id -> (stamp, frozenset of friend ids)
+        self._blocks = OrderedDict()  # user id -> (stamp, (ids they block, ids blocking them))
+        self._filter = None
+        self._filter_stamp = None
+        self._filter_through = ""  # newest block id folded into the filter
+
+    def _fold_blocks(self, bloom, after) -> str:
+        """Adds every block with an id above `after` to the filter, returning the newest id seen."""
+        last_pk = after
+        while True:
+            rows = list(Blocks.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", "blocker_id", "blocked_id")[:10000])
+            if not rows:
+                return last_pk
+            for _, blocker_id, blocked_id in rows:
+                bloom.add(blocker_id)
+                bloom.add(blocked_id)
+            last_pk = rows[-1][0]
+
+    def _might_have_blocks(self, user_id, blocks_stamp) -> bool:
+        if self._filter is None or self._filter_stamp != blocks_stamp:
+            with self._lock:
+                if self._filter is None:
+                    bloom = BloomFilter(getattr(settings, "RELATIONSHIP_FILTER_BITS", 1 << 23))
+                    after = ""
+                else:
+                    # Bits are only ever set, so readers can keep using the filter while it's caught up
+                    bloom = self._filter
+                    after = snowflake_from_timestamp(timestamp_from_snowflake(self._filter_through) - _CATCH_UP_OVERLAP) if self._filter_through else ""
+                through = self._fold_blocks(bloom, after)
+                self._filter = bloom
+                self._filter_through = max(through, self._filter_through)
+                self._filter_stamp = blocks_stamp
+        return user_id in self._filter
+
+    def _remember(self, entries: OrderedDict, user_id, value):
+        with self._lock:
+            entries[user_id] = value
+            entries.move_to_end(user_id)
+            while len(entries) > getattr(settings, "RELATIONSHIP_CACHE_USERS", 100000):
+                entries.popitem(last=False)
+
+    def friends(self, user_id) -> frozenset:
+        stamp, = get_stamps(_user_key(user_id))
+        cached = self._friends.get(user_id)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        rows = Friendship.objects.filter(Q(user1_id=user_id) | Q(user2_id=user_id)).values_list("user1_id", "user2_id")
+        friends = frozenset(b if a == user_id else a for a, b in rows)
+        self._remember(self._friends, user_id, (stamp, friends))
+        return friends
+
+    def blocks(self, user_id) -> tuple[frozenset, frozenset]:
+        """Returns (ids this user blocks, ids blocking this user)."""
+        stamp, blocks_stamp = get_stamps(_user_key(user_id), _BLOCKS_KEY)
+        if not self._might_have_blocks(user_id, blocks_stamp):
+            return frozenset(), frozenset()
+        cached = self._blocks.get(user_id)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        blocking, blocked_by = set(), set()
+        for blocker_id, blocked_id in Blocks.objects.filter(Q(blocker_id=user_id) | Q(blocked_id=user_id)).values_list("blocker_id", "blocked_id"):
+            if blocker_id == user_id:
+                blocking.add(blocked_id)
+            else:
+                blocked_by.add(blocker_id)
+        blocks = (frozenset(blocking), frozenset(blocked_by))
+        self._remember(self._blocks, user_id, (stamp, blocks))
+        return blocks
+
+    def invalidate(self, *user_ids):
+        """Drops the users' cached relationships in every process, once the current transaction commits."""
+        bump_stamp(*map(_user_key, user_ids))
+
+    def block_added(self, blocker_id, blocked_id):
+        bump_stamp(_BLOCKS_KEY, _user_key(blocker_id), _user_key(blocked_id))
+
+
+graph = RelationshipGraph()
+
+
+def _pk(obj):
+    return getattr(obj, "pk", obj)
+
+
+def are_friends(a, b) -> bool:
+    return _pk(b) in graph.friends(_pk(a))
+
+
+def is_blocked(a, b) -> bool:
+    """True if either user has blocked the other."""
+    blocking, blocked_by = graph.blocks(_pk(a))
+    b = _pk(b)
+    return b in blocking or b in blocked_by
+
+
+def can_message(sender, recipient) -> bool:
+    return _pk(sender) != _pk(recipient) and not is_blocked(sender, recipient)
+
+
+def can_message_many(sender, recipients) -> set:
+    """Which of recipients the sender can reach, for group DMs and mentions. Returns a set of user ids."""
+    sender_id = _pk(sender)
+    blocking, blocked_by = graph.blocks(sender_id)
+    return {r for r in map(_pk, recipients) if r != sender_id and r not in blocking and r not in blocked_by}
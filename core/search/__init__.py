@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils.module_loading import import_string
+from koru.db import replica_reads
+from koru.utils import normalize_cursor
+from ..models import Channel, Message
+from ..permissions import private_channels, visible_channels, is_private_channel, has_channel_permission
+
+DEFAULT_LIMIT = 25
+MAX_LIMIT = 100
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = import_string(getattr(settings, "SEARCH_BACKEND", "core.search.sqlite.SQLiteFTSBackend"))()
+    return _backend
+
+
+def _rows(queryset):
+    return queryset.values_list("pk", "channel__space_id", "channel_id", "author_id", "content")
+
+
+def index_messages(message_ids):
+    """(Re)index messages by id. Deleted ones are taken out of the index instead."""
+    message_ids = list(message_ids)
+    rows = list(_rows(Message.objects.filter(pk__in=message_ids, deleted=False)))
+    indexed = {row[0] for row in rows}
+    get_backend().index(rows)
+    gone = [i for i in message_ids if i not in indexed]
+    if gone:
+        get_backend().remove(gone)
+
+
+def remove_messages(message_ids):
+    get_backend().remove(list(message_ids))
+
+
+def reindex(batch_size: int = 1000) -> int:
+    """Rebuild the whole index, streaming messages batch_size at a time in snowflake order."""
+    backend = get_backend()
+    backend.setup()
+    backend.clear()
+    total = 0
+    last_pk = ""
+    queryset = Message.objects.filter(deleted=False).order_by("pk")
+    while True:
+        rows = list(_rows(queryset.filter(pk__gt=last_pk))[:batch_size])
+        if not rows:
+            break
+        backend.index(rows)
+        total += len(rows)
+        last_pk = rows[-1][0]
+    return total
+
+
+def _searchable_channel_ids(user, space=None, channel=None) -> list[str]:
+    if channel is not None:
+        if is_private_channel(channel):
+            allowed = private_channels(user).filter(pk=channel.pk).exists()
+        else:
+            allowed = has_channel_permission(user, channel, "view_channels") and has_channel_permission(user, channel, "read_history")
+        return [channel.pk] if allowed else []
+    if space is not None:
+        return [c.pk for c in visible_channels(user, space)]
+    return list(private_channels(user).values_list("pk", flat=True))
+
+
+@replica_reads()
+def search_messages(user, text: str, space=None, channel: Channel = None, author=None, mentions=None,
+                    after=None, before=None, order: str = "newest", limit: int = DEFAULT_LIMIT) -> list[Message]:
+    """
+    Full-text search over messages the user is allowed to read.
+
+    Scope it to a channel, a space, or neither (which searches the user's DMs and group DMs).
+    after/before are snowflake bounds, order is "newest" or "relevance".
+    """
+    if order not in ("newest", "relevance"):
+        raise ValidationError(f"Invalid search order: {order!r}")
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    channel_ids = _searchable_channel_ids(user, space, channel)
+    if not channel_ids:
+        return []
+
+    ids = get_backend().search(
+        text,
+        channel_ids,
+        author_id=getattr(author, "pk", author),
+        mentions=getattr(mentions, "pk", mentions),
+        after=normalize_cursor(after),
+        before=normalize_cursor(before),
+        order=order,
+        limit=limit,
+    )
+    messages = Message.objects.filter(pk__in=ids, deleted=False).select_related("author", "channel").in_bulk()
+    return [messages[i] for i in ids if i in messages]
@@ -0,0 +1,32 @@
+class SearchBackend:
+    """
+    Interface every message search backend implements. Backends only ever see plain values, never models,
+    so indexing can stream straight out of values_list().
+
+    An indexed row is (message id, space id, channel id, author id, content).
+    """
+
+    def setup(self, using=None):
+        """
+        Create whatever tables/indexes the backend needs. Must be safe to call more than once.
+        Runs after every migrate with the database alias that was migrated as using.
+        """
+        raise NotImplementedError
+
+    def index(self, rows):
+        """Add or replace rows in the index."""
+        raise NotImplementedError
+
+    def remove(self, message_ids):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def search(self, text: str, channel_ids, author_id=None, mentions=None, after=None, before=None,
+               order: str = "newest", limit: int = 25) -> list[str]:
+        """
+        Return matching message ids. Only messages in channel_ids are ever returned; the caller has already
+        narrowed that down to what the searching user is allowed to see. after/before are snowflakes.
+        """
+        raise NotImplementedError
@@ -0,0 +1,105 @@
+from django.db import connections, router
+from ..models import Message
+from .base import SearchBackend
+
+TABLE = "core_message_fts"
+
+
+def _rowid(message_id) -> int:
+    # FTS5 rowids are signed 64-bit, snowflakes are unsigned. Wrap them the same way a C cast would.
+    value = int(message_id)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _match_expression(text: str) -> str:
+    # Quote every term so user input can't be parsed as FTS5 query syntax
+    return " ".join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """Message search on SQLite's FTS5, for local and dev deployments."""
+
+    def __init__(self):
+        # Aliases the table is known to exist on
+        self._ready = set()
+
+    def _connection(self, write=False):
+        return connections[router.db_for_write(Message) if write else router.db_for_read(Message)]
+
+    def _placeholders(self, values):
+        return ", ".join(["%s"] * len(values))
+
+    def setup(self, using=None):
+        connection = connections[using] if using else self._connection(write=True)
+        if connection.alias in self._ready:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5("
+                "content, message_id UNINDEXED, space_id UNINDEXED, channel_id UNINDEXED, author_id UNINDEXED, "
+                "tokenize = 'unicode61 remove_diacritics 2')"
+            )
+        # A table made inside a transaction goes away again if it rolls back, so only trust one made outside
+        if not connection.in_atomic_block:
+            self._ready.add(connection.alias)
+
+    def index(self, rows):
+        self.setup()
+        rows = [(_rowid(r[0]), r[4] or "", r[0], r[1], r[2], r[3]) for r in rows]
+        if not rows:
+            return
+        with self._connection(write=True).cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {TABLE} WHERE rowid IN ({self._placeholders(rows)})", [r[0] for r in rows]
+            )
+            cursor.executemany(
+                f"INSERT INTO {TABLE} (rowid, content, message_id, space_id, channel_id, author_id) "
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                rows,
+            )
+
+    def remove(self, message_ids):
+        self.setup()
+        rowids = [_rowid(i) for i in message_ids]
+        if not rowids:
+            return
+        with self._connection(write=True).cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE} WHERE rowid IN ({self._placeholders(rowids)})", rowids)
+
+    def clear(self):
+        self.setup()
+        with self._connection(write=True).cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE}")
+
+    def search(self, text, channel_ids, author_id=None, mentions=None, after=None, before=None,
+               order="newest", limit=25):
+        self.setup()
+        channel_ids = list(channel_ids)
+        match = _match_expression(text)
+        if not channel_ids or not match:
+            return []
+
+        sql = [f"SELECT message_id FROM {TABLE} WHERE {TABLE} MATCH %s"]
+        params = [match]
+        sql.append(f"AND channel_id IN ({self._placeholders(channel_ids)})")
+        params.extend(channel_ids)
+        if author_id is not None:
+            sql.append("AND author_id = %s")
+            params.append(author_id)
+        if mentions is not None:
+            through = Message.mentions.through._meta.db_table
+            sql.append(f"AND message_id IN (SELECT message_id FROM {through} WHERE user_id = %s)")
+            params.append(mentions)
+        if after is not None:
+            sql.append("AND message_id > %s")
+            params.append(after)
+        if before is not None:
+            sql.append("AND message_id < %s")
+            params.append(before)
+        sql.append("ORDER BY rank" if order == "relevance" else "ORDER BY message_id DESC")
+        sql.append("LIMIT %s")
+        params.append(limit)
+
+        with self._connection().cursor() as cursor:
+            cursor.execute(" ".join(sql), params)
+            return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,193 @@
+from django.db import router, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, post_migrate, m2m_changed
+from django.dispatch import receiver
+from koru.gateway import events as gateway
+from . import activity, archive, bans, counters, emoji, forwarding, invites, mentions, permissions, readstate, registry, search
+from .ordering import positions_changed
+from .relationships import graph
+from .models import ArchiveSegment, Blocks, ChannelForwarder, CustomEmoji, Friendship, Invite, Message, Space, SpaceBan, SpaceRegEntry, SpaceRole, UserRoleAssignment
+
+
+@receiver([post_save, post_delete], sender=SpaceRole)
+def role_changed(sender, instance, **kwargs):
+    # Moving one role shifts its siblings too, so the whole space has to go
+    permissions.invalidate_space(instance.space_id)
+
+
+@receiver(positions_changed, sender=SpaceRole)
+def roles_reordered(sender, space_id, **kwargs):
+    permissions.invalidate_space(space_id)
+
+
+@receiver([post_save, post_delete], sender=UserRoleAssignment)
+def role_assignment_changed(sender, instance, **kwargs):
+    permissions.invalidate_member(instance.user_id, instance.space_id)
+
+
+@receiver(post_save, sender=Space)
+def space_saved(sender, instance, created, update_fields=None, **kwargs):
+    if not created and (update_fields is None or "owner" in update_fields):
+        permissions.invalidate_space(instance.pk)
+    space_id, vanity_url = instance.pk, instance.vanity_url
+    transaction.on_commit(lambda: registry.refresh_spaces([space_id]))
+    transaction.on_commit(lambda: invites.forget_vanity(vanity_url))
+
+
+@receiver(post_delete, sender=Space)
+def space_deleted(sender, instance, **kwargs):
+    permissions.invalidate_space(instance.pk)
+    space_id, vanity_url = instance.pk, instance.vanity_url
+    transaction.on_commit(lambda: registry.refresh_spaces([space_id]))
+    transaction.on_commit(lambda: invites.forget_vanity(vanity_url))
+
+
+@receiver([post_save, post_delete], sender=SpaceRegEntry)
+def registry_entry_changed(sender, instance, **kwargs):
+    space_id = instance.space_id
+    transaction.on_commit(lambda: registry.refresh_spaces([space_id]))
+
+
+@receiver(counters.member_counts_changed)
+def member_counts_changed(sender, space_ids, **kwargs):
+    registry.refresh_spaces(space_ids)
+
+
+@receiver(m2m_changed, sender=Space.members.through)
+def space_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ("post_add", "post_remove"):
+        sign = 1 if action == "post_add" else -1
+        if reverse:
+            # user.spaces.add(...): instance is the user, pk_set holds spaces
+            for space_id in pk_set:
+                permissions.invalidate_member(instance.pk, space_id)
+                counters.on_members_changed(space_id, sign)
+        else:
+            for user_id in pk_set:
+                permissions.invalidate_member(user_id, instance.pk)
+            counters.on_members_changed(instance.pk, sign * len(pk_set))
+    elif action == "pre_clear":
+        # Once cleared we can't tell what was there anymore
+        if reverse:
+            instance._cleared_space_ids = list(instance.spaces.values_list("pk", flat=True))
+        else:
+            instance._cleared_member_count = instance.members.count()
+    elif action == "post_clear":
+        if reverse:
+            for space_id in getattr(instance, "_cleared_space_ids", ()):
+                permissions.invalidate_member(instance.pk, space_id)
+                counters.on_members_changed(space_id, -1)
+        else:
+            permissions.invalidate_space(instance.pk)
+            counters.on_members_changed(instance.pk, -getattr(instance, "_cleared_member_count", 0))
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    # index_messages() takes deleted messages back out of the index too
+    message_id = instance.pk
+    transaction.on_commit(lambda: search.index_messages([message_id]))
+    if created:
+        activity.on_message_created(instance)
+        forwarding.on_message_created(instance)
+        mentions.on_message_created(instance)
+        transaction.on_commit(lambda: gateway.message_created(instance))
+    else:
+        transaction.on_commit(lambda: gateway.message_updated(instance))
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    message_id, channel_id = instance.pk, instance.channel_id
+    # Other processes may still hold a pointer to it too; their flush drops it
+    activity.forget_messages([message_id])
+    transaction.on_commit(lambda: search.remove_messages([message_id]))
+    transaction.on_commit(lambda: gateway.message_deleted(message_id, channel_id))
+
+
+@receiver(post_migrate)
+def create_search_index(sender, using, **kwargs):
+    # Made here rather than on first use, so it exists before anything (like a test) runs in a transaction
+    if sender.name == "core" and router.allow_migrate_model(using, Message):
+        search.get_backend().setup(using=using)
+
+
+@receiver([post_save, post_delete], sender=SpaceBan)
+def ban_changed(sender, instance, **kwargs):
+    space_id, user_id = instance.space_id, instance.user_id
+    transaction.on_commit(lambda: bans.forget_bans([(space_id, user_id)]))
+
+
+@receiver(post_save, sender=CustomEmoji)
+def custom_emoji_saved(sender, instance, **kwargs):
+    space_id = instance.space_id
+    transaction.on_commit(lambda: emoji.forget_space(space_id))
+
+
+@receiver(post_delete, sender=CustomEmoji)
+def custom_emoji_deleted(sender, instance, **kwargs):
+    space_id = instance.space_id
+    emoji.emoji_hard_deleted(space_id)
+    transaction.on_commit(lambda: emoji.forget_space(space_id))
+
+
+@receiver([post_save, post_delete], sender=ChannelForwarder)
+def forwarder_changed(sender, instance, **kwargs):
+    forwarding.invalidate()
+
+
+@receiver(m2m_changed, sender=Message.mentions.through)
+def message_mentions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != "post_add" or not pk_set:
+        return
+    if reverse:
+        # user.mentioned_in.add(...): instance is the user, pk_set holds messages
+        for message in Message.objects.filter(pk__in=pk_set).only("channel_id", "author_id"):
+            readstate.on_mentions_added(message, [instance.pk])
+    else:
+        readstate.on_mentions_added(instance, pk_set)
+
+
+@receiver([post_save, post_delete], sender=Friendship)
+def friendship_changed(sender, instance, **kwargs):
+    graph.invalidate(instance.user1_id, instance.user2_id)
+
+
+@receiver(post_save, sender=Blocks)
+def block_saved(sender, instance, **kwargs):
+    graph.block_added(instance.blocker_id, instance.blocked_id)
+
+
+@receiver(post_delete, sender=Blocks)
+def block_deleted(sender, instance, **kwargs):
+    # Bloom filters can't forget, so both users keep taking the slower path until the process restarts
+    graph.invalidate(instance.blocker_id, instance.blocked_id)
+
+
+@receiver(post_delete, sender=ArchiveSegment)
+def archive_segment_deleted(sender, instance, **kwargs):
+    # Also runs when a channel or space delete cascades to its segments
+    path, upload_paths = instance.path, list(instance.upload_paths)
+    transaction.on_commit(lambda: archive.delete_segment_files(path, upload_paths))
+
+
+@receiver([post_save, post_delete], sender=Invite)
+def invite_changed(sender, instance, **kwargs):
+    code = instance.code
+    transaction.on_commit(lambda: invites.forget_invite(code))
+
+
+@receiver(m2m_changed, sender=Invite.roles_granted.through)
+def invite_roles_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if not reverse:
+        codes = [instance.code]
+    else:
+        # role.invites_granting_role was changed, which can touch any number of invites
+        query = Q(roles_granted=instance)
+        if pk_set:
+            query |= Q(pk__in=pk_set)
+        codes = Invite.objects.filter(query).values_list("code", flat=True).distinct()
+    for code in codes:
+        invites.forget_invite(code)
@@ -1,3 +1,1463 @@
-from django.test import TestCase
+from types import SimpleNamespace
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from users.models import User
+from .models import Space, Channel, Category, Message, Invite
 
-# Create your tests here.
+
+class ResourceModelSaveQueryTests(TestCase):
+    """Saving a ResourceModel should cost exactly one query, no matter how it was loaded."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email="owner@koru.test", username="owner")
+        cls.space = Space.objects.create(name="Space", owner=cls.user)
+        cls.category = Category.objects.create(space=cls.space, name="General", position=1)
+        cls.channel = Channel.objects.create(space=cls.space, name="general", position=1, category=cls.category)
+        cls.message = Message.objects.create(channel=cls.channel, author=cls.user, content="hi")
+        cls.invite = Invite.objects.create(space=cls.space, channel=cls.channel, inviter=cls.user)
+
+    def test_create_is_one_query(self):
+        with self.assertNumQueries(1):
+            Message.objects.create(channel=self.channel, author=self.user, content="hello")
+
+    def test_update_is_one_query(self):
+        for model, pk in (
+            (Space, self.space.pk),
+            (Category, self.category.pk),
+            (Channel, self.channel.pk),
+            (Message, self.message.pk),
+            (Invite, self.invite.pk),
+        ):
+            obj = model.objects.get(pk=pk)
+            with self.subTest(model=model.__name__), self.assertNumQueries(1):
+                obj.save()
+
+    def test_update_fields_save_is_one_query_and_bumps_updated_at(self):
+        message = Message.objects.get(pk=self.message.pk)
+        before = message.updated_at
+        message.content = "edited"
+        with self.assertNumQueries(1):
+            message.save(update_fields=["content"])
+        message.refresh_from_db()
+        self.assertEqual(message.content, "edited")
+        self.assertGreater(message.updated_at, before)
+
+    def test_changing_id_is_rejected_without_a_query(self):
+        invite = Invite.objects.get(pk=self.invite.pk)
+        invite.id = "1"
+        with self.assertNumQueries(0), self.assertRaises(ValidationError):
+            invite.save()
+
+
+class SnowflakeAllocatorTests(SimpleTestCase):
+    def _allocator(self, clock=None):
+        from snowflakekit import SnowflakeConfig
+        from koru.utils import SNOWFLAKE_EPOCH, SNOWFLAKE_NODE_BITS, SNOWFLAKE_TIME_BITS, SNOWFLAKE_WORKER_BITS, SnowflakeAllocator
+        allocator = SnowflakeAllocator(SnowflakeConfig(
+            epoch=SNOWFLAKE_EPOCH, node_id=1, worker_id=2,
+            time_bits=SNOWFLAKE_TIME_BITS, node_bits=SNOWFLAKE_NODE_BITS, worker_bits=SNOWFLAKE_WORKER_BITS,
+        ))
+        if clock is not None:
+            allocator._now = lambda: next(clock)
+        return allocator
+
+    def test_ids_only_go_up(self):
+        import itertools
+        allocator = self._allocator()
+        ids = [allocator.next_id() for _ in range(5000)]
+        self.assertTrue(all(a < b for a, b in itertools.pairwise(ids)))
+
+    def test_ids_keep_going_up_when_the_clock_goes_back(self):
+        import itertools
+        from koru.utils import SNOWFLAKE_EPOCH
+        allocator = self._allocator(iter([SNOWFLAKE_EPOCH + t for t in (5000, 5001, 4000, 4000, 5001, 4999)]))
+        ids = [allocator.next_id() for _ in range(6)]
+        self.assertTrue(all(a < b for a, b in itertools.pairwise(ids)))
+
+    def test_running_out_of_sequence_borrows_the_next_millisecond(self):
+        import itertools
+        from koru.utils import SNOWFLAKE_EPOCH
+        allocator = self._allocator(itertools.repeat(SNOWFLAKE_EPOCH + 5000))
+        ids = allocator.reserve(allocator._max_sequence * 3)
+        ids.append(allocator.next_id())
+        self.assertTrue(all(a < b for a, b in itertools.pairwise(ids)))
+
+    def test_threads_never_share_ids(self):
+        import threading
+        allocator = self._allocator()
+        results = []
+
+        def allocate():
+            results.append([allocator.next_id() for _ in range(500)] + allocator.reserve(500))
+
+        threads = [threading.Thread(target=allocate) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        every_id = [i for ids in results for i in ids]
+        self.assertEqual(len(set(every_id)), 8 * 1000)
+
+    def test_reserved_blocks_do_not_overlap(self):
+        allocator = self._allocator()
+        first, second = allocator.reserve(3000), allocator.reserve(3000)
+        self.assertEqual(len(set(first)), 3000)
+        self.assertLess(max(first), min(second))
+        self.assertEqual(allocator.reserve(0), [])
+        with self.assertRaises(ValueError):
+            allocator.reserve(-1)
+
+    def test_a_missing_worker_id_is_an_error_outside_debug(self):
+        from unittest import mock
+        from django.core.exceptions import ImproperlyConfigured
+        from django.test import override_settings
+        from koru.utils import _worker_id
+        with mock.patch.dict("os.environ", {"KORU_WORKER_ID": ""}), override_settings(SNOWFLAKE_WORKER_ID=None):
+            with override_settings(DEBUG=False), self.assertRaises(ImproperlyConfigured):
+                _worker_id()
+            with override_settings(DEBUG=True), self.assertLogs("koru.utils", "WARNING"):
+                self.assertLess(_worker_id(), 256)
+        with override_settings(SNOWFLAKE_WORKER_ID=256), self.assertRaises(ImproperlyConfigured):
+            _worker_id()
+
+
+class HistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        from koru.utils import reserve_snowflakes
+        cls.user = User.objects.create(email="author@koru.test", username="author")
+        cls.space = Space.objects.create(name="Space", owner=cls.user)
+        cls.channel = Channel.objects.create(space=cls.space, name="general", position=1)
+        cls.ids = reserve_snowflakes(30)
+        Message.objects.bulk_create(Message(id=i, channel=cls.channel, author=cls.user, content=i) for i in cls.ids)
+
+    def test_before_after_around(self):
+        from .history import get_history
+        newest_first = self.ids[::-1]
+        self.assertEqual([m.id for m in get_history(self.channel, limit=5)], newest_first[:5])
+        self.assertEqual([m.id for m in get_history(self.channel, before=self.ids[10], limit=5)], self.ids[5:10][::-1])
+        self.assertEqual([m.id for m in get_history(self.channel, after=self.ids[10], limit=5)], self.ids[11:16][::-1])
+        self.assertEqual([m.id for m in get_history(self.channel, around=self.ids[10], limit=4)], self.ids[9:13][::-1])
+
+    def test_page_query_count_is_fixed(self):
+        from .history import get_history
+        with self.assertNumQueries(3):
+            get_history(self.channel, before=self.ids[-1], limit=20)
+        with self.assertNumQueries(3):
+            get_history(self.channel, before=self.ids[3], limit=20)
+
+    def test_uploads_come_with_the_page(self):
+        from django.core import checks
+        from .history import get_history
+        from .models import Attachment
+        # The reverse accessor used to clash with the legacy Message.attachments list
+        self.assertEqual([e.id for e in checks.run_checks() if e.id in ("fields.E302", "fields.E303")], [])
+        Message(channel=self.channel, author=self.user, content="unsaved")
+        upload = Attachment.objects.create(message_id=self.ids[-1], url="https://cdn.koru.test/a", filename="a", content_type="text/plain", size=1)
+        page = get_history(self.channel, limit=2)
+        with self.assertNumQueries(0):
+            self.assertEqual([list(m.files.all()) for m in page], [[upload], []])
+
+
+class PermissionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        from .models import SpaceRole
+        cls.owner = User.objects.create(email="perm-owner@koru.test", username="perm-owner")
+        cls.member = User.objects.create(email="perm-member@koru.test", username="perm-member")
+        cls.space = Space.objects.create(name="Space", owner=cls.owner)
+        cls.space.members.add(cls.owner, cls.member)
+        cls.channel = Channel.objects.create(space=cls.space, name="general", position=1)
+        cls.everyone = SpaceRole.objects.create(
+            space=cls.space, name="everyone", default_role=True, position=1,
+            permissions={"view_channels": True, "send_messages": True},
+        )
+        cls.muted = SpaceRole.objects.create(space=cls.space, name="muted", position=2, permissions={"send_messages": False})
+
+    def test_roles_resolve_by_position_and_invalidate(self):
+        from . import permissions
+        from .models import UserRoleAssignment
+        self.assertTrue(permissions.has_permission(self.member, self.space, "send_messages"))
+        self.assertTrue(permissions.has_permission(self.owner, self.space, "ban_members"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            assignment = UserRoleAssignment.objects.create(user=self.member, space=self.space, role=self.muted)
+            # Nothing is dropped until the change commits
+            self.assertTrue(permissions.has_permission(self.member, self.space, "send_messages"))
+        self.assertFalse(permissions.has_permission(self.member, self.space, "send_messages"))
+        with self.assertNumQueries(0):
+            permissions.has_permission(self.member, self.space, "send_messages")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            assignment.delete()
+        self.assertTrue(permissions.has_permission(self.member, self.space, "send_messages"))
+
+    def test_channel_overrides(self):
+        from . import permissions
+        self.everyone.permissions = {**self.everyone.permissions, "channels": {self.channel.pk: {"send_messages": False}}}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.everyone.save()
+        self.assertTrue(permissions.has_permission(self.member, self.space, "send_messages"))
+        self.assertFalse(permissions.has_channel_permission(self.member, self.channel, "send_messages"))
+
+    def test_changes_made_by_other_processes_are_seen(self):
+        from django.core.cache import cache
+        from django.test import override_settings
+        from . import permissions
+        from .models import SpaceRole
+        self.assertTrue(permissions.has_permission(self.member, self.space, "send_messages"))
+        # Another worker edits the role and bumps the shared stamp; nothing in this process was told
+        SpaceRole.objects.filter(pk=self.everyone.pk).update(permissions={"view_channels": True})
+        cache.set(permissions._space_key(self.space.pk), "changed elsewhere", None)
+        self.assertFalse(permissions.has_permission(self.member, self.space, "send_messages"))
+
+        with override_settings(PERMISSION_CACHE_SPACES=1):
+            other = Space.objects.create(name="Other", owner=self.owner)
+            permissions.has_permission(self.owner, other, "ban_members")
+            self.assertEqual(list(permissions._spaces), [other.pk])
+
+
+class ReorderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(email="order-owner@koru.test", username="order-owner")
+        cls.space = Space.objects.create(name="Space", owner=cls.owner)
+        cls.channels = [Channel.objects.create(space=cls.space, name=f"c{i}") for i in range(5)]
+
+    def names(self):
+        return list(Channel.objects.filter(space=self.space).values_list("name", flat=True))
+
+    def test_reorder_is_constant_statements(self):
+        new_order = [c.pk for c in reversed(self.channels)]
+        # savepoint, lock + validate, two UPDATEs, release
+        with self.assertNumQueries(5):
+            Channel.reorder(self.space, new_order)
+        self.assertEqual(self.names(), ["c4", "c3", "c2", "c1", "c0"])
+
+    def test_reorder_rejects_partial_orderings(self):
+        with self.assertRaises(ValidationError):
+            Channel.reorder(self.space, [c.pk for c in self.channels[:-1]])
+
+    def test_single_move_only_touches_one_row(self):
+        channel = Channel.objects.get(pk=self.channels[4].pk)
+        before = dict(Channel.objects.exclude(pk=channel.pk).values_list("pk", "position"))
+        channel.move_to(1)
+        self.assertEqual(self.names(), ["c4", "c0", "c1", "c2", "c3"])
+        self.assertEqual(before, dict(Channel.objects.exclude(pk=channel.pk).values_list("pk", "position")))
+
+
+class MemberCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(email="count-owner@koru.test", username="count-owner")
+        cls.joiners = [User.objects.create(email=f"joiner{i}@koru.test", username=f"joiner{i}") for i in range(3)]
+        cls.space = Space.objects.create(name="Space", owner=cls.owner)
+
+    def setUp(self):
+        from . import counters
+        # Deltas left over from other tests would land in this test's flush
+        counters._pending.clear()
+
+    def test_joins_and_leaves_are_batched(self):
+        from unittest import mock
+        from .counters import flush_member_counts
+        # Keep the background flusher out of it so the test decides when things get written
+        with mock.patch("core.counters._flusher"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.space.members.add(*self.joiners)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.joiners[0].spaces.remove(self.space)
+        self.space.refresh_from_db()
+        self.assertEqual(self.space.member_count, 0)
+
+        with self.assertNumQueries(1):
+            flush_member_counts()
+        self.space.refresh_from_db()
+        self.assertEqual(self.space.member_count, 2)
+
+    def test_reconcile_fixes_drift(self):
+        from .counters import reconcile_member_counts
+        self.space.members.add(*self.joiners)
+        Space.objects.filter(pk=self.space.pk).update(member_count=42)
+        self.assertEqual(reconcile_member_counts(), 1)
+        self.space.refresh_from_db()
+        self.assertEqual(self.space.member_count, 3)
+
+
+class PurgeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email="purge@koru.test", username="purge")
+        cls.space = Space.objects.create(name="Space", owner=cls.user)
+        cls.channel = Channel.objects.create(space=cls.space, name="general")
+
+    def test_old_deleted_messages_are_purged_in_batches(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .models import Attachment
+        from .purge import purge_messages
+        old = timezone.now() - timedelta(days=31)
+        doomed = [Message.objects.create(channel=self.channel, author=self.user, deleted=True, deleted_at=old) for _ in range(5)]
+        kept = Message.objects.create(channel=self.channel, author=self.user, deleted=True, deleted_at=timezone.now())
+        reply = Message.objects.create(channel=self.channel, author=self.user, reply_to=doomed[0])
+        Attachment.objects.create(message=doomed[1], url="https://cdn.koru.test/a", filename="a", content_type="text/plain", size=1)
+
+        self.assertEqual(purge_messages(batch_size=2), 5)
+        self.assertEqual(set(Message.objects.values_list("pk", flat=True)), {kept.pk, reply.pk})
+        self.assertFalse(Attachment.objects.exists())
+        reply.refresh_from_db()
+        self.assertIsNone(reply.reply_to_id)
+
+    def test_permadelete_skips_the_grace_period(self):
+        from unittest import mock
+        from .purge import delete_message
+        self.user.flags = ["permadelete"]
+        message = Message.objects.create(channel=self.channel, author=self.user)
+        with mock.patch("koru.gateway.events.publish") as publish, self.captureOnCommitCallbacks(execute=True):
+            delete_message(message)
+        self.assertFalse(Message.objects.filter(pk=message.pk).exists())
+        publish.assert_called_once_with(self.channel.pk, "MESSAGE_DELETE", {"id": message.pk, "channel_id": self.channel.pk})
+
+    def test_purging_a_user_purges_their_spaces_and_files(self):
+        import io
+        import os
+        import tempfile
+        from datetime import timedelta
+        from django.test import override_settings
+        from django.utils import timezone
+        from .models import Attachment
+        from .purge import purge_users
+        from .uploads import stream_upload
+        member = User.objects.create(email="purge-member@koru.test", username="purge-member")
+        elsewhere = Space.objects.create(name="Elsewhere", owner=member)
+        other_channel = Channel.objects.create(space=elsewhere, name="general")
+        in_own_space = Message.objects.create(channel=self.channel, author=member)
+        kept = Message.objects.create(channel=other_channel, author=member)
+        sent = Message.objects.create(channel=other_channel, author=self.user)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = {"BACKEND": "django.core.files.storage.FileSystemStorage", "OPTIONS": {"location": tmp}}
+            with override_settings(STORAGES={"default": storage, "attachments": storage}):
+                files = [
+                    stream_upload(io.BytesIO(b"sent"), "sent.txt", "text/plain", uploader=self.user, message=sent),
+                    stream_upload(io.BytesIO(b"pending"), "pending.txt", "text/plain", uploader=self.user),
+                    stream_upload(io.BytesIO(b"theirs"), "theirs.txt", "text/plain", uploader=member, message=in_own_space),
+                ]
+                User.objects.filter(pk=self.user.pk).update(deleted=True, deleted_at=timezone.now() - timedelta(days=31))
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.assertEqual(purge_users(), 1)
+                self.assertFalse(any(os.path.exists(os.path.join(tmp, f.path)) for f in files))
+
+        self.assertFalse(Space.objects.filter(pk=self.space.pk).exists())
+        self.assertFalse(Message.objects.filter(pk__in=[in_own_space.pk, sent.pk]).exists())
+        self.assertTrue(Message.objects.filter(pk=kept.pk).exists())
+        self.assertFalse(Attachment.objects.exists())
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(email="search-owner@koru.test", username="search-owner")
+        cls.outsider = User.objects.create(email="search-outsider@koru.test", username="search-outsider")
+        cls.space = Space.objects.create(name="Space", owner=cls.owner)
+        cls.channel = Channel.objects.create(space=cls.space, name="general")
+
+    def test_index_follows_saves_and_respects_access(self):
+        from .search import search_messages
+        with self.captureOnCommitCallbacks(execute=True):
+            hit = Message.objects.create(channel=self.channel, author=self.owner, content="the quick brown fox")
+            Message.objects.create(channel=self.channel, author=self.owner, content="something else")
+        self.assertEqual(search_messages(self.owner, "fox", space=self.space), [hit])
+        self.assertEqual(search_messages(self.outsider, "fox", space=self.space), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            hit.deleted = True
+            hit.save()
+        self.assertEqual(search_messages(self.owner, "fox", space=self.space), [])
+
+    def test_table_made_inside_a_transaction_is_checked_again(self):
+        from .search.sqlite import SQLiteFTSBackend
+        backend = SQLiteFTSBackend()
+        backend.setup()
+        # TestCase runs in a transaction that gets rolled back, so the table can't be assumed to stay
+        self.assertEqual(backend._ready, set())
+
+
+class RegistryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(email="registry@koru.test", username="registry")
+        cls.small = Space.objects.create(name="small", owner=cls.owner, space_registry_listed=True, member_count=5, server_tags=["Games"])
+        cls.big = Space.objects.create(name="big", owner=cls.owner, space_registry_listed=True, member_count=500, server_tags=["games", "art"])
+        cls.official = Space.objects.create(name="official", owner=cls.owner, space_registry_listed=True, server_official=True)
+        Space.objects.create(name="unlisted", owner=cls.owner, member_count=10000, server_tags=["games"])
+
+    def test_ranking_tags_and_incremental_refresh(self):
+        from .registry import discover, get_index, refresh_spaces
+        get_index().rebuild()
+        self.assertEqual(discover()[0], [self.official, self.big, self.small])
+        self.assertEqual(discover(tags=["games"]), ([self.big, self.small], 2))
+        self.assertEqual(discover(tags=["games", "art"])[0], [self.big])
+
+        Space.objects.filter(pk=self.small.pk).update(member_count=1000)
+        refresh_spaces([self.small.pk])
+        with self.assertNumQueries(1):
+            spaces, total = discover(tags=["games"], per_page=1)
+        self.assertEqual((spaces, total), ([self.small], 2))
+
+    def test_only_one_thread_rebuilds_a_stale_index(self):
+        import threading
+        from unittest import mock
+        from .registry import RegistryIndex
+        index = RegistryIndex()
+        index.built_at = 0  # built long ago
+        started, release = threading.Event(), threading.Event()
+        rebuilds = []
+
+        def slow_rebuild():
+            rebuilds.append(threading.current_thread())
+            started.set()
+            release.wait(5)
+
+        with mock.patch.object(index, "rebuild", side_effect=slow_rebuild):
+            rebuilder = threading.Thread(target=index.rebuild_if_stale, args=(60,))
+            rebuilder.start()
+            started.wait(5)
+            # Everyone else gets the old index straight away instead of rebuilding too
+            index.rebuild_if_stale(60)
+            release.set()
+            rebuilder.join()
+        self.assertEqual(rebuilds, [rebuilder])
+
+
+class RelationshipTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.a, cls.b, cls.c = (User.objects.create(email=f"rel{i}@koru.test", username=f"rel{i}") for i in range(3))
+
+    def test_blocks_and_friends_are_answered_from_memory(self):
+        from .models import Blocks, Friendship
+        from .relationships import are_friends, can_message, can_message_many
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.create(user1=self.a, user2=self.b)
+            block = Blocks.objects.create(blocker=self.c, blocked=self.a)
+
+        self.assertTrue(are_friends(self.b, self.a))
+        self.assertFalse(can_message(self.a, self.c))
+        self.assertEqual(can_message_many(self.a, [self.b, self.c]), {self.b.pk})
+        with self.assertNumQueries(0):
+            can_message(self.a, self.c)
+            can_message_many(self.a, [self.b, self.c])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            block.delete()
+        self.assertTrue(can_message(self.a, self.c))
+
+    def test_changes_made_by_other_processes_are_seen(self):
+        from django.core.cache import cache
+        from django.test import override_settings
+        from .models import Blocks
+        from .relationships import RelationshipGraph, can_message
+        self.assertTrue(can_message(self.b, self.c))
+
+        # Another process adds a block: nothing runs here except the shared stamps changing
+        with self.captureOnCommitCallbacks(execute=False):
+            Blocks.objects.create(blocker=self.b, blocked=self.c)
+        cache.set_many({"koru:relationships:blocks": "elsewhere", f"koru:relationships:{self.b.pk}": "elsewhere"}, None)
+        self.assertFalse(can_message(self.b, self.c))
+        self.assertFalse(can_message(self.c, self.b))
+
+        Blocks.objects.filter(blocker=self.b).delete()
+        cache.set(f"koru:relationships:{self.b.pk}", "elsewhere again", None)
+        self.assertTrue(can_message(self.b, self.c))
+
+        with override_settings(RELATIONSHIP_CACHE_USERS=2):
+            small = RelationshipGraph()
+            for user in (self.a, self.b, self.c):
+                small.friends(user.pk)
+            self.assertEqual(list(small._friends), [self.b.pk, self.c.pk])
+
+
+class InviteTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        from .models import SpaceRole
+        cls.owner = User.objects.create(email="invite-owner@koru.test", username="invite-owner")
+        cls.joiners = [User.objects.create(email=f"invitee{i}@koru.test", username=f"invitee{i}") for i in range(3)]
+        cls.space = Space.objects.create(name="Space", owner=cls.owner)
+        cls.role = SpaceRole.objects.create(space=cls.space, name="newbie")
+        cls.invite = Invite.objects.create(space=cls.space, inviter=cls.owner, max_uses=2)
+        cls.invite.roles_granted.add(cls.role)
+
+    def test_max_uses_is_enforced_and_roles_granted(self):
+        from .invites import redeem_invite
+        from .models import UserRoleAssignment
+        redeem_invite(self.joiners[0], self.invite.code)
+        redeem_invite(self.joiners[0], self.invite.code)  # already a member, doesn't count
+        redeem_invite(self.joiners[1], self.invite.code)
+        with self.assertRaises(ValidationError):
+            redeem_invite(self.joiners[2], self.invite.code)
+
+        self.invite.refresh_from_db()
+        self.assertEqual(self.invite.uses, 2)
+        self.assertEqual(set(self.space.members.values_list("pk", flat=True)), {self.joiners[0].pk, self.joiners[1].pk})
+        self.assertEqual(UserRoleAssignment.objects.filter(role=self.role).count(), 2)
+
+    def test_a_redemption_that_loses_the_race_to_join_counts_nothing(self):
+        from unittest import mock
+        from . import counters
+        from .invites import redeem_invite
+        counters._pending.clear()
+        self.space.members.through.objects.create(space=self.space, user=self.joiners[0])
+        # As if another redemption by the same user got in between the membership check and the INSERT
+        with mock.patch("core.invites._is_member", return_value=False), self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(redeem_invite(self.joiners[0], self.invite.code), self.space.pk)
+
+        self.invite.refresh_from_db()
+        self.assertEqual(self.invite.uses, 0)
+        self.assertEqual(self.space.members.count(), 1)
+        self.assertEqual(dict(counters._pending), {})
+
+    def test_a_rejected_redemption_leaves_no_membership(self):
+        from . import counters
+        from .invites import redeem_invite
+        counters._pending.clear()
+        Invite.objects.filter(pk=self.invite.pk).update(uses=2)
+        with self.captureOnCommitCallbacks(execute=True), self.assertRaises(ValidationError):
+            redeem_invite(self.joiners[0], self.invite.code)
+        self.assertFalse(self.space.members.exists())
+        self.assertEqual(dict(counters._pending), {})
+
+
+class UploadTests(TestCase):
+    def setUp(self):
+        import tempfile
+        from django.test import override_settings
+        self.tmp = tempfile.TemporaryDirectory()
+        storage = {"BACKEND": "django.core.files.storage.FileSystemStorage", "OPTIONS": {"location": self.tmp.name}}
+        self.settings_override = override_settings(STORAGES={"default": storage, "attachments": storage}, MAX_UPLOAD_SIZE=1024 * 1024)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmp.cleanup()
+
+    def test_stream_upload_hashes_on_the_fly(self):
+        import hashlib
+        import io
+        from .uploads import stream_upload
+        body = b"koru" * 100000
+        attachment = stream_upload(io.BytesIO(body), "notes.txt", "text/plain")
+        self.assertEqual(attachment.size, len(body))
+        self.assertEqual(attachment.sha256, hashlib.sha256(body).hexdigest())
+        with open(f"{self.tmp.name}/{attachment.path}", "rb") as f:
+            self.assertEqual(f.read(), body)
+
+    def test_oversized_uploads_are_cleaned_up(self):
+        import io
+        import os
+        from .models import Attachment
+        from .uploads import stream_upload
+        with self.assertRaises(ValidationError):
+            stream_upload(io.BytesIO(b"x" * (1024 * 1024 + 1)), "big.bin", "application/octet-stream")
+        self.assertFalse(Attachment.objects.exists())
+        self.assertEqual([f for _, _, files in os.walk(self.tmp.name) for f in files], [])
+
+
+class FakeS3Storage(FileSystemStorage):
+    """Local stand-in for an S3 storage: files land on disk, and presigned URLs are recorded instead of signed."""
+    bucket_name = "koru-test"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.presigned = []
+        client = SimpleNamespace(generate_presigned_url=self._presign)
+        self.bucket = SimpleNamespace(meta=SimpleNamespace(client=client))
+
+    def _presign(self, method, Params, ExpiresIn):
+        self.presigned.append((method, Params, ExpiresIn))
+        return f"https://{Params['Bucket']}.s3.test/{Params['Key']}"
+
+
+class PresignedUploadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email="presign@koru.test", username="presign")
+        cls.other = User.objects.create(email="presign-other@koru.test", username="presign-other")
+
+    def setUp(self):
+        import tempfile
+        from django.core.files.storage import storages
+        from django.test import override_settings
+        self.tmp = tempfile.TemporaryDirectory()
+        storage = {"BACKEND": "core.tests.FakeS3Storage", "OPTIONS": {"location": self.tmp.name}}
+        self.settings_override = override_settings(STORAGES={"default": storage, "attachments": storage}, MAX_UPLOAD_SIZE=1024)
+        self.settings_override.enable()
+        self.storage = storages["attachments"]
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmp.cleanup()
+
+    def _upload(self, body):
+        """Presign an upload of body. Returns the presign response and a function that does the client's PUT."""
+        import hashlib
+        from .uploads import create_presigned_upload
+        presigned = create_presigned_upload(self.user, "notes.txt", "text/plain", len(body), hashlib.sha256(body).hexdigest())
+        return presigned, lambda content=body: self._put(content)
+
+    def _put(self, content):
+        import os
+        # The presigned key is the storage's location plus the name
+        key = self.storage.presigned[-1][1]["Key"]
+        self.storage.save(os.path.relpath(key, self.storage.location), ContentFile(content))
+
+    def test_presigned_url_pins_what_was_declared(self):
+        import base64
+        import hashlib
+        presigned, _ = self._upload(b"koru")
+        method, params, ttl = self.storage.presigned[0]
+        self.assertEqual(method, "put_object")
+        self.assertEqual(params["ContentType"], "text/plain")
+        self.assertEqual(params["ContentLength"], 4)
+        self.assertEqual(params["ChecksumSHA256"], base64.b64encode(hashlib.sha256(b"koru").digest()).decode())
+        self.assertEqual(presigned["url"], f"https://koru-test.s3.test/{params['Key']}")
+        self.assertEqual(presigned["expires_in"], ttl)
+
+    def test_oversized_uploads_are_refused_up_front(self):
+        from .uploads import create_presigned_upload
+        with self.assertRaises(ValidationError):
+            create_presigned_upload(self.user, "big.bin", "application/octet-stream", 1025, "00" * 32)
+        self.assertEqual(self.storage.presigned, [])
+
+    def test_confirm_records_the_upload_once(self):
+        from .models import Attachment
+        from .uploads import confirm_presigned_upload
+        presigned, put = self._upload(b"koru")
+        with self.assertRaises(ValidationError):
+            confirm_presigned_upload(self.user, presigned["token"])  # not uploaded yet
+        put()
+        with self.assertRaises(ValidationError):
+            confirm_presigned_upload(self.other, presigned["token"])
+
+        attachment = confirm_presigned_upload(self.user, presigned["token"])
+        self.assertEqual(confirm_presigned_upload(self.user, presigned["token"]), attachment)
+        self.assertEqual(Attachment.objects.count(), 1)
+        self.assertEqual((attachment.filename, attachment.size, attachment.uploader_id), ("notes.txt", 4, self.user.pk))
+
+    def test_confirm_checks_the_stored_size(self):
+        from .uploads import confirm_presigned_upload
+        presigned, put = self._upload(b"koru")
+        put(b"koru koru")
+        with self.assertRaises(ValidationError):
+            confirm_presigned_upload(self.user, presigned["token"])
+
+    def test_paths_are_unique(self):
+        from django.db import IntegrityError, transaction
+        from .models import Attachment
+        fields = {"url": "https://cdn.koru.test/a", "filename": "a", "content_type": "text/plain", "size": 1}
+        Attachment.objects.create(**fields)
+        Attachment.objects.create(**fields)  # rows from before paths were recorded
+        Attachment.objects.create(path="attachments/1/a", **fields)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Attachment.objects.create(path="attachments/1/a", **fields)
+
+
+class AuditLogTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.mod = User.objects.create(email="audit@koru.test", username="audit")
+        cls.space = Space.objects.create(name="Space", owner=cls.mod)
+
+    def setUp(self):
+        from . import audit
+        audit._buffer.clear()
+
+    def test_entries_are_buffered_until_commit_and_paged(self):
+        from unittest import mock
+        from .audit import flush_audit_log, get_audit_log, log_action
+        from .models import AuditLogEntry
+        # Keep the background flusher out of it so the test decides when things get written
+        with mock.patch("core.audit._flusher"), self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(0):
+            for i in range(5):
+                log_action(self.space, "ban" if i % 2 else "kick", performed_by=self.mod, details={"n": i})
+        # Reading doesn't write anything on the way; entries show up once the flusher has run
+        self.assertEqual(get_audit_log(self.space), [])
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(flush_audit_log(), 5)
+        # One INSERT for the lot (plus the savepoint around it, since the test runs in a transaction)
+        self.assertEqual(sum(q["sql"].startswith("INSERT") for q in queries), 1)
+
+        page = get_audit_log(self.space, limit=2)
+        self.assertEqual([e.details["n"] for e in page], [4, 3])
+        self.assertEqual([e.details["n"] for e in get_audit_log(self.space, before=page[-1].id)], [2, 1, 0])
+        self.assertEqual([e.details["n"] for e in get_audit_log(self.space, action="ban")], [3, 1])
+        self.assertEqual(AuditLogEntry.objects.count(), 5)
+
+    def test_rejected_entries_are_dropped_and_the_buffer_is_capped(self):
+        from django.test import override_settings
+        from . import audit
+        from .audit import _enqueue, flush_audit_log
+        from .models import AuditLogEntry
+        written = AuditLogEntry.objects.create(space=self.space, action="kick")
+        duplicate = AuditLogEntry(id=written.pk, space=self.space, action="kick")
+        _enqueue([duplicate, AuditLogEntry(space=self.space, action="ban")])
+        self.assertEqual(flush_audit_log(), 1)
+        self.assertEqual(audit._buffer, [])
+        self.assertEqual(AuditLogEntry.objects.count(), 2)
+
+        with override_settings(AUDIT_LOG_MAX_BUFFER=3):
+            _enqueue([AuditLogEntry(space=self.space, action="kick", details={"n": i}) for i in range(5)])
+        self.assertEqual([e.details["n"] for e in audit._buffer], [2, 3, 4])
+
+
+class GatewayTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email="gateway@koru.test", username="gateway")
+        cls.space = Space.objects.create(name="Space", owner=cls.user)
+        cls.channel = Channel.objects.create(space=cls.space, name="general")
+
+    def test_message_events_are_published_on_commit(self):
+        from unittest import mock
+        with mock.patch("koru.gateway.events.get_pubsub") as get_pubsub:
+            with self.captureOnCommitCallbacks(execute=True):
+                message = Message.objects.create(channel=self.channel, author=self.user, content="hi")
+            with self.captureOnCommitCallbacks(execute=True):
+                message.content = "edited"
+                message.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                message.delete()
+        calls = get_pubsub.return_value.publish.call_args_list
+        self.assertEqual({c.args[0] for c in calls}, {f"channel:{self.channel.pk}"})
+        self.assertEqual([c.args[1]["t"] for c in calls], ["MESSAGE_CREATE", "MESSAGE_UPDATE", "MESSAGE_DELETE"])
+        self.assertEqual(calls[1].args[1]["d"]["content"], "edited")
+
+    def test_queued_events_are_coalesced_and_batched(self):
+        import asyncio
+        import json
+        from koru.gateway.connection import GatewayConnection
+        from koru.gateway.pubsub import InProcessPubSub
+
+        frames = []
+
+        async def send(message):
+            frames.append([(e["t"], e["d"]["id"]) for e in json.loads(message["text"])])
+
+        async def run():
+            pubsub = InProcessPubSub()
+            connection = GatewayConnection(send, batch_size=2)
+            pubsub.subscribe("channel:1", connection.push)
+            for kind, message_id in (
+                ("MESSAGE_CREATE", "1"), ("MESSAGE_UPDATE", "1"),
+                ("MESSAGE_UPDATE", "2"), ("MESSAGE_UPDATE", "2"),
+                ("MESSAGE_CREATE", "3"), ("MESSAGE_DELETE", "3"),
+                ("MESSAGE_DELETE", "4"),
+            ):
+                pubsub.publish("channel:1", {"t": kind, "d": {"id": message_id}})
+            sender = asyncio.create_task(connection.run())
+            await asyncio.sleep(0.01)
+            connection.close()
+            await sender
+
+        asyncio.run(run())
+        self.assertEqual(frames, [
+            [("MESSAGE_CREATE", "1"), ("MESSAGE_UPDATE", "2")],
+            [("MESSAGE_DELETE", "4")],
+        ])
+
+
+class ReadStateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(email="author@koru.test", username="author")
+        cls.readers = User.objects.bulk_create(
+            User(email=f"reader{i}@koru.test", username=f"reader{i}") for i in range(20)
+        )
+        cls.space = Space.objects.create(name="Space", owner=cls.author)
+        cls.channel = Channel.objects.create(space=cls.space, name="general")
+
+    def setUp(self):
+        from . import readstate
+        readstate._pending_acks.clear()
+
+    def test_mentions_are_one_bulk_update(self):
+        from .models import MessageReadState
+        from .readstate import record_mentions
+        with self.assertNumQueries(2):
+            record_mentions(self.channel.pk, [u.pk for u in self.readers])
+        record_mentions(self.channel.pk, [self.readers[0].pk])
+        counts = dict(MessageReadState.objects.values_list("user_id", "mention_count"))
+        self.assertEqual(len(counts), 20)
+        self.assertEqual(counts[self.readers[0].pk], 2)
+        self.assertEqual(counts[self.readers[1].pk], 1)
+
+    def test_acks_are_coalesced_and_only_move_forward(self):
+        from unittest import mock
+        from .models import MessageReadState
+        from .readstate import ack, flush_acks, unread_summary
+        reader = self.readers[0]
+        with mock.patch("core.readstate._flusher"), self.captureOnCommitCallbacks(execute=True):
+            first = Message.objects.create(channel=self.channel, author=self.author, content="one")
+            second = Message.objects.create(channel=self.channel, author=self.author, content="two")
+            second.mentions.add(reader)
+        Channel.objects.filter(pk=self.channel.pk).update(last_message=second)
+        self.assertEqual(unread_summary(reader)[0]["mention_count"], 1)
+
+        with mock.patch("core.readstate._flusher"), self.assertNumQueries(0):
+            ack(reader, self.channel, first.pk)
+            ack(reader, self.channel, second.pk)
+            ack(reader, self.channel, first.pk)
+        self.assertEqual(flush_acks(), 1)
+        state = MessageReadState.objects.get(user=reader, channel=self.channel)
+        self.assertEqual((state.last_read_message_id, state.mention_count), (second.pk, 0))
+
+        with mock.patch("core.readstate._flusher"):
+            ack(reader, self.channel, first.pk)
+        flush_acks()
+        state.refresh_from_db()
+        self.assertEqual(state.last_read_message_id, second.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(unread_summary(reader), [])
+
+    def test_acks_that_cannot_be_written_are_dropped(self):
+        from .models import MessageReadState
+        from . import readstate
+        from .readstate import ack, flush_acks
+        message = Message.objects.create(channel=self.channel, author=self.author, content="hi")
+        with self.assertRaises(ValidationError):
+            ack(self.readers[0], self.channel, "not-a-snowflake")
+        ack(self.readers[0], self.channel, 12345)
+        ack(self.readers[1], self.channel, int(message.pk))
+        self.assertEqual(flush_acks(), 1)
+        self.assertEqual(readstate._pending_acks, {})
+        self.assertEqual(
+            list(MessageReadState.objects.filter(last_read_message__isnull=False).values_list("user_id", flat=True)),
+            [self.readers[1].pk],
+        )
+
+    def test_a_flush_with_only_invalid_acks_touches_nothing(self):
+        from .models import MessageReadState
+        from .readstate import _unread_mentions, ack, flush_acks
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.create(channel=self.channel, author=self.author, content="hi")
+            message.mentions.add(self.readers[0], self.readers[1])
+        ack(self.readers[2], self.channel, 12345)
+        with self.assertNumQueries(1):
+            self.assertEqual(flush_acks(), 0)
+        counts = dict(MessageReadState.objects.values_list("user_id", "mention_count"))
+        self.assertEqual(counts, {self.readers[0].pk: 1, self.readers[1].pk: 1})
+
+        # Nothing read yet means every mention is unread
+        MessageReadState.objects.update(mention_count=0)
+        MessageReadState.objects.update(mention_count=_unread_mentions())
+        self.assertEqual(set(MessageReadState.objects.values_list("mention_count", flat=True)), {1})
+
+
+class LastMessageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        from .models import DM, GroupDM
+        cls.user = User.objects.create(email="inbox@koru.test", username="inbox")
+        cls.friend = User.objects.create(email="friend@koru.test", username="friend")
+        cls.space = Space.objects.create(name="Space", owner=cls.user)
+        cls.dm_channel = Channel.objects.create(space=cls.space, name="dm", rdm=True)
+        cls.group_channel = Channel.objects.create(space=cls.space, name="group", gdm=True)
+        DM.objects.create(user1=cls.user, user2=cls.friend, channel=cls.dm_channel)
+        group = GroupDM.objects.create(name="group", owner=cls.friend, channel=cls.group_channel)
+        group.members.add(cls.user, cls.friend)
+
+    def setUp(self):
+        from . import activity
+        activity._pending.clear()
+
+    def test_pointer_is_coalesced_and_only_moves_forward(self):
+        from unittest import mock
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .activity import flush_last_messages, record_last_message
+        messages = [Message.objects.create(channel=self.dm_channel, author=self.friend) for _ in range(3)]
+        with mock.patch("core.activity._flusher"):
+            for message in messages:
+                record_last_message(self.dm_channel.pk, message.pk)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(flush_last_messages(), 1)
+        self.assertEqual(sum(q["sql"].startswith("UPDATE") for q in queries.captured_queries), 1)
+        self.dm_channel.refresh_from_db()
+        self.assertEqual(self.dm_channel.last_message_id, messages[-1].pk)
+
+        with mock.patch("core.activity._flusher"):
+            record_last_message(self.dm_channel.pk, messages[0].pk)
+        flush_last_messages()
+        self.dm_channel.refresh_from_db()
+        self.assertEqual(self.dm_channel.last_message_id, messages[-1].pk)
+
+    def test_inbox_is_sorted_by_last_activity_in_one_query(self):
+        from unittest import mock
+        from .activity import flush_last_messages, inbox, record_last_message
+        with mock.patch("core.activity._flusher"):
+            record_last_message(self.dm_channel.pk, Message.objects.create(channel=self.dm_channel, author=self.friend).pk)
+            flush_last_messages()
+            with self.assertNumQueries(1):
+                self.assertEqual([c.pk for c in inbox(self.user)], [self.dm_channel.pk, self.group_channel.pk])
+
+            # Not flushed yet, but the inbox already knows about it
+            record_last_message(self.group_channel.pk, Message.objects.create(channel=self.group_channel, author=self.friend).pk)
+            with self.assertNumQueries(1):
+                self.assertEqual([c.pk for c in inbox(self.user)], [self.group_channel.pk, self.dm_channel.pk])
+            flush_last_messages()
+
+    def test_pointers_to_deleted_messages_are_dropped(self):
+        from unittest import mock
+        from . import activity
+        from .activity import flush_last_messages, record_last_message
+        kept = Message.objects.create(channel=self.group_channel, author=self.friend)
+        gone = Message.objects.create(channel=self.dm_channel, author=self.friend)
+        with mock.patch("core.activity._flusher"):
+            record_last_message(self.group_channel.pk, kept.pk)
+            record_last_message(self.dm_channel.pk, gone.pk)
+        # Deleted by some other process, which can't reach this one's pending pointers
+        with mock.patch("core.activity.forget_messages"):
+            gone.delete()
+        self.assertEqual(flush_last_messages(), 1)
+        self.assertEqual(activity._pending, {})
+        self.assertEqual(
+            dict(Channel.objects.filter(pk__in=[self.dm_channel.pk, self.group_channel.pk]).values_list("pk", "last_message_id")),
+            {self.dm_channel.pk: None, self.group_channel.pk: kept.pk},
+        )
+
+        # Deleting one here forgets its pending pointer straight away
+        latest = Message.objects.create(channel=self.dm_channel, author=self.friend)
+        with mock.patch("core.activity._flusher"):
+            record_last_message(self.dm_channel.pk, latest.pk)
+        latest.delete()
+        self.assertEqual(activity._pending, {})
+
+
+class ForwardingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email="forward@koru.test", username="forward")
+        cls.space = Space.objects.create(name="Space", owner=cls.user)
+        cls.channels = [Channel.objects.create(space=cls.space, name=f"c{i}") for i in range(4)]
+
+    def setUp(self):
+        from .forwarding import invalidate
+        invalidate()
+
+    def test_chains_are_followed_and_loops_refused(self):
+        from .forwarding import add_forwarder, forward_targets
+        from .models import ChannelForwarder
+        a, b, c, d = self.channels
+        add_forwarder(a, b)
+        add_forwarder(b, c)
+        with self.assertRaises(ValidationError):
+            add_forwarder(c, a)
+        # Even a loop that got in some other way can't send the walk round forever
+        ChannelForwarder.objects.create(source_channel=c, destination_channel=b)
+        self.assertEqual(forward_targets(a.pk), {b.pk, c.pk})
+        self.assertEqual(forward_targets(c.pk), {b.pk})
+        self.assertEqual(forward_targets(d.pk), set())
+
+    def test_copies_are_bulk_written_once_per_destination(self):
+        from unittest import mock
+        from .forwarding import _worker, add_forwarder
+        a, b, c, _ = self.channels
+        add_forwarder(a, b)
+        add_forwarder(a, c)
+        with mock.patch.object(_worker, "start"), self.captureOnCommitCallbacks(execute=True):
+            originals = [Message.objects.create(channel=a, author=self.user, content=str(i)) for i in range(3)]
+        with mock.patch.object(_worker, "start"):
+            _worker.enqueue(originals[0].pk)
+            self.assertEqual(_worker.drain(), 6)
+        self.assertEqual(_worker.drain(), 0)
+        copies = Message.objects.filter(forwarded_from__isnull=False)
+        self.assertEqual(
+            sorted(copies.values_list("forwarded_from__content", "channel_id")),
+            sorted((o.content, ch.pk) for o in originals for ch in (b, c)),
+        )
+
+    def test_copies_another_worker_wrote_first_are_not_announced(self):
+        from unittest import mock
+        from .forwarding import add_forwarder, deliver_forwards
+        a, b, c, _ = self.channels
+        add_forwarder(a, b)
+        add_forwarder(a, c)
+        original = Message.objects.create(channel=a, author=self.user, content="hi")
+        real_bulk_create = Message.objects.bulk_create
+
+        def racing_bulk_create(objs, **kwargs):
+            # Another worker writes the copy into b between this one's check for existing copies and its INSERT
+            real_bulk_create([Message(channel=b, author=self.user, content="hi", forwarded_from=original)])
+            return real_bulk_create(objs, **kwargs)
+
+        with mock.patch("koru.gateway.events.message_created") as announced, mock.patch.object(Message.objects, "bulk_create", side_effect=racing_bulk_create):
+            self.assertEqual(deliver_forwards([original.pk]), 1)
+        self.assertEqual([call.args[0].channel_id for call in announced.call_args_list], [c.pk])
+        self.assertEqual(Message.objects.filter(forwarded_from=original, channel=b).count(), 1)
+
+    def test_forwarder_changes_elsewhere_are_seen(self):
+        from django.core.cache import cache
+        from .forwarding import forward_targets
+        from .models import ChannelForwarder
+        a, b, _, _ = self.channels
+        self.assertEqual(forward_targets(a.pk), set())
+        # Written by another process: no signal here, only the shared stamp changes
+        ChannelForwarder.objects.bulk_create([ChannelForwarder(source_channel=a, destination_channel=b)])
+        cache.set("koru:forwarders", "elsewhere", None)
+        self.assertEqual(forward_targets(a.pk), {b.pk})
+
+
+class EmojiTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email="emoji@koru.test", username="emoji")
+        cls.space = Space.objects.create(name="Space", owner=cls.user)
+
+    def setUp(self):
+        from .emoji import forget_space
+        forget_space(self.space.pk)
+
+    def test_tokens_resolve_from_the_cached_map(self):
+        from .emoji import get_emoji_map, resolve_emoji
+        from .models import CustomEmoji
+        koru = CustomEmoji.objects.create(space=self.space, name="koru", url="https://cdn.koru.test/koru.png")
+        CustomEmoji.objects.create(space=self.space, name="wave", url="https://cdn.koru.test/wave.png", available=False)
+        get_emoji_map(self.space)
+        with self.assertNumQueries(0):
+            found = resolve_emoji(self.space, "hi :koru: :nope: :wave::koru:")
+        self.assertEqual(set(found), {"koru", "wave"})
+        self.assertEqual(found["koru"].id, koru.pk)
+        self.assertFalse(found["wave"].available)
+
+    def test_changes_made_by_other_processes_are_seen(self):
+        from django.core.cache import cache
+        from .emoji import get_emoji_map
+        from .models import CustomEmoji
+        self.assertEqual(get_emoji_map(self.space)[1], {})
+        # Another process adds one: nothing is forgotten here, only the shared stamp changes
+        with self.captureOnCommitCallbacks(execute=False):
+            CustomEmoji.objects.create(space=self.space, name="koru", url="https://cdn.koru.test/koru.png")
+        self.assertEqual(get_emoji_map(self.space)[1], {})
+        cache.set(f"koru:emoji:{self.space.pk}", "elsewhere", None)
+        self.assertEqual(set(get_emoji_map(self.space)[1]), {"koru"})
+
+    def test_changes_since_a_version(self):
+        from .emoji import changes_since, delete_emoji
+        from .models import CustomEmoji
+        koru = CustomEmoji.objects.create(space=self.space, name="koru", url="https://cdn.koru.test/koru.png")
+        wave = CustomEmoji.objects.create(space=self.space, name="wave", url="https://cdn.koru.test/wave.png")
+        version = changes_since(self.space, 0)["version"]
+        self.assertEqual(changes_since(self.space, version)["emoji"], [])
+
+        wave.available = False
+        wave.save(update_fields=["available"])
+        delete_emoji(koru)
+        changes = changes_since(self.space, version)
+        self.assertFalse(changes["full"])
+        self.assertEqual(
+            [(e["name"], e["available"], e["deleted"]) for e in changes["emoji"]],
+            [("wave", False, False), ("koru", True, True)],
+        )
+
+        # Hard deletes leave nothing to diff against, so older clients get everything again
+        wave.delete()
+        changes = changes_since(self.space, changes["version"] - 1)
+        self.assertEqual((changes["full"], changes["emoji"]), (True, []))
+
+
+class GroupMentionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        from .models import SpaceRole, UserRoleAssignment
+        cls.owner = User.objects.create(email="mention-owner@koru.test", username="mention-owner")
+        cls.members = User.objects.bulk_create(
+            User(email=f"mention{i}@koru.test", username=f"mention{i}") for i in range(4)
+        )
+        cls.space = Space.objects.create(name="Space", owner=cls.owner)
+        cls.space.members.add(cls.owner, *cls.members)
+        cls.channel = Channel.objects.create(space=cls.space, name="general")
+        SpaceRole.objects.create(
+            space=cls.space, name="everyone", default_role=True, permissions={"view_channels": True, "send_messages": True},
+        )
+        cls.team = SpaceRole.objects.create(space=cls.space, name="team", mentionable_by_everyone=True)
+        cls.staff = SpaceRole.objects.create(space=cls.space, name="staff")
+        for user in cls.members[:2]:
+            UserRoleAssignment.objects.create(user=user, space=cls.space, role=cls.team)
+
+    def test_only_allowed_mentions_are_kept(self):
+        from .mentions import allowed_mentions
+        self.assertEqual(
+            allowed_mentions(self.members[0], self.channel, [self.team.pk, self.staff.pk], everyone=True),
+            ([self.team.pk], False),
+        )
+        roles, everyone = allowed_mentions(self.owner, self.channel, [self.team.pk, self.staff.pk], everyone=True)
+        self.assertEqual((sorted(roles), everyone), (sorted([self.team.pk, self.staff.pk]), True))
+
+    def test_expansion_happens_in_the_background_in_chunks(self):
+        from unittest import mock
+        from .mentions import _worker, expand_mentions, set_group_mentions
+        from .models import MessageReadState
+        message = Message(channel=self.channel, author=self.owner, content="hey @team and @everyone")
+        set_group_mentions(message, [self.team.pk])
+        with mock.patch.object(_worker, "start"), self.captureOnCommitCallbacks(execute=True):
+            message.save()
+        self.assertFalse(message.mentions.exists())
+
+        with mock.patch("core.mentions.CHUNK_SIZE", 1):
+            self.assertEqual(_worker.drain(), 2)
+        self.assertEqual(set(message.mentions.values_list("pk", flat=True)), {u.pk for u in self.members[:2]})
+
+        # Expanding @everyone afterwards only reaches the people not already mentioned
+        Message.objects.filter(pk=message.pk).update(mention_everyone=True)
+        self.assertEqual(expand_mentions(message.pk), 2)
+        counts = dict(MessageReadState.objects.filter(channel=self.channel).values_list("user_id", "mention_count"))
+        self.assertEqual(counts, {u.pk: 1 for u in self.members})
+
+
+class BulkBanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .models import SpaceMember, SpaceRole, UserRoleAssignment
+        cls.owner = User.objects.create(email="ban-owner@koru.test", username="ban-owner")
+        cls.regular = User.objects.create(email="regular@koru.test", username="regular")
+        cls.raiders = User.objects.bulk_create(
+            User(email=f"raider{i}@koru.test", username=f"raider{i}") for i in range(5)
+        )
+        cls.space = Space.objects.create(name="Space", owner=cls.owner)
+        cls.channel = Channel.objects.create(space=cls.space, name="general")
+        cls.role = SpaceRole.objects.create(space=cls.space, name="member")
+        cls.raid_started = timezone.now() - timedelta(minutes=5)
+        SpaceMember.objects.create(space=cls.space, user=cls.owner, joined_at=cls.raid_started - timedelta(days=30))
+        SpaceMember.objects.create(space=cls.space, user=cls.regular, joined_at=cls.raid_started - timedelta(days=3))
+        for raider in cls.raiders:
+            SpaceMember.objects.create(space=cls.space, user=raider, joined_at=timezone.now())
+            UserRoleAssignment.objects.create(user=raider, space=cls.space, role=cls.role)
+            Message.objects.create(channel=cls.channel, author=raider, content="spam")
+        cls.kept = Message.objects.create(channel=cls.channel, author=cls.regular, content="hi")
+
+    def setUp(self):
+        from . import audit, counters
+        audit._buffer.clear()
+        counters._pending.clear()
+
+    def test_join_window_ban_cleans_up_the_raid(self):
+        from unittest import mock
+        from .audit import flush_audit_log
+        from .bans import bulk_ban, is_banned
+        from .models import AuditLogEntry, SpaceBan, UserRoleAssignment
+        with mock.patch("core.counters._flusher"), mock.patch("core.audit._flusher"), \
+                mock.patch("core.search.remove_messages") as remove_messages:
+            with self.captureOnCommitCallbacks() as callbacks:
+                result = bulk_ban(self.space, joined_after=self.raid_started, banned_by=self.owner, reason="raid", purge_since=self.raid_started)
+            # The purged messages only leave the search index once the ban has committed
+            remove_messages.assert_not_called()
+            for callback in callbacks:
+                callback()
+        remove_messages.assert_called_once()
+        self.assertEqual(len(remove_messages.call_args.args[0]), 5)
+        self.assertEqual(result, {"banned": 5, "removed": 5, "messages_purged": 5})
+        self.assertEqual(set(self.space.members.values_list("pk", flat=True)), {self.owner.pk, self.regular.pk})
+        self.assertFalse(UserRoleAssignment.objects.filter(space=self.space).exists())
+        self.assertEqual(list(Message.objects.values_list("pk", flat=True)), [self.kept.pk])
+        self.assertEqual(SpaceBan.objects.filter(space=self.space, active=True).count(), 5)
+
+        flush_audit_log()
+        self.assertEqual(AuditLogEntry.objects.get(space=self.space).details["banned"], 5)
+
+        self.assertTrue(is_banned(self.raiders[0], self.space))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_banned(self.raiders[0], self.space))
+        self.assertFalse(is_banned(self.regular, self.space))
+
+    def test_ban_checks_are_cached_and_cleared(self):
+        from .bans import is_banned, unban
+        from .models import SpaceBan
+        self.assertFalse(is_banned(self.regular, self.space))
+        with self.captureOnCommitCallbacks(execute=True):
+            SpaceBan.objects.create(space=self.space, user=self.regular)
+        self.assertTrue(is_banned(self.regular, self.space))
+        with self.captureOnCommitCallbacks(execute=True):
+            unban(self.space, self.regular)
+        self.assertFalse(is_banned(self.regular, self.space))
+
+
+class CreatedBetweenTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email="range@koru.test", username="range")
+        cls.space = Space.objects.create(name="Space", owner=cls.user)
+        cls.channel = Channel.objects.create(space=cls.space, name="general")
+
+    def test_time_ranges_are_primary_key_ranges(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from koru.utils import snowflake_from_timestamp, timestamp_from_snowflake
+        now = timezone.now()
+        hour_ago = Message.objects.create(
+            channel=self.channel, author=self.user, id=snowflake_from_timestamp(now - timedelta(hours=1), upper=True)
+        )
+        recent = Message.objects.create(channel=self.channel, author=self.user)
+        self.assertLess(abs(timestamp_from_snowflake(recent.pk) - now), timedelta(seconds=5))
+
+        last_half_hour = Message.objects.created_between(now - timedelta(minutes=30), now + timedelta(minutes=1))
+        self.assertEqual(list(last_half_hour), [recent])
+        self.assertEqual(list(Message.objects.created_before(now - timedelta(minutes=30))), [hour_ago])
+        self.assertEqual(Message.objects.created_after(now - timedelta(hours=2)).count(), 2)
+
+
+class ArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email="archive@koru.test", username="archive")
+        cls.friend = User.objects.create(email="archive-friend@koru.test", username="archive-friend")
+        cls.space = Space.objects.create(name="Space", owner=cls.user)
+        cls.channel = Channel.objects.create(space=cls.space, name="general")
+
+    def setUp(self):
+        import tempfile
+        from django.test import override_settings
+        self.tmp = tempfile.TemporaryDirectory()
+        storage = {"BACKEND": "django.core.files.storage.FileSystemStorage", "OPTIONS": {"location": self.tmp.name}}
+        self.settings_override = override_settings(STORAGES={"default": storage, "archive": storage})
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmp.cleanup()
+
+    def test_old_months_move_to_segments_and_history_still_reads_them(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from koru.utils import snowflake_from_timestamp
+        from .archive import archive_messages
+        from .history import get_history
+        from .models import ArchiveSegment
+        now = timezone.now()
+        old = [
+            Message.objects.create(
+                channel=self.channel, author=self.user, content=f"old {i}",
+                id=snowflake_from_timestamp(now - timedelta(days=70, minutes=-i)),
+            )
+            for i in range(3)
+        ]
+        old[1].mentions.add(self.friend)
+        recent = Message.objects.create(channel=self.channel, author=self.user, content="new")
+        Channel.objects.filter(pk=self.channel.pk).update(last_message=recent)
+        self.channel.refresh_from_db()
+
+        self.assertEqual(archive_messages(older_than=timedelta(days=30), now=now), 3)
+        self.assertEqual(list(Message.objects.values_list("pk", flat=True)), [recent.pk])
+        self.assertEqual(ArchiveSegment.objects.get().message_count, 3)
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.archived_through, old[-1].pk)
+
+        page = get_history(self.channel)
+        self.assertEqual([m.pk for m in page], [recent.pk, old[2].pk, old[1].pk, old[0].pk])
+        self.assertEqual(page[2].content, "old 1")
+        self.assertEqual(page[2].author, self.user)
+        self.assertEqual(page[2].archived_mentions, [self.friend])
+        self.assertEqual(page[2].archived_files, [])
+        self.assertEqual([m.pk for m in get_history(self.channel, after=old[0].pk, limit=2)], [old[2].pk, old[1].pk])
+        self.assertEqual([m.pk for m in get_history(self.channel, around=old[1].pk, limit=3)], [old[2].pk, old[1].pk, old[0].pk])
+        # Nothing left in those months, so a second run is a no-op
+        self.assertEqual(archive_messages(older_than=timedelta(days=30), now=now), 0)
+
+    def _archive(self, *messages):
+        """Create (channel, author, content, reply_to) messages 70 days ago and archive them, with an upload each."""
+        import io
+        from datetime import timedelta
+        from django.utils import timezone
+        from koru.utils import snowflake_from_timestamp
+        from .archive import archive_messages
+        from .uploads import stream_upload
+        now = timezone.now()
+        created = []
+        for i, (channel, author, content, reply_to) in enumerate(messages):
+            message = Message.objects.create(
+                channel=channel, author=author, content=content, reply_to=reply_to and created[reply_to - 1],
+                id=snowflake_from_timestamp(now - timedelta(days=70, minutes=-i)),
+            )
+            stream_upload(io.BytesIO(content.encode()), f"{content}.txt", "text/plain", uploader=author, message=message)
+            created.append(message)
+        archive_messages(older_than=timedelta(days=30), now=now)
+        return created
+
+    def _stored(self):
+        import os
+        return sorted(os.path.relpath(os.path.join(root, f), self.tmp.name) for root, _, files in os.walk(self.tmp.name) for f in files)
+
+    def test_purging_a_user_removes_their_archived_messages(self):
+        from datetime import timedelta
+        from unittest import mock
+        from django.utils import timezone
+        from .history import get_history
+        from .models import ArchiveSegment
+        from .purge import purge_users
+        quiet = Channel.objects.create(space=self.space, name="quiet")
+        mine, theirs, reply, _ = self._archive(
+            (self.channel, self.user, "mine", None),
+            (self.channel, self.friend, "theirs", None),
+            (self.channel, self.user, "reply", 2),
+            (quiet, self.friend, "alone", None),
+        )
+        before = self._stored()
+        kept_segment = ArchiveSegment.objects.get(channel=self.channel)
+        self.assertEqual(set(kept_segment.authors.all()), {self.user, self.friend})
+
+        User.objects.filter(pk=self.friend.pk).update(deleted=True, deleted_at=timezone.now() - timedelta(days=31))
+        with mock.patch("koru.gateway.events.publish") as publish, self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(purge_users(), 1)
+
+        self.channel.refresh_from_db()
+        page = get_history(self.channel)
+        self.assertEqual([m.pk for m in page], [reply.pk, mine.pk])
+        self.assertIsNone(page[0].reply_to_id)
+        self.assertEqual(publish.call_count, 2)
+
+        # The quiet channel's segment had nothing else in it, so it's gone along with its file
+        self.assertFalse(ArchiveSegment.objects.filter(channel=quiet).exists())
+        kept_segment.refresh_from_db()
+        self.assertEqual((kept_segment.message_count, set(kept_segment.authors.all())), (2, {self.user}))
+        self.assertEqual(len(kept_segment.upload_paths), 2)
+        after = self._stored()
+        self.assertEqual(set(after) - set(before), {kept_segment.path})
+        self.assertEqual(len(before) - len(after), 4 - 1)  # two segments and two uploads gone, one new segment
+
+    def test_deleting_an_archived_message_removes_it_from_the_archive(self):
+        from unittest import mock
+        from .history import get_history
+        from .purge import delete_message
+        first, second = self._archive((self.channel, self.user, "first", None), (self.channel, self.user, "second", None))
+        self.channel.refresh_from_db()
+        archived = get_history(self.channel)[0]
+        self.assertEqual((archived.pk, archived.archived), (second.pk, True))
+
+        with mock.patch("koru.gateway.events.publish") as publish, self.captureOnCommitCallbacks(execute=True):
+            delete_message(archived)
+        self.assertEqual([m.pk for m in get_history(self.channel)], [first.pk])
+        publish.assert_called_once_with(self.channel.pk, "MESSAGE_DELETE", {"id": second.pk, "channel_id": self.channel.pk})
+        self.assertFalse(any(name.endswith("second.txt") for name in self._stored()))
+
+    def test_segment_files_go_with_their_space(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .purge import purge_spaces
+        self._archive((self.channel, self.user, "old", None))
+        self.assertEqual(len(self._stored()), 2)
+        Space.objects.filter(pk=self.space.pk).update(deleted=True, deleted_at=timezone.now() - timedelta(days=31))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(purge_spaces(), 1)
+        self.assertEqual(self._stored(), [])
+
+
+class DatabaseRoutingTests(SimpleTestCase):
+    def test_reads_go_to_replicas_only_where_allowed(self):
+        from django.db import router
+        from django.test import override_settings
+        from koru.db import replica_reads
+        from users.models import UserProfile
+        with replica_reads():
+            self.assertEqual(router.db_for_read(Message), "default")
+        with override_settings(DATABASE_REPLICAS=["replica"]):
+            self.assertEqual(router.db_for_read(Message), "default")
+            self.assertEqual(router.db_for_read(UserProfile), "replica")
+            with replica_reads():
+                self.assertEqual(router.db_for_read(Message), "replica")
+            self.assertEqual(router.db_for_write(Message), "default")
+            self.assertFalse(router.allow_migrate("replica", "core"))
+
+    def test_writes_stick_the_user_to_the_primary(self):
+        from types import SimpleNamespace
+        from django.db import router
+        from django.test import RequestFactory, override_settings
+        from koru.db import StickyPrimaryMiddleware, is_sticky, replica_reads
+        user = SimpleNamespace(pk="sticky-user", is_authenticated=True)
+        reads = []
+
+        def view(request):
+            with replica_reads():
+                reads.append(router.db_for_read(Message))
+                if request.method == "POST":
+                    router.db_for_write(Message)
+                    reads.append(router.db_for_read(Message))
+
+        middleware = StickyPrimaryMiddleware(view)
+        with override_settings(DATABASE_REPLICAS=["replica"]):
+            request = RequestFactory().get("/")
+            request.user = user
+            middleware(request)
+            self.assertFalse(is_sticky(user.pk))
+
+            request = RequestFactory().post("/")
+            request.user = user
+            middleware(request)
+            self.assertTrue(is_sticky(user.pk))
+
+            request = RequestFactory().get("/")
+            request.user = user
+            middleware(request)
+        self.assertEqual(reads, ["replica", "replica", "default", "default"])
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    Real reads and writes through a primary and a replica that's lagging behind: a second SQLite database
+    that never gets the primary's rows. It isn't in DATABASES (the runner would set it up and check it like any
+    other), so the alias is only added once the class is set up, and connected to straight away.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        import tempfile
+        from django.db import connections
+        from .models import PurgeCheckpoint
+        super().setUpClass()
+        cls.replica_dir = tempfile.TemporaryDirectory()
+        connections.settings["replica"] = {**connections.settings["default"], "NAME": f"{cls.replica_dir.name}/replica.sqlite3"}
+        connections["replica"].connect()
+        with connections["replica"].schema_editor() as editor:
+            editor.create_model(PurgeCheckpoint)
+
+    @classmethod
+    def tearDownClass(cls):
+        from django.db import connections
+        connections["replica"].close()
+        del connections["replica"]
+        del connections.settings["replica"]
+        cls.replica_dir.cleanup()
+        super().tearDownClass()
+
+    def test_reads_after_a_write_in_the_same_request_go_to_the_primary(self):
+        from types import SimpleNamespace
+        from django.test import RequestFactory, override_settings
+        from koru.db import StickyPrimaryMiddleware, replica_reads
+        from .models import PurgeCheckpoint
+        seen = []
+
+        def view(request):
+            if request.method == "POST":
+                PurgeCheckpoint.objects.create(name="written")
+            with replica_reads():
+                seen.append(PurgeCheckpoint.objects.filter(name="written").exists())
+
+        def send(method, user_id):
+            request = getattr(RequestFactory(), method)("/")
+            request.user = SimpleNamespace(pk=user_id, is_authenticated=True)
+            StickyPrimaryMiddleware(view)(request)
+
+        with override_settings(DATABASE_REPLICAS=["replica"]):
+            send("post", "writer")
+            # Someone else reads from the replica, which hasn't got the row yet
+            send("get", "reader")
+            # The writer keeps reading from the primary for a while
+            send("get", "writer")
+        self.assertEqual(seen, [True, False, True])
+        self.assertFalse(PurgeCheckpoint.objects.using("replica").exists())
@@ -0,0 +1,187 @@
+import base64
+import hashlib
+import logging
+import posixpath
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.files import File
+from django.core.files.storage import InvalidStorageError, default_storage, storages
+from django.utils.text import get_valid_filename
+from koru.utils import snowflaker
+from .models import Attachment
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 8 * 1024 * 1024
+PRESIGNED_SALT = "koru.uploads.presigned"
+
+
+def max_upload_size() -> int:
+    return getattr(settings, "MAX_UPLOAD_SIZE", 25 * 1024 * 1024)
+
+
+def get_storage():
+    """The "attachments" entry in STORAGES if there is one, otherwise the default storage."""
+    try:
+        return storages["attachments"]
+    except InvalidStorageError:
+        return default_storage
+
+
+def delete_files(paths):
+    """Remove attachment files from storage. Failures are only logged, as the rows pointing at them are already gone."""
+    storage = get_storage()
+    for path in paths:
+        try:
+            storage.delete(path)
+        except Exception:
+            logger.exception("Couldn't delete attachment file %s", path)
+
+
+class HashingReader:
+    """
+    Read-only file-like wrapper that hashes and counts bytes as they go past, so the size and checksum
+    of an upload are known without ever holding the whole file. Refuses to read past max_size.
+    """
+
+    def __init__(self, stream, max_size: int):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = CHUNK_SIZE
+        data = self.stream.read(min(n, self.max_size + 1 - self.size))
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise ValidationError(f"Attachments can't be bigger than {self.max_size} bytes")
+        self._hash.update(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+
+def _storage_name(filename: str) -> str:
+    return posixpath.join("attachments", snowflaker(), get_valid_filename(filename) or "file")
+
+
+def stream_upload(stream, filename: str, content_type: str, uploader=None, message=None) -> Attachment:
+    """
+    Stream an upload into storage chunk by chunk and record it as an Attachment.
+
+    stream can be anything with read(n), including a Django request (as long as request.body/POST
+    haven't been touched). On S3 the storage's managed transfer turns the stream into a multipart upload.
+    """
+    storage = get_storage()
+    reader = HashingReader(stream, max_upload_size())
+    content = File(reader, name=filename)
+    content.content_type = content_type
+    name = _storage_name(filename)
+    try:
+        name = storage.save(name, content)
+    except Exception:
+        # Don't leave half an upload lying around (S3 aborts its own multipart uploads)
+        if storage.exists(name):
+            storage.delete(name)
+        raise
+    return Attachment.objects.create(
+        message=message,
+        uploader=uploader,
+        url=storage.url(name),
+        path=name,
+        filename=filename,
+        content_type=content_type,
+        size=reader.size,
+        sha256=reader.sha256,
+    )
+
+
+def stream_request_upload(request, uploader=None, message=None) -> Attachment:
+    """Upload the raw body of a PUT/POST. The filename comes from ?filename=, the type from Content-Type."""
+    filename = request.GET.get("filename") or "file"
+    content_type = request.content_type or "application/octet-stream"
+    return stream_upload(request, filename, content_type, uploader=uploader, message=message)
+
+
+def _s3_client(storage):
+    bucket = getattr(storage, "bucket", None)
+    if bucket is None:
+        raise ImproperlyConfigured("Direct uploads need an S3 attachments storage")
+    return bucket.meta.client
+
+
+def create_presigned_upload(uploader, filename: str, content_type: str, size: int, sha256: str) -> dict:
+    """
+    Hand out a presigned PUT URL so the client can upload straight to S3.
+
+    S3 itself enforces the size, type and SHA-256 the client declared here. Once the PUT is done the
+    client sends back the token with confirm_presigned_upload().
+    """
+    if size > max_upload_size():
+        raise ValidationError(f"Attachments can't be bigger than {max_upload_size()} bytes")
+    storage = get_storage()
+    client = _s3_client(storage)
+    name = _storage_name(filename)
+    key = posixpath.join(getattr(storage, "location", "") or "", name)
+    ttl = getattr(settings, "PRESIGNED_UPLOAD_TTL", 900)
+    url = client.generate_presigned_url(
+        "put_object",
+        Params={
+            "Bucket": storage.bucket_name,
+            "Key": key,
+            "ContentType": content_type,
+            "ContentLength": size,
+            "ChecksumSHA256": base64.b64encode(bytes.fromhex(sha256)).decode(),
+        },
+        ExpiresIn=ttl,
+    )
+    token = signing.dumps(
+        {"name": name, "filename": filename, "content_type": content_type, "size": size, "sha256": sha256,
+         "uploader": getattr(uploader, "pk", uploader)},
+        salt=PRESIGNED_SALT,
+    )
+    return {"url": url, "token": token, "expires_in": ttl}
+
+
+def confirm_presigned_upload(uploader, token: str, message=None) -> Attachment:
+    """Record a finished direct upload as an Attachment, after checking it really landed in storage."""
+    try:
+        data = signing.loads(token, salt=PRESIGNED_SALT, max_age=getattr(settings, "PRESIGNED_UPLOAD_TTL", 900) * 2)
+    except signing.BadSignature:
+        raise ValidationError("Invalid or expired upload token")
+    if data["uploader"] != getattr(uploader, "pk", uploader):
+        raise ValidationError("Invalid or expired upload token")
+
+    storage = get_storage()
+    try:
+        stored_size = storage.size(data["name"])
+    except Exception:
+        raise ValidationError("The upload hasn't finished yet")
+    if stored_size != data["size"]:
+        raise ValidationError("The uploaded file doesn't match what was declared")
+
+    # path is unique, so when two confirms race get_or_create hands the loser the winner's row
+    attachment, _ = Attachment.objects.get_or_create(
+        path=data["name"],
+        defaults={
+            "message": message,
+            "uploader_id": data["uploader"],
+            "url": storage.url(data["name"]),
+            "filename": data["filename"],
+            "content_type": data["content_type"],
+            "size": data["size"],
+            "sha256": data["sha256"],
+        },
+    )
+    return attachment
@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "koru.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up, the gateway pulls in models
+from koru.gateway import GatewayApp  # noqa: E402
+
+gateway_application = GatewayApp()
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket" and scope["path"].rstrip("/") == "/gateway":
+        return await gateway_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -0,0 +1,122 @@
+import random
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PRIMARY = DEFAULT_DB_ALIAS
+
+# Whether reads in the current context may go to a replica, see replica_reads()
+_replica_reads = ContextVar("koru_replica_reads", default=False)
+# The request being handled, if any: {"user_id": ..., "sticky": bool, "wrote": bool}
+_request = ContextVar("koru_db_request", default=None)
+
+_local = threading.local()
+
+
+def replicas() -> list[str]:
+    return list(getattr(settings, "DATABASE_REPLICAS", ()))
+
+
+def sticky_seconds() -> float:
+    return getattr(settings, "DATABASE_STICKY_SECONDS", 5)
+
+
+def _sticky_key(user_id):
+    return f"koru:db-sticky:{user_id}"
+
+
+def mark_written(user_id):
+    """Keep the user's reads on the primary for DATABASE_STICKY_SECONDS, so they see their own writes."""
+    if user_id is not None and replicas():
+        cache.set(_sticky_key(user_id), 1, sticky_seconds())
+
+
+def is_sticky(user_id) -> bool:
+    return user_id is not None and bool(cache.get(_sticky_key(user_id)))
+
+
+def _pinned() -> bool:
+    request = _request.get()
+    if request is not None and (request["sticky"] or request["wrote"]):
+        return True
+    # A transaction on the primary has to read its own uncommitted writes
+    return connections[PRIMARY].in_atomic_block
+
+
+@contextmanager
+def replica_reads():
+    """
+    Let reads inside this block go to a replica, unless the current user wrote something recently or we're
+    inside a transaction. Only wrap reads that can live with replication lag. Works as a decorator too.
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends every write to the primary, and reads to one of DATABASE_REPLICAS when they're inside
+    replica_reads() or are of a model in read_mostly. With no replicas configured everything stays
+    on the primary.
+    """
+
+    # (app label, model name) pairs that are read from replicas wherever the read comes from
+    read_mostly = {("users", "userprofile")}
+
+    def db_for_read(self, model, **hints):
+        aliases = replicas()
+        if not aliases:
+            return PRIMARY
+        if not (_replica_reads.get() or (model._meta.app_label, model._meta.model_name) in self.read_mostly):
+            return PRIMARY
+        if _pinned():
+            return PRIMARY
+        # Stay on one replica per thread so a page of results doesn't mix replicas that lag by different amounts
+        alias = getattr(_local, "replica", None)
+        if alias not in aliases:
+            alias = _local.replica = random.choice(aliases)
+        return alias
+
+    def db_for_write(self, model, **hints):
+        request = _request.get()
+        if request is not None:
+            request["wrote"] = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in replicas()
+
+
+class StickyPrimaryMiddleware:
+    """
+    Gives each request read-your-writes on top of PrimaryReplicaRouter: once a request writes, the rest of
+    it reads from the primary, and so do that user's requests for the next DATABASE_STICKY_SECONDS.
+    Goes after AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not replicas():
+            return self.get_response(request)
+        user = getattr(request, "user", None)
+        user_id = user.pk if user is not None and user.is_authenticated else None
+        state = {"user_id": user_id, "sticky": is_sticky(user_id), "wrote": False}
+        token = _request.set(state)
+        try:
+            return self.get_response(request)
+        finally:
+            _request.reset(token)
+            if state["wrote"]:
+                mark_written(user_id)
@@ -0,0 +1,2 @@
+from .app import GatewayApp, issue_token
+from .pubsub import BrokerPubSub, InProcessPubSub, LocalBroker, PubSub, get_pubsub
@@ -0,0 +1,103 @@
+import asyncio
+import json
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from .connection import GatewayConnection, SlowConsumer
+from .events import channel_topic
+from .pubsub import get_pubsub
+
+TOKEN_SALT = "koru.gateway"
+
+# Close codes sent to the client
+CLOSE_UNAUTHORIZED = 4001
+CLOSE_TOO_SLOW = 4008
+
+
+def issue_token(user) -> str:
+    """A short-lived token the client passes as ?token= when it opens the gateway."""
+    return signing.dumps({"u": getattr(user, "pk", user)}, salt=TOKEN_SALT)
+
+
+def authenticate(scope):
+    """The user id the connection's token belongs to, or None."""
+    token = parse_qs(scope.get("query_string", b"").decode()).get("token", [None])[0]
+    if not token:
+        return None
+    try:
+        data = signing.loads(token, salt=TOKEN_SALT, max_age=getattr(settings, "GATEWAY_TOKEN_TTL", 300))
+    except signing.BadSignature:
+        return None
+    return data.get("u")
+
+
+def subscribable_channel_ids(user_id) -> list[str]:
+    """Every channel the user should get events for: their DMs and group DMs, plus what they can see in their spaces."""
+    from core import permissions
+    from core.models import Space
+
+    channel_ids = list(permissions.private_channels(user_id).values_list("pk", flat=True))
+    for space in Space.objects.filter(members__id=user_id, deleted=False):
+        channel_ids.extend(channel.pk for channel in permissions.visible_channels(user_id, space))
+    return channel_ids
+
+
+class GatewayApp:
+    """
+    ASGI app for the realtime gateway websocket.
+
+    A connection is subscribed to its channels once, when it opens. Joining a space or gaining access to
+    a channel means reconnecting to pick it up.
+    """
+
+    def __init__(self, pubsub=None):
+        self._pubsub = pubsub
+
+    @property
+    def pubsub(self):
+        return self._pubsub or get_pubsub()
+
+    async def __call__(self, scope, receive, send):
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        user_id = authenticate(scope)
+        if user_id is None:
+            await send({"type": "websocket.close", "code": CLOSE_UNAUTHORIZED})
+            return
+        await send({"type": "websocket.accept"})
+
+        channel_ids = await sync_to_async(subscribable_channel_ids)(user_id)
+        connection = GatewayConnection(
+            send,
+            batch_size=getattr(settings, "GATEWAY_BATCH_SIZE", 100),
+            max_pending=getattr(settings, "GATEWAY_MAX_PENDING", 5000),
+        )
+        topics = [channel_topic(channel_id) for channel_id in channel_ids]
+        for topic in topics:
+            self.pubsub.subscribe(topic, connection.push)
+        connection.push({"t": "READY", "d": {"user_id": user_id, "channel_ids": channel_ids}})
+        sender = asyncio.create_task(connection.run())
+
+        try:
+            while not sender.done():
+                receiving = asyncio.ensure_future(receive())
+                await asyncio.wait([receiving, sender], return_when=asyncio.FIRST_COMPLETED)
+                if not receiving.done():
+                    receiving.cancel()
+                    break
+                message = receiving.result()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("text") and json.loads(message["text"]).get("t") == "PING":
+                    connection.push({"t": "PONG"})
+        finally:
+            for topic in topics:
+                self.pubsub.unsubscribe(topic, connection.push)
+            connection.close()
+
+        try:
+            await sender
+        except SlowConsumer:
+            await send({"type": "websocket.close", "code": CLOSE_TOO_SLOW})
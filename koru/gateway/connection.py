@@ -0,0 +1,84 @@
+import asyncio
+import itertools
+import json
+from collections import OrderedDict
+
+MESSAGE_CREATE = "MESSAGE_CREATE"
+MESSAGE_UPDATE = "MESSAGE_UPDATE"
+MESSAGE_DELETE = "MESSAGE_DELETE"
+
+_unique = itertools.count()
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+class GatewayConnection:
+    """
+    Outbound side of one gateway connection.
+
+    Events are queued and sent in batches (one frame holding a JSON list), so a client that falls behind
+    gets fewer, bigger frames instead of a growing backlog. While queued, events for the same message are
+    coalesced: several edits collapse into the latest, an edit to a message still waiting to be created
+    is folded into the create, and a delete cancels out anything still waiting for that message.
+    A client that still manages to fall max_pending events behind is disconnected.
+    """
+
+    def __init__(self, send, batch_size: int = 100, max_pending: int = 5000):
+        self.send = send
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending = OrderedDict()
+        self._wake = asyncio.Event()
+        self.closed = False
+        self.slow = False
+
+    def _key(self, event):
+        message_id = (event.get("d") or {}).get("id")
+        if event.get("t") in (MESSAGE_CREATE, MESSAGE_UPDATE, MESSAGE_DELETE) and message_id:
+            return ("message", message_id)
+        return ("event", next(_unique))
+
+    def push(self, event: dict):
+        if self.closed:
+            return
+        key = self._key(event)
+        queued = self._pending.get(key)
+        kind = event.get("t")
+        if queued is None:
+            self._pending[key] = event
+        elif kind == MESSAGE_DELETE:
+            if queued["t"] == MESSAGE_CREATE:
+                # The client never saw it, so it doesn't need to hear about it at all
+                del self._pending[key]
+            else:
+                self._pending[key] = event
+        elif kind == MESSAGE_UPDATE and queued["t"] == MESSAGE_CREATE:
+            self._pending[key] = {**event, "t": MESSAGE_CREATE}
+        else:
+            self._pending[key] = event
+
+        if len(self._pending) > self.max_pending:
+            self.slow = True
+            self.close()
+        self._wake.set()
+
+    def close(self):
+        self.closed = True
+        self._wake.set()
+
+    async def run(self):
+        """Sends queued events until the connection is closed. Raises SlowConsumer if the client fell too far behind."""
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            if self.slow:
+                raise SlowConsumer()
+            if self.closed:
+                return
+            while self._pending:
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popitem(last=False)[1])
+                await self.send({"type": "websocket.send", "text": json.dumps(batch)})
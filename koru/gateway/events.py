@@ -0,0 +1,39 @@
+import time
+from .connection import MESSAGE_CREATE, MESSAGE_DELETE, MESSAGE_UPDATE
+from .pubsub import get_pubsub
+
+
+def channel_topic(channel_id) -> str:
+    return f"channel:{channel_id}"
+
+
+def message_payload(message) -> dict:
+    return {
+        "id": message.pk,
+        "channel_id": message.channel_id,
+        "author_id": message.author_id,
+        "content": message.content,
+        "reply_to_id": message.reply_to_id,
+        "pinned": message.pinned_to_channel,
+        "edited_at": message.updated_at.isoformat() if message.updated_at else None,
+    }
+
+
+def publish(channel_id, kind: str, data: dict):
+    # "ts" is when the event was published, it lets clients (and the benchmark) see delivery lag
+    get_pubsub().publish(channel_topic(channel_id), {"t": kind, "d": data, "ts": time.time()})
+
+
+def message_created(message):
+    publish(message.channel_id, MESSAGE_CREATE, message_payload(message))
+
+
+def message_updated(message):
+    if message.deleted:
+        message_deleted(message.pk, message.channel_id)
+    else:
+        publish(message.channel_id, MESSAGE_UPDATE, message_payload(message))
+
+
+def message_deleted(message_id, channel_id):
+    publish(channel_id, MESSAGE_DELETE, {"id": message_id, "channel_id": channel_id})
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import threading
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class PubSub:
+    """
+    Topic based pub/sub the gateway fans events out through.
+
+    Subscribers are callbacks owned by an asyncio loop, and they're always called on that loop.
+    publish() can be called from any thread, including Django's sync views and signal handlers.
+    """
+
+    def subscribe(self, topic: str, callback, loop=None):
+        raise NotImplementedError
+
+    def unsubscribe(self, topic: str, callback):
+        raise NotImplementedError
+
+    def publish(self, topic: str, event: dict):
+        raise NotImplementedError
+
+
+class InProcessPubSub(PubSub):
+    """Single-node pub/sub: publishing hands the event straight to this process's subscribers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # topic -> {callback: loop}
+
+    def subscribe(self, topic, callback, loop=None):
+        loop = loop or asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers.setdefault(topic, {})[callback] = loop
+
+    def unsubscribe(self, topic, callback):
+        with self._lock:
+            subscribers = self._subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.pop(callback, None)
+                if not subscribers:
+                    del self._subscribers[topic]
+
+    def subscriber_count(self, topic) -> int:
+        return len(self._subscribers.get(topic, ()))
+
+    def _deliver(self, topic, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, {}).items())
+        # Group by loop so each loop is woken once per event rather than once per subscriber
+        by_loop = {}
+        for callback, loop in subscribers:
+            by_loop.setdefault(loop, []).append(callback)
+        for loop, callbacks in by_loop.items():
+            loop.call_soon_threadsafe(_call_all, callbacks, event)
+
+    def publish(self, topic, event):
+        self._deliver(topic, event)
+
+
+def _call_all(callbacks, event):
+    for callback in callbacks:
+        callback(event)
+
+
+class LocalBroker:
+    """
+    Stand-in for a network broker (Redis pub/sub and the like) so multi-node fan-out can be run and tested
+    in one process. Events are serialized on the way through, the same as they would be on the wire.
+    """
+
+    def __init__(self):
+        self._nodes = []
+
+    def attach(self, node: "BrokerPubSub"):
+        self._nodes.append(node)
+
+    def broadcast(self, topic, payload: str):
+        for node in list(self._nodes):
+            node._deliver(topic, json.loads(payload))
+
+
+_default_broker = LocalBroker()
+
+
+class BrokerPubSub(InProcessPubSub):
+    """One node of a multi-node setup. Publishing goes through the broker so every node's subscribers get it."""
+
+    def __init__(self, broker: LocalBroker = None):
+        super().__init__()
+        self.broker = broker or _default_broker
+        self.broker.attach(self)
+
+    def publish(self, topic, event):
+        self.broker.broadcast(topic, json.dumps(event))
+
+
+_pubsub = None
+
+
+def get_pubsub() -> PubSub:
+    global _pubsub
+    if _pubsub is None:
+        _pubsub = import_string(getattr(settings, "GATEWAY_PUBSUB", "koru.gateway.pubsub.InProcessPubSub"))()
+    return _pubsub
@@ -0,0 +1,36 @@
+import threading
+
+# Tiny in-process metrics registry. Nothing exports these yet; koructl and the workers print snapshot().
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timings = {}
+
+
+def incr(name: str, value: int = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name: str, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, seconds: float):
+    with _lock:
+        timing = _timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0})
+        timing["count"] += 1
+        timing["total"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+        timing["last"] = seconds
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timings": {name: dict(timing) for name, timing in _timings.items()},
+        }
@@ -53,6 +53,7 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "koru.db.StickyPrimaryMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "allauth.account.middleware.AccountMiddleware",
@@ -88,6 +89,19 @@ DATABASES = {
     }
 }
 
+# Aliases in DATABASES that are read replicas of "default". Writes always go to "default"; history, search,
+# registry and profile reads go to a replica (see koru.db). After a user writes, their reads stay on "default"
+# for DATABASE_STICKY_SECONDS so they see their own changes. That's tracked in the cache, so use a shared one
+# when running more than one process.
+# To try it locally, add a second alias with the same sqlite NAME as "default" and list it here.
+DATABASE_REPLICAS = []
+DATABASE_STICKY_SECONDS = 5
+DATABASE_ROUTERS = ["koru.db.PrimaryReplicaRouter"]
+
+# Every alias keeps its connections open for this many seconds (checked before reuse) unless it sets
+# CONN_MAX_AGE itself. For PostgreSQL, OPTIONS = {"pool": True} gives you a real pool instead.
+DATABASE_CONN_MAX_AGE = 60
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -120,6 +134,80 @@ USE_I18N = True
 USE_TZ = True
 
 
+# Snowflake IDs
+# Every process writing to the database needs its own (node, worker) pair or IDs can collide.
+# Leave these as None to fall back to the KORU_NODE_ID / KORU_WORKER_ID environment variables. The node defaults to 0,
+# but with no worker ID anywhere the first ID allocation fails unless DEBUG is on, where it's taken from the process ID.
+SNOWFLAKE_NODE_ID = None
+SNOWFLAKE_WORKER_ID = None
+
+# How often (in seconds) queued Space.member_count changes get written to the database
+MEMBER_COUNT_FLUSH_INTERVAL = 5
+
+# Soft-deleted messages, users and spaces are purged this many days after deletion.
+# Users with the permadelete flag have their messages purged immediately.
+PURGE_AFTER_DAYS = 30
+
+# Message search backend. The SQLite FTS5 one is for local/dev deployments.
+SEARCH_BACKEND = "core.search.sqlite.SQLiteFTSBackend"
+
+# Longest the in-process Space Registry index goes between full rebuilds (in seconds).
+# Changes to listed spaces are applied incrementally in between.
+REGISTRY_REBUILD_INTERVAL = 300
+
+# Size of the Bloom filter the relationship graph uses to skip block lookups for users who have never blocked
+# (or been blocked by) anyone. 2^23 bits is 1MiB.
+RELATIONSHIP_FILTER_BITS = 1 << 23
+
+# Friends and block sets are cached in each process for up to RELATIONSHIP_CACHE_USERS users. Like permissions,
+# changes are announced through version stamps in the shared cache.
+RELATIONSHIP_CACHE_USERS = 100000
+
+# Attachments
+# Uploads are stored through the "attachments" entry in STORAGES if you define one (e.g. an S3 bucket through
+# django-storages), otherwise the default storage.
+MAX_UPLOAD_SIZE = 25 * 1024 * 1024
+# How long (in seconds) a presigned direct-to-storage upload URL stays valid
+PRESIGNED_UPLOAD_TTL = 900
+
+# Audit log entries are buffered and written in batches of up to AUDIT_LOG_BATCH_SIZE,
+# at least every AUDIT_LOG_FLUSH_INTERVAL seconds. Entries older than AUDIT_LOG_RETENTION_DAYS get pruned.
+# If writes keep failing, at most AUDIT_LOG_MAX_BUFFER entries are held and the oldest are dropped after that.
+AUDIT_LOG_BATCH_SIZE = 500
+AUDIT_LOG_FLUSH_INTERVAL = 2
+AUDIT_LOG_MAX_BUFFER = 50000
+AUDIT_LOG_RETENTION_DAYS = 90
+
+# Buffered writes (member counts, audit log, read state, ...) and background queues run on daemon threads.
+# The test runner turns them off so tests flush explicitly.
+BACKGROUND_THREADS = True
+TEST_RUNNER = "koru.testing.KoruTestRunner"
+
+# Permission masks are cached in each process for up to PERMISSION_CACHE_SPACES spaces, and up to
+# PERMISSION_CACHE_ENTRIES_PER_SPACE members/channels within each. Changes are announced through version stamps
+# in the cache, so every process needs to share one (CACHES) for them to see each other's changes.
+PERMISSION_CACHE_SPACES = 10000
+PERMISSION_CACHE_ENTRIES_PER_SPACE = 10000
+
+# Read acks are held in memory and written at least every READ_STATE_FLUSH_INTERVAL seconds
+READ_STATE_FLUSH_INTERVAL = 1
+
+# Channel.last_message is written at least every LAST_MESSAGE_FLUSH_INTERVAL seconds instead of on every send
+LAST_MESSAGE_FLUSH_INTERVAL = 1
+
+# Realtime gateway. GATEWAY_PUBSUB is the pub/sub class events fan out through; a client more than
+# GATEWAY_MAX_PENDING events behind gets disconnected. Connection tokens are good for GATEWAY_TOKEN_TTL seconds.
+GATEWAY_PUBSUB = "koru.gateway.pubsub.InProcessPubSub"
+GATEWAY_BATCH_SIZE = 100
+GATEWAY_MAX_PENDING = 5000
+GATEWAY_TOKEN_TTL = 300
+
+# Whole months of messages older than ARCHIVE_AFTER_DAYS get moved out of the database into compressed segment
+# files by `koructl archive`. Segments go through the "archive" entry in STORAGES if you define one, otherwise
+# wherever attachments go.
+ARCHIVE_AFTER_DAYS = 180
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
@@ -145,18 +233,35 @@ except Exception:
     _incl = None
     print("koru_settings.py not found, using default settings - if you would like to use custom ones, please copy koru_settings-example.py to koru_settings.py and modify as needed.")
 
+def _merge(current: dict, incoming: dict):
+    # Dicts are merged all the way down, so overriding DATABASES["default"]["NAME"] keeps the rest of "default"
+    for key, value in incoming.items():
+        if isinstance(current.get(key), dict) and isinstance(value, dict):
+            _merge(current[key], value)
+        else:
+            current[key] = value
+
+
 if _incl is not None:
     for _name in dir(_incl):
         if not _name.isupper():
             continue
         _value = getattr(_incl, _name)
 
-        # If both current and incoming values are dicts, merge shallowly
+        # If both current and incoming values are dicts, merge them
         if _name in globals() and isinstance(globals()[_name], dict) and isinstance(_value, dict):
-            globals()[_name].update(_value)
+            _merge(globals()[_name], _value)
         else:
             # Otherwise replace/override the existing setting
             globals()[_name] = _value
 
     # cleanup temporary names
-    del _incl, _name, _value
\ No newline at end of file
+    del _incl, _name, _value
+
+for _alias, _database in DATABASES.items():
+    _database.setdefault("CONN_MAX_AGE", DATABASE_CONN_MAX_AGE)
+    _database.setdefault("CONN_HEALTH_CHECKS", True)
+    if _alias in DATABASE_REPLICAS:
+        # Tests run against "default" only, replicas just point at it
+        _database.setdefault("TEST", {}).setdefault("MIRROR", "default")
+del _alias, _database
\ No newline at end of file
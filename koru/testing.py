@@ -0,0 +1,26 @@
+import os
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class KoruTestRunner(DiscoverRunner):
+    """
+    The default runner, without background flusher and worker threads. Those would otherwise outlive the
+    test they were started in and keep querying (or flushing into) whatever database is there next.
+
+    Tests run with DEBUG off, so a snowflake worker ID is filled in when none is configured. Every test
+    process gets a database of its own, so any ID will do.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._background_threads = getattr(settings, "BACKGROUND_THREADS", True)
+        self._worker_id = getattr(settings, "SNOWFLAKE_WORKER_ID", None)
+        settings.BACKGROUND_THREADS = False
+        if self._worker_id is None and not os.environ.get("KORU_WORKER_ID"):
+            settings.SNOWFLAKE_WORKER_ID = 0
+
+    def teardown_test_environment(self, **kwargs):
+        settings.BACKGROUND_THREADS = self._background_threads
+        settings.SNOWFLAKE_WORKER_ID = self._worker_id
+        super().teardown_test_environment(**kwargs)
@@ -1,17 +1,350 @@
-from django.db import models
-from snowflakekit import SnowflakeGenerator, SnowflakeConfig
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, models, transaction
+from snowflakekit import SnowflakeConfig
 from django.forms import ValidationError
 
+SNOWFLAKE_EPOCH = 1767225600000  # January 1, 2026
+
+# Snowflakes are stored as strings, so they're zero-padded to the width of the largest 64-bit value.
+# That way sorting by id (as a string) is the same as sorting by time.
+SNOWFLAKE_WIDTH = 20
+
+# Layout: 39 bits of milliseconds since the epoch, then node, worker and sequence bits.
+# Everything below the timestamp is SNOWFLAKE_TIME_SHIFT bits wide.
+SNOWFLAKE_TIME_BITS = 39
+SNOWFLAKE_NODE_BITS = 5
+SNOWFLAKE_WORKER_BITS = 8
+SNOWFLAKE_TIME_SHIFT = 64 - SNOWFLAKE_TIME_BITS
+
+
+def _resolve_id(setting_name, env_name, bits):
+    value = getattr(settings, setting_name, None) if settings.configured else None
+    if value is None:
+        value = os.environ.get(env_name)
+    if value is None or value == "":
+        return None
+    value = int(value)
+    if not 0 <= value < 1 << bits:
+        raise ImproperlyConfigured(f"{setting_name} must be between 0 and {(1 << bits) - 1}, not {value}")
+    return value
+
+
+def _worker_id() -> int:
+    worker_id = _resolve_id("SNOWFLAKE_WORKER_ID", "KORU_WORKER_ID", SNOWFLAKE_WORKER_BITS)
+    if worker_id is not None:
+        return worker_id
+    if not (settings.configured and settings.DEBUG):
+        # Guessing here would mean two processes that guess the same can hand out the same IDs
+        raise ImproperlyConfigured(
+            "No snowflake worker ID configured. Give every process writing to the database its own "
+            "SNOWFLAKE_WORKER_ID (or KORU_WORKER_ID)."
+        )
+    # Fine for a development server, which is one process anyway
+    worker_id = os.getpid() % (1 << SNOWFLAKE_WORKER_BITS)
+    logging.getLogger(__name__).warning("No snowflake worker ID configured, using %d from the process ID", worker_id)
+    return worker_id
+
+
+class SnowflakeAllocator:
+    """
+    Thread-safe, monotonic snowflake allocator.
+
+    There should only ever be one of these per process (see get_snowflake_allocator()), and no two
+    processes writing to the same database should share a (node_id, worker_id) pair.
+    """
+
+    def __init__(self, config: SnowflakeConfig):
+        self.config = config
+        self._lock = threading.Lock()
+        self._last_ts = -1
+        self._sequence = 0
+        self._max_sequence = (1 << config.sequence_bits) - 1
+        self._time_shift = config.node_bits + config.worker_bits + config.sequence_bits
+        self._base = (config.node_id << (config.worker_bits + config.sequence_bits)) | (config.worker_id << config.sequence_bits)
+
+    def _now(self):
+        return time.time_ns() // 1_000_000
+
+    def _allocate(self, n):
+        ids = []
+        with self._lock:
+            while len(ids) < n:
+                ts = self._now()
+                if ts > self._last_ts:
+                    self._last_ts = ts
+                    self._sequence = 0
+                elif self._sequence > self._max_sequence:
+                    # Sequence is used up for this millisecond (or the clock went backwards and we ran out),
+                    # borrow the next one instead of waiting so IDs stay monotonic.
+                    self._last_ts += 1
+                    self._sequence = 0
+
+                take = min(n - len(ids), self._max_sequence + 1 - self._sequence)
+                prefix = ((self._last_ts - self.config.epoch) << self._time_shift) | self._base
+                ids.extend(range(prefix + self._sequence, prefix + self._sequence + take))
+                self._sequence += take
+        return ids
+
+    def next_id(self) -> int:
+        return self._allocate(1)[0]
+
+    def reserve(self, n: int) -> list[int]:
+        """Hand out a block of n increasing IDs in one go, for bulk_create paths."""
+        if n < 0:
+            raise ValueError("Cannot reserve a negative number of IDs")
+        return self._allocate(n)
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def get_snowflake_allocator() -> SnowflakeAllocator:
+    global _allocator
+    if _allocator is None:
+        with _allocator_lock:
+            if _allocator is None:
+                _allocator = SnowflakeAllocator(SnowflakeConfig(
+                    epoch=SNOWFLAKE_EPOCH,
+                    node_id=_resolve_id("SNOWFLAKE_NODE_ID", "KORU_NODE_ID", SNOWFLAKE_NODE_BITS) or 0,
+                    worker_id=_worker_id(),
+                    time_bits=SNOWFLAKE_TIME_BITS,
+                    node_bits=SNOWFLAKE_NODE_BITS,
+                    worker_bits=SNOWFLAKE_WORKER_BITS,
+                ))
+    return _allocator
+
+
+def _reset_allocator():
+    # A forked child must not keep using its parent's allocator state
+    global _allocator
+    _allocator = None
+
+
+os.register_at_fork(after_in_child=_reset_allocator)
+
+
+def background_threads() -> bool:
+    # Off under the test runner (see koru.testing), so tests decide when buffered work gets written
+    return getattr(settings, "BACKGROUND_THREADS", True)
+
+
+class PeriodicFlusher:
+    """
+    Calls flush() on a daemon thread every interval() seconds, and once more when the process exits.
+    Used by anything that buffers writes in memory. Started on first use with start().
+    """
+
+    def __init__(self, name: str, flush, interval):
+        self.name = name
+        self.flush = flush
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop = None
+
+    def start(self):
+        if self._stop is not None or not background_threads():
+            return
+        with self._lock:
+            if self._stop is None:
+                self._stop = threading.Event()
+                threading.Thread(target=self._loop, args=(self._stop,), name=self.name, daemon=True).start()
+                atexit.register(self.stop)
+
+    def _loop(self, stop):
+        while not stop.wait(self.interval()):
+            try:
+                self.flush()
+            except Exception:
+                # Whatever was buffered is kept, try again next round
+                logging.getLogger(__name__).exception("%s flush failed", self.name)
+
+    def stop(self):
+        with self._lock:
+            if self._stop is not None:
+                self._stop.set()
+                self._stop = None
+        self.flush()
+
+
+class BatchWorker:
+    """
+    Works through a queue on a daemon thread, started on first enqueue(). handle() gets up to batch_size
+    items at a time as (item, enqueued_at) pairs, enqueued_at being a time.monotonic() reading, and returns
+    a count that run_once() and drain() pass back.
+    """
+
+    def __init__(self, name: str, handle, batch_size: int = 100):
+        self.name = name
+        self.handle = handle
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or not background_threads():
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def enqueue(self, item):
+        self.queue.put((item, time.monotonic()))
+        self.start()
+
+    def _take_batch(self, block=True):
+        batch = [self.queue.get(block=block)]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run_once(self, block=True) -> int:
+        try:
+            batch = self._take_batch(block)
+        except queue.Empty:
+            return 0
+        return self.handle(batch)
+
+    def drain(self) -> int:
+        """Handle everything queued on the calling thread."""
+        total = 0
+        while not self.queue.empty():
+            total += self.run_once(block=False)
+        return total
+
+    def _loop(self):
+        while True:
+            try:
+                close_old_connections()
+                self.run_once()
+            except Exception:
+                logging.getLogger(__name__).exception("%s batch failed", self.name)
+
+
+def get_stamps(*keys) -> list[str]:
+    """
+    Version stamps for the given keys in the shared cache, in one round trip. Anything cached in-process is
+    only good while the stamp it was cached under is still current, which is how processes see each other's
+    changes. A key that has no stamp yet (or was evicted) gets a fresh one.
+    """
+    found = cache.get_many(keys)
+    stamps = []
+    for key in keys:
+        stamp = found.get(key)
+        if stamp is None:
+            # add() so processes racing to create the same stamp agree on one
+            stamp = uuid.uuid4().hex
+            if not cache.add(key, stamp, None):
+                stamp = cache.get(key) or stamp
+        stamps.append(stamp)
+    return stamps
+
+
+def bump_stamp(*keys):
+    """Give keys new stamps once the current transaction commits (or right away outside one)."""
+    transaction.on_commit(lambda: cache.set_many({key: uuid.uuid4().hex for key in keys}, None))
+
+
+def format_snowflake(value: int) -> str:
+    return str(value).zfill(SNOWFLAKE_WIDTH)
+
+
 def snowflaker():
-    config = SnowflakeConfig(
-        epoch=1767225600000,  # January 1, 2026
-        worker_id=2,
-        time_bits=39,
-        node_bits=5,
-        worker_bits=8
-    )
-    generator = SnowflakeGenerator(config)
-    return generator.generate()
+    return format_snowflake(get_snowflake_allocator().next_id())
+
+
+def reserve_snowflakes(n: int) -> list[str]:
+    return [format_snowflake(value) for value in get_snowflake_allocator().reserve(n)]
+
+
+def _epoch_ms(when) -> int:
+    # Datetimes without a timezone are taken to be UTC, numbers are unix time in seconds
+    if isinstance(when, datetime):
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=dt_timezone.utc)
+        return int(when.timestamp() * 1000)
+    return int(when * 1000)
+
+
+def snowflake_from_timestamp(when, upper: bool = False) -> str:
+    """
+    The lowest snowflake that could have been made at `when` (a datetime or unix time), or the highest with
+    upper=True. Every id made during that millisecond sorts between the two.
+    """
+    value = max(_epoch_ms(when) - SNOWFLAKE_EPOCH, 0) << SNOWFLAKE_TIME_SHIFT
+    if upper:
+        value |= (1 << SNOWFLAKE_TIME_SHIFT) - 1
+    return format_snowflake(value)
+
+
+def timestamp_from_snowflake(snowflake) -> datetime:
+    """When a snowflake was made, to the millisecond."""
+    ms = (int(snowflake) >> SNOWFLAKE_TIME_SHIFT) + SNOWFLAKE_EPOCH
+    return datetime.fromtimestamp(ms / 1000, tz=dt_timezone.utc)
+
+
+def snowflake_bounds(start=None, end=None) -> dict:
+    """
+    Lookups matching ids made in [start, end), for .filter(**snowflake_bounds(a, b)).
+    Either end can be None to leave that side open.
+    """
+    bounds = {}
+    if start is not None:
+        bounds["id__gte"] = snowflake_from_timestamp(start)
+    if end is not None:
+        bounds["id__lt"] = snowflake_from_timestamp(end)
+    return bounds
+
+
+def normalize_cursor(cursor) -> str | None:
+    """
+    Accept a snowflake as an int or a (possibly unpadded) string and return it in stored form.
+    A datetime becomes the lowest snowflake made at that time, so history and search can page by date too.
+    """
+    if cursor is None:
+        return None
+    if isinstance(cursor, datetime):
+        return snowflake_from_timestamp(cursor)
+    try:
+        value = int(cursor)
+    except (TypeError, ValueError):
+        raise ValidationError(f"Invalid message cursor: {cursor!r}")
+    if value < 0:
+        raise ValidationError(f"Invalid message cursor: {cursor!r}")
+    return format_snowflake(value)
+
+
+class ResourceQuerySet(models.QuerySet):
+    """
+    Time range filters that run as primary key range scans. Snowflakes sort by creation time, so these
+    don't need created_at (or an index on it) at all.
+    """
+
+    def created_between(self, start=None, end=None):
+        """Rows created in [start, end). Either end can be None."""
+        return self.filter(**snowflake_bounds(start, end))
+
+    def created_after(self, start):
+        return self.created_between(start, None)
+
+    def created_before(self, end):
+        return self.created_between(None, end)
+
 
 class ResourceModel(models.Model):
     id = models.CharField(max_length=64, primary_key=True, default=snowflaker, editable=False, unique=True)
@@ -22,14 +355,35 @@ class ResourceModel(models.Model):
     suspended = models.BooleanField(default=False)
     deleted = models.BooleanField(default=False)
 
+    objects = ResourceQuerySet.as_manager()
+
+    # The ID this instance was loaded or created with, so save() can check it without going back to the database
+    _loaded_id = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_id = instance.pk
+        return instance
+
     def save(self, *args, **kwargs):
         if not self.id:
             self.id = snowflaker()
         # If this entry is being updated we need to throw an error if the snowflake is being changed
-        elif self.pk and self.id != self.__class__.objects.get(pk=self.pk).id:
+        elif self._loaded_id is not None and self.id != self._loaded_id:
             raise ValidationError("ID cannot be changed once set.")
 
+        # auto_now is only applied to fields being saved, so partial saves need to bring updated_at along
+        update_fields = kwargs.get("update_fields")
+        if update_fields and not self._state.adding:
+            update_fields = set(update_fields)
+            if "id" in update_fields:
+                raise ValidationError("ID cannot be changed once set.")
+            update_fields.add("updated_at")
+            kwargs["update_fields"] = update_fields
+
         super().save(*args, **kwargs)
-    
+        self._loaded_id = self.pk
+
     class Meta:
-        abstract = True
\ No newline at end of file
+        abstract = True
@@ -1,7 +1,7 @@
 from django.db import models
+from django.utils import timezone
 from users.models import User
 from koru.utils import ResourceModel, snowflaker
-from .utils import recalc_standing, recalc_points
 
 # Create your models here.
 class UserViolation(ResourceModel):
@@ -23,12 +23,17 @@ class UserViolation(ResourceModel):
     deleted = None
 
     class Meta:
-        ordering = ['-created_at']
+        # Newest first. Snowflakes sort by creation time, so this rides the primary key instead of created_at
+        ordering = ['-id']
+        indexes = [
+            # Used by the expiry sweeper
+            models.Index(fields=["active", "expires_at"], name="violation_active_expiry_idx"),
+        ]
 
     def save(self, *args, **kwargs):
         if self.pk is None:
             pass
-        if self.pk and self.expires_at and self.expires_at < models.functions.Now():
+        if self.pk and self.expires_at and self.expires_at <= timezone.now():
             self.expired = True
             self.active = False
         if self.pk and self.active and self.expired:
@@ -36,8 +41,9 @@ class UserViolation(ResourceModel):
         if self.pk and self.appealed == True and self.appeal_status == 3:
             self.active = False
         super().save(*args, **kwargs)
-        recalc_points(self.user)
-        recalc_standing(self.user)
+        # utils imports this module, so this one has to be imported late
+        from .utils import schedule_standing_recompute
+        schedule_standing_recompute(self.user_id)
 
 
 class UserRecord(models.Model):
@@ -0,0 +1,94 @@
+import logging
+import time
+from django.db import transaction
+from django.utils import timezone
+from core.bans import forget_bans
+from core.models import Invite, SpaceBan
+from koru import metrics
+from .models import UserViolation
+from .utils import recompute_standings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def _expired_violations(now):
+    return UserViolation.objects.filter(active=True, expires_at__lte=now)
+
+
+def _expired_bans(now):
+    return SpaceBan.objects.filter(active=True, expires_at__lte=now)
+
+
+def _expired_invites(now):
+    return Invite.objects.filter(deleted=False, permanent=False, expires_at__lte=now)
+
+
+# name -> (queryset of expired rows, fields to set on them)
+SWEEPS = {
+    "violations": (_expired_violations, {"active": False, "expired": True}),
+    "bans": (_expired_bans, {"active": False}),
+    "invites": (_expired_invites, {"deleted": True}),
+}
+
+
+def sweep_kind(name: str, now=None, chunk_size: int = DEFAULT_CHUNK_SIZE, pause: float = 0) -> int:
+    """
+    Expire everything of one kind that's past its expires_at, chunk_size rows per UPDATE.
+    Violations also get their users' standings recomputed, once per chunk. Returns how many rows were expired.
+    """
+    get_queryset, changes = SWEEPS[name]
+    now = now or timezone.now()
+    started = time.perf_counter()
+
+    backlog = get_queryset(now).count()
+    metrics.gauge(f"sweeper.{name}.backlog", backlog)
+
+    total = 0
+    while True:
+        with transaction.atomic():
+            rows = list(get_queryset(now).order_by("expires_at").values_list("pk", flat=True)[:chunk_size])
+            if not rows:
+                break
+            if name == "violations":
+                user_ids = set(UserViolation.objects.filter(pk__in=rows).values_list("user_id", flat=True))
+            elif name == "bans":
+                lifted = list(SpaceBan.objects.filter(pk__in=rows).values_list("space_id", "user_id"))
+            # Filter on the expiry condition again so a row un-expired since we read it is left alone
+            expired = get_queryset(now).filter(pk__in=rows).update(updated_at=timezone.now(), **changes)
+            if name == "violations":
+                recompute_standings(user_ids)
+            elif name == "bans":
+                transaction.on_commit(lambda lifted=lifted: forget_bans(lifted))
+        total += expired
+        if len(rows) < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    elapsed = time.perf_counter() - started
+    metrics.incr(f"sweeper.{name}.expired", total)
+    metrics.observe(f"sweeper.{name}.duration", elapsed)
+    logger.info("Swept %d expired %s in %.2fs (backlog was %d)", total, name, elapsed, backlog)
+    return total
+
+
+def sweep(chunk_size: int = DEFAULT_CHUNK_SIZE, pause: float = 0) -> dict:
+    """Run every sweep once. Returns {kind: rows expired}."""
+    now = timezone.now()
+    started = time.perf_counter()
+    results = {name: sweep_kind(name, now=now, chunk_size=chunk_size, pause=pause) for name in SWEEPS}
+    metrics.observe("sweeper.duration", time.perf_counter() - started)
+    return results
+
+
+def run_forever(interval: float = 60, chunk_size: int = DEFAULT_CHUNK_SIZE, pause: float = 0):
+    """Long-running worker mode. Sweeps every interval seconds until interrupted."""
+    while True:
+        started = time.monotonic()
+        try:
+            sweep(chunk_size=chunk_size, pause=pause)
+        except Exception:
+            logger.exception("Expiry sweep failed")
+        time.sleep(max(0, interval - (time.monotonic() - started)))
@@ -1,3 +1,49 @@
 from django.test import TestCase
+from users.models import User
+from .models import UserRecord, UserViolation
+from .utils import recompute_standings, standing_for_points
 
-# Create your tests here.
+
+class StandingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(email=f"user{i}@koru.test", username=f"user{i}") for i in range(3)]
+
+    def test_thresholds(self):
+        self.assertEqual([standing_for_points(p) for p in (0, 15, 16, 21, 26, 31, 36, 99)], [0, 0, 1, 2, 3, 4, 5, 5])
+
+    def test_recompute_is_deferred_and_deduplicated(self):
+        user = self.users[0]
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            for _ in range(4):
+                UserViolation.objects.create(user=user, action="warn", standing_point_worth=5)
+        self.assertTrue(callbacks)
+        record = UserRecord.objects.get(user=user)
+        self.assertEqual((record.standing_points, record.standing), (20, 1))
+
+    def test_bulk_recompute_is_one_update_per_batch(self):
+        UserViolation.objects.bulk_create(
+            UserViolation(user=user, action="ban", standing_point_worth=40) for user in self.users
+        )
+        UserRecord.objects.bulk_create(UserRecord(user=user) for user in self.users)
+        with self.assertNumQueries(1):
+            self.assertEqual(recompute_standings([u.pk for u in self.users]), 3)
+        self.assertEqual(set(UserRecord.objects.values_list("standing", flat=True)), {5})
+
+
+class SweeperTests(TestCase):
+    def test_expired_violations_are_swept_and_standing_recomputed(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .sweeper import sweep_kind
+        user = User.objects.create(email="swept@koru.test", username="swept")
+        past, future = timezone.now() - timedelta(days=1), timezone.now() + timedelta(days=1)
+        UserViolation.objects.bulk_create([
+            UserViolation(user=user, action="warn", standing_point_worth=20, expires_at=past),
+            UserViolation(user=user, action="warn", standing_point_worth=20, expires_at=past),
+            UserViolation(user=user, action="warn", standing_point_worth=16, expires_at=future),
+        ])
+        self.assertEqual(sweep_kind("violations", chunk_size=1), 2)
+        self.assertEqual(UserViolation.objects.filter(active=True).count(), 1)
+        record = UserRecord.objects.get(user=user)
+        self.assertEqual((record.standing_points, record.standing), (16, 1))
@@ -1,32 +1,97 @@
-from django.db import models
+import threading
+from django.db import transaction
+from django.db.models import Case, IntegerField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Now
+from django.db.models.lookups import GreaterThanOrEqual
 from .models import UserRecord, UserViolation
-from users.models import User
-
-def recalc_standing(user: User):
-    record, created = UserRecord.objects.get_or_create(user=user)
-    active_violations = user.moderation_records.filter(expires_at__gt=models.functions.Now(), appealed=False)
-    total_points = sum(v.standing_point_worth for v in active_violations)
-
-    record.standingPts = total_points
-
-    if total_points >= 36:
-        record.standing = 5
-    elif total_points >= 31:
-        record.standing = 4
-    elif total_points >= 26:
-        record.standing = 3
-    elif total_points >= 21:
-        record.standing = 2
-    elif total_points >= 16:
-        record.standing = 1
-    else:
-        record.standing = 0
-
-    record.save()
-
-def recalc_points(user: User):
-    violations = UserViolation.objects.exclude(active=False).filter(user=user)
-    total_points = sum(v.standing_point_worth for v in violations)
-    record, created = UserRecord.objects.get_or_create(user=user)
-    record.standing_points = total_points
-    record.save()
\ No newline at end of file
+
+# (minimum points, standing) from worst to best, see UserRecord
+STANDING_THRESHOLDS = [
+    (36, 5),
+    (31, 4),
+    (26, 3),
+    (21, 2),
+    (16, 1),
+]
+
+RECOMPUTE_BATCH_SIZE = 500
+
+
+def standing_for_points(points: int) -> int:
+    for minimum, standing in STANDING_THRESHOLDS:
+        if points >= minimum:
+            return standing
+    return 0
+
+
+def active_violations():
+    """Violations that still count towards standing: active, and either permanent or not expired yet."""
+    return UserViolation.objects.filter(Q(expires_at__isnull=True) | Q(expires_at__gt=Now()), active=True)
+
+
+def _points_expression():
+    points = (
+        active_violations()
+        .filter(user_id=OuterRef("user_id"))
+        .order_by()
+        .values("user_id")
+        .annotate(total=Sum("standing_point_worth"))
+        .values("total")
+    )
+    return Coalesce(Subquery(points, output_field=IntegerField()), Value(0))
+
+
+def recompute_standings(user_ids, batch_size: int = RECOMPUTE_BATCH_SIZE) -> int:
+    """
+    Recompute standing_points and standing for many users at once. The sum is done by the database and every
+    batch is written with a single UPDATE. Returns the number of records updated.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    updated = 0
+    for i in range(0, len(user_ids), batch_size):
+        batch = user_ids[i:i + batch_size]
+        # SET can't see the new standing_points, so the standing CASE runs the same sum again
+        points = _points_expression()
+        standing = Case(
+            *[When(GreaterThanOrEqual(points, minimum), then=Value(level)) for minimum, level in STANDING_THRESHOLDS],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+        count = UserRecord.objects.filter(user_id__in=batch).update(standing_points=points, standing=standing)
+        if count < len(batch):
+            # Someone is missing a record, make them and go again
+            existing = set(UserRecord.objects.filter(user_id__in=batch).values_list("user_id", flat=True))
+            UserRecord.objects.bulk_create(
+                [UserRecord(user_id=user_id) for user_id in batch if user_id not in existing], ignore_conflicts=True
+            )
+            count = UserRecord.objects.filter(user_id__in=batch).update(standing_points=points, standing=standing)
+        updated += count
+    return updated
+
+
+def recompute_standing(user_id) -> int:
+    return recompute_standings([user_id])
+
+
+# Users waiting for a recompute at the end of the current transaction
+_pending = threading.local()
+
+
+def _run_pending():
+    user_ids = getattr(_pending, "user_ids", None)
+    _pending.user_ids = set()
+    if user_ids:
+        recompute_standings(user_ids)
+
+
+def schedule_standing_recompute(user_id):
+    """
+    Recompute a user's standing once the current transaction commits (or right away outside of one).
+    Scheduling the same user several times in one transaction only recomputes them once.
+    """
+    if not hasattr(_pending, "user_ids"):
+        _pending.user_ids = set()
+    _pending.user_ids.add(user_id)
+    # The first callback to run handles everyone, the rest find nothing left to do. If the transaction rolls back
+    # the ids stay queued and get recomputed on the next commit, which is harmless.
+    transaction.on_commit(_run_pending)